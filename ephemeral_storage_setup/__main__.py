@@ -0,0 +1,3 @@
+from ephemeral_storage_setup.cli import cli
+
+cli()
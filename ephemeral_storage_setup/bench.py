@@ -0,0 +1,274 @@
+"""
+Self-contained direct I/O benchmark for the assembled array, used to verify that
+a host performs as expected before it starts serving.
+
+Each job runs a number of threads doing synchronous I/O with page-aligned
+buffers. Queue depth is emulated by the number of threads, since each thread
+has one request in flight at a time.
+"""
+
+import concurrent.futures
+import logging
+import mmap
+import os
+import random
+import stat
+import time
+
+from ephemeral_storage_setup import crypt, utils
+
+logger = logging.getLogger()
+
+BENCH_FILE_NAME = ".ephemeral-storage-setup-bench"
+
+# Default jobs: name, block size, random offsets, write.
+JOBS = (
+    ("seq-write", 1024**2, False, True),
+    ("seq-read", 1024**2, False, False),
+    ("rand-write", 4096, True, True),
+    ("rand-read", 4096, True, False),
+)
+
+
+class BelowThreshold(Exception):
+    pass
+
+
+def percentile(sorted_values, fraction):
+    """
+    Return the given percentile (0.0 - 1.0) of a sorted, non-empty list.
+    """
+
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return sorted_values[index]
+
+
+def run_job(fd, name, block_size, random_offsets, write, threads, size, runtime):
+    """
+    Run a single benchmark job against the open file descriptor, and return
+    its result as a dict.
+    """
+
+    blocks = size // block_size
+    if blocks < threads:
+        raise ValueError(f"benchmark size too small for {name}: {size}")
+
+    deadline = time.monotonic() + runtime
+
+    def worker(index):
+        # Anonymous mmap gives a page-aligned buffer, as required by O_DIRECT.
+        buf = mmap.mmap(-1, block_size)
+        if write:
+            buf.write(os.urandom(block_size))
+
+        rng = random.Random(index)
+        first_block = index * blocks // threads
+        slice_blocks = (index + 1) * blocks // threads - first_block
+        latencies = []
+        block = 0
+        while True:
+            if random_offsets:
+                offset = rng.randrange(blocks) * block_size
+            else:
+                offset = (first_block + block % slice_blocks) * block_size
+                block += 1
+
+            start = time.monotonic()
+            if write:
+                os.pwrite(fd, buf, offset)
+            else:
+                os.preadv(fd, [buf], offset)
+            end = time.monotonic()
+
+            latencies.append(end - start)
+            if end >= deadline:
+                break
+
+        buf.close()
+        return latencies
+
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        latencies = sorted(
+            latency
+            for worker_latencies in executor.map(worker, range(threads))
+            for latency in worker_latencies
+        )
+    elapsed = time.monotonic() - start
+
+    if write:
+        os.fsync(fd)
+
+    ops = len(latencies)
+    return {
+        "job": name,
+        "block_size": block_size,
+        "threads": threads,
+        "ops": ops,
+        "bytes": ops * block_size,
+        "seconds": round(elapsed, 6),
+        "iops": round(ops / elapsed, 1),
+        "mbps": round(ops * block_size / elapsed / 1024**2, 1),
+        "lat_p50_us": round(percentile(latencies, 0.50) * 1e6, 1),
+        "lat_p99_us": round(percentile(latencies, 0.99) * 1e6, 1),
+    }
+
+
+def prepare_file(path, size):
+    """
+    Create and fill the benchmark file, so that reads hit allocated, written
+    blocks rather than holes.
+    """
+
+    chunk = b"\xa5" * 1024**2
+    with open(path, "wb") as f:
+        written = 0
+        while written < size:
+            written += f.write(chunk[: min(len(chunk), size - written)])
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def default_target(config):
+    """
+    Return the default benchmark target: a file under the mount point if one
+    is configured, or the md device otherwise.
+    """
+
+    mount_point_path = config.get("mount", {}).get("mount_point", {}).get("path")
+    if mount_point_path:
+        return os.path.join(mount_point_path, BENCH_FILE_NAME)
+
+    return f"/dev/md/{config.get('mdraid', {}).get('name', 'ephemeral')}"
+
+
+def jobs(bench_config, is_device):
+    """
+    Yield (name, block size, random offsets, write, threads) for each job.
+    Writes to a block device destroy its contents, so they must be enabled
+    explicitly for device targets.
+    """
+
+    threads = bench_config.get("threads", 4)
+    allow_write = not is_device or bench_config.get("allow_device_write", False)
+
+    for name, block_size, random_offsets, write in JOBS:
+        if write and not allow_write:
+            continue
+        yield name, block_size, random_offsets, write, threads
+
+    for queue_depth in bench_config.get("queue_depths", [1, 4, 16, 32]):
+        yield f"rand-read-qd{queue_depth}", 4096, True, False, queue_depth
+
+
+def run(config, target=None):
+    """
+    Run the benchmark, log each result, and return the list of results.
+    """
+
+    bench_config = config.get("bench", {})
+    target = target or bench_config.get("target") or default_target(config)
+    size = utils.to_bytes(bench_config.get("size", "1G"))
+    runtime = float(bench_config.get("runtime", 5))
+
+    is_device = os.path.exists(target) and stat.S_ISBLK(os.stat(target).st_mode)
+    if not is_device:
+        prepare_file(target, size)
+
+    flags = os.O_RDWR
+    if bench_config.get("direct", True):
+        flags |= os.O_DIRECT
+
+    results = []
+    fd = os.open(target, flags)
+    try:
+        if is_device:
+            size = min(size, os.lseek(fd, 0, os.SEEK_END))
+
+        for name, block_size, random_offsets, write, threads in jobs(
+            bench_config, is_device
+        ):
+            result = run_job(
+                fd, name, block_size, random_offsets, write, threads, size, runtime
+            )
+            result["target"] = target
+            logger.info("benchmark result", extra=result)
+            results.append(result)
+    finally:
+        os.close(fd)
+        if not is_device:
+            os.unlink(target)
+
+    return results
+
+
+def compare_encryption(config):
+    """
+    Run the read-only device jobs against the crypt device, and against the
+    plaintext device under it, and return the crypt device results, each with
+    the plaintext result, and the IOPS overhead in percent.
+    """
+
+    encrypted = crypt.bench_target(config)
+    plaintext = crypt.backing_device(encrypted)
+
+    # Writing to the device under the crypt device would destroy the data.
+    config = dict(config, bench=dict(config.get("bench", {}), allow_device_write=False))
+
+    plaintext_results = {
+        result["job"]: result for result in run(config, target=plaintext)
+    }
+    results = run(config, target=encrypted)
+    for result in results:
+        baseline = plaintext_results[result["job"]]
+        result["plaintext"] = baseline
+        result["overhead_pct"] = (
+            round((1 - result["iops"] / baseline["iops"]) * 100, 1)
+            if baseline["iops"]
+            else None
+        )
+        logger.info(
+            "encryption overhead",
+            extra={
+                "job": result["job"],
+                "iops": result["iops"],
+                "plaintext_iops": baseline["iops"],
+                "lat_p99_us": result["lat_p99_us"],
+                "plaintext_lat_p99_us": baseline["lat_p99_us"],
+                "overhead_pct": result["overhead_pct"],
+            },
+        )
+
+    return results
+
+
+def check_thresholds(results, thresholds):
+    """
+    Compare the results to minimum thresholds, given as a dict of job name to
+    a dict of metric (e.g. iops, mbps) to minimum value. Raise BelowThreshold
+    listing every failure.
+    """
+
+    by_job = {result["job"]: result for result in results}
+    failures = []
+    for job, minimums in thresholds.items():
+        if job not in by_job:
+            failures.append(f"{job}: not run")
+            continue
+
+        for metric, minimum in minimums.items():
+            value = by_job[job][metric]
+            if value < minimum:
+                logger.error(
+                    "benchmark below threshold",
+                    extra={
+                        "job": job,
+                        "metric": metric,
+                        "value": value,
+                        "threshold": minimum,
+                    },
+                )
+                failures.append(f"{job} {metric}: {value} < {minimum}")
+
+    if failures:
+        raise BelowThreshold("; ".join(failures))
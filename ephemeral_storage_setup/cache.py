@@ -0,0 +1,194 @@
+"""
+dm-cache layer using the ephemeral array as a block cache in front of a
+persistent device, like an EBS volume. The array is split into a metadata and a
+data device with dm-linear, and the cache device is created with dmsetup.
+
+Device-mapper tables don't persist, so the cache device is created again on
+every boot. When the array survived, the cache metadata is reused, keeping any
+dirty blocks. When the array was rebuilt from blank disks, the metadata is
+wiped, and the cache starts out empty.
+"""
+
+import logging
+import os
+import os.path
+
+from ephemeral_storage_setup import devices, execute, readiness, utils
+
+logger = logging.getLogger()
+
+MAPPER_DIR = "/dev/mapper"
+
+MODES = ("writethrough", "writeback")
+
+# dm-cache block size bounds: a multiple of 32K, up to 1G.
+BLOCK_SIZE_MULTIPLE = 32 * 1024
+DEFAULT_BLOCK_SIZE = 256 * 1024
+
+SECTOR_SIZE = 512
+
+# Cache metadata: a fixed part, and 16 bytes per cache block, rounded up.
+METADATA_BASE_SIZE = 4 * 1024**2
+METADATA_BYTES_PER_BLOCK = 16
+METADATA_ALIGNMENT = 1024**2
+
+# Bytes zeroed at the start of the metadata device, for dm-cache to format
+# fresh metadata.
+METADATA_WIPE_SIZE = 4096
+
+
+def block_size(config):
+    size = utils.to_bytes(config.get("block_size", DEFAULT_BLOCK_SIZE))
+    if size % BLOCK_SIZE_MULTIPLE or not 0 < size <= 1024**3:
+        raise ValueError(f"invalid cache block size: {size}")
+
+    return size
+
+
+def metadata_size(cache_bytes, cache_block_size):
+    """
+    Return the size in bytes of the metadata area for a cache of the given
+    size and block size.
+    """
+
+    size = METADATA_BASE_SIZE + METADATA_BYTES_PER_BLOCK * (
+        cache_bytes // cache_block_size
+    )
+    return -(-size // METADATA_ALIGNMENT) * METADATA_ALIGNMENT
+
+
+def select_origin(devs, detect_config):
+    """
+    Return the persistent disk to cache, among the scanned devices: the one
+    disk that matches the detect config, and isn't partitioned or in use by
+    other devices. Raise RuntimeError unless there's exactly one.
+    """
+
+    candidates = []
+    for dev in devs:
+        if not isinstance(dev, devices.Disk):
+            continue
+
+        # Partitioned disks, like the root volume, and disks held by other
+        # devices are never origins.
+        if dev.raw_info.get("pttype") or dev.raw_info.get("children"):
+            continue
+
+        if dev.matches_config(detect_config):
+            candidates.append(dev)
+
+    if len(candidates) != 1:
+        raise RuntimeError(
+            f"expected one cache origin device, found {len(candidates)}: "
+            f"{', '.join(dev.path for dev in candidates)}"
+        )
+
+    return candidates[0]
+
+
+def tables(cache_path, cache_bytes, origin_path, origin_bytes, config):
+    """
+    Return the dm tables of the (metadata, data, cache) devices, for a cache
+    on cache_path, in front of origin_path.
+    """
+
+    mode = config.get("mode", "writethrough")
+    if mode not in MODES:
+        raise ValueError(f"unknown cache mode: {mode}")
+
+    name = config.get("name", "ephemeral-cache")
+    cache_block_size = block_size(config)
+    metadata_bytes = metadata_size(cache_bytes, cache_block_size)
+    data_bytes = cache_bytes - metadata_bytes
+    data_bytes -= data_bytes % cache_block_size
+
+    metadata_sectors = metadata_bytes // SECTOR_SIZE
+    metadata_table = f"0 {metadata_sectors} linear {cache_path} 0"
+    data_table = f"0 {data_bytes // SECTOR_SIZE} linear {cache_path} {metadata_sectors}"
+    cache_table = (
+        f"0 {origin_bytes // SECTOR_SIZE} cache "
+        f"{MAPPER_DIR}/{name}-cmeta {MAPPER_DIR}/{name}-cdata {origin_path} "
+        f"{cache_block_size // SECTOR_SIZE} 1 {mode} default 0"
+    )
+
+    return metadata_table, data_table, cache_table
+
+
+def dmsetup_create(name, table):
+    execute.run_sync(["dmsetup", "create", name, "--table", table])
+
+
+def wipe_metadata(metadata_path):
+    with open(metadata_path, "r+b") as f:
+        f.write(bytes(METADATA_WIPE_SIZE))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def attach(cache_path, origin_path, config, fresh):
+    """
+    Create the cache device in front of origin_path, using the device at
+    cache_path as cache, and return the cache device path. With fresh, the
+    cache metadata is wiped first, as for a newly created array.
+    """
+
+    name = config.get("name", "ephemeral-cache")
+    device_path = os.path.join(MAPPER_DIR, name)
+    if os.path.exists(device_path):
+        logger.info("cache device already active", extra={"path": device_path})
+        return device_path
+
+    metadata_table, data_table, cache_table = tables(
+        cache_path,
+        utils.device_size(cache_path),
+        origin_path,
+        utils.device_size(origin_path),
+        config,
+    )
+
+    dmsetup_create(f"{name}-cmeta", metadata_table)
+    dmsetup_create(f"{name}-cdata", data_table)
+    readiness.wait_for_nodes(
+        [
+            os.path.join(MAPPER_DIR, f"{name}-cmeta"),
+            os.path.join(MAPPER_DIR, f"{name}-cdata"),
+        ]
+    )
+
+    if fresh:
+        if config.get("mode", "writethrough") == "writeback":
+            logger.warning(
+                "rebuilding writeback cache; blocks not yet written back by a "
+                "previous cache are lost",
+                extra={"origin": origin_path},
+            )
+        wipe_metadata(os.path.join(MAPPER_DIR, f"{name}-cmeta"))
+
+    dmsetup_create(name, cache_table)
+    devices.topology.invalidate("dmsetup")
+    readiness.wait_for_nodes([device_path])
+
+    logger.info(
+        "attached cache",
+        extra={
+            "path": device_path,
+            "cache": cache_path,
+            "origin": origin_path,
+            "fresh": fresh,
+            "table": cache_table,
+        },
+    )
+    return device_path
+
+
+def find_origin(fsuuid):
+    """
+    Return the path of the origin device holding the filesystem with the given
+    UUID, when the cache device isn't active yet.
+    """
+
+    path = f"/dev/disk/by-uuid/{fsuuid}"
+    if not os.path.exists(path):
+        raise RuntimeError(f"cache origin device not found: {path}")
+
+    return os.path.realpath(path)
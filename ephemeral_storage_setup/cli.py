@@ -1,25 +1,52 @@
+import argparse
 import logging
 import os.path
 import sys
 import traceback
 
-import yaml
-
-from ephemeral_storage_setup import devices, utils
+from ephemeral_storage_setup import (
+    devices,
+    geometry,
+    lazy,
+    pipeline,
+    readiness,
+    report,
+    resume,
+    tune,
+    utils,
+)
 
 from .log import CustomJsonFormatter
 
+# Subsystems only some runs need are imported on first use.
+yaml = lazy.module("yaml")
+bench = lazy.module("ephemeral_storage_setup.bench")
+cache = lazy.module("ephemeral_storage_setup.cache")
+crypt = lazy.module("ephemeral_storage_setup.crypt")
+hotplug = lazy.module("ephemeral_storage_setup.hotplug")
+numa = lazy.module("ephemeral_storage_setup.numa")
+populate = lazy.module("ephemeral_storage_setup.populate")
+probe = lazy.module("ephemeral_storage_setup.probe")
+
 logger = logging.getLogger()
 
+# Exit code of `bench --check` when results are below the thresholds, apart
+# from errors (1), for health checks.
+EXIT_BELOW_THRESHOLD = 2
+
 config_file_paths = [
     "/etc/ephemeral-storage-setup/config.yml",
 ]
 
 
-def main():
-    # If supplied, treat the first argument as the configuration file.
-    if len(sys.argv) > 1:
-        config_file_paths.insert(0, sys.argv[1])
+def load_config(config_path=None):
+    """
+    Load the configuration from the given path, or the default paths, and
+    apply the global settings.
+    """
+
+    if config_path is not None:
+        config_file_paths.insert(0, config_path)
 
     config = None
     for fn in config_file_paths:
@@ -44,8 +71,20 @@ def main():
     # Update log level from config.
     logger.setLevel(config.get("log_level", logging.INFO))
 
+    devices.configure_scanner(config.get("scanner", "lsblk"))
+    readiness.configure(config.get("udev", {}))
+
+    return config
+
+
+def select_disks(devs, detect_config):
+    """
+    Return the uninitialized disks among the scanned devices that match the
+    detect configuration.
+    """
+
     disks = []
-    for dev in devices.scan_devices():
+    for dev in devs:
         if not isinstance(dev, devices.Disk):
             logger.info(f"Device {dev.path} not a disk. Skipping.")
             continue
@@ -54,29 +93,635 @@ def main():
             logger.info(f"Device {dev.path} is already initialized. Skipping.")
             continue
 
-        if not dev.matches_config(config.get("detect", {})):
-            logger.info(f"Device {dev.path} doesn't match the detect configuration. Skipping.")
+        if not dev.matches_config(detect_config):
+            logger.info(
+                f"Device {dev.path} doesn't match the detect configuration. Skipping."
+            )
             continue
 
         disks.append(dev)
 
-    if len(disks) == 0:
-        logger.error("no member devices found")
-        raise RuntimeError("no member devices found")
+    return disks
+
+
+def pool_configs(config):
+    """
+    Return the config of each pool. Without a `pools` section, the whole config
+    is a single pool. Otherwise, each pool's sections (detect, mdraid, mkfs,
+    mount, etc) replace the top-level sections of the same name.
+    """
+
+    if "pools" not in config:
+        return [config]
+
+    defaults = {key: value for key, value in config.items() if key != "pools"}
+    pools = [dict(defaults, **pool) for pool in config["pools"]]
+
+    md_names = [pool_name(pool) for pool in pools]
+    duplicates = sorted({name for name in md_names if md_names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"pools with duplicate mdraid names: {', '.join(duplicates)}")
+
+    return pools
+
+
+def pool_name(config):
+    return config.get("mdraid", {}).get("name", "ephemeral")
+
+
+def numa_pool(config, node):
+    """
+    Return the config of the part of a NUMA pool on the given node: an array
+    and mount point of its own, named after the node from the templates in the
+    numa section.
+    """
+
+    if "cache" in config:
+        raise ValueError("numa and cache can't be combined")
+
+    numa_config = config["numa"]
+    mdraid_config = config.get("mdraid", {})
+    mount_config = config.get("mount", {})
+    mount_point_config = mount_config.get("mount_point", {})
+
+    md_name = numa_config.get("name", "{name}-node{node}").format(
+        name=pool_name(config), node=node
+    )
+    path = numa_config.get("mount_point", "{path}-node{node}").format(
+        path=mount_point_config.get("path", ""), node=node
+    )
+
+    pool = {key: value for key, value in config.items() if key != "numa"}
+    pool["mdraid"] = dict(mdraid_config, name=md_name)
+    pool["mount"] = dict(mount_config, mount_point=dict(mount_point_config, path=path))
+    pool["numa_node"] = node
+    return pool
+
+
+def split_numa(pools, pool_disks, origins):
+    """
+    Replace each pool with a numa section by one pool per NUMA node its disks
+    are attached to, so that each array only stripes over disks local to one
+    node. Return the pools, disks and origins like find_disks.
+    """
+
+    split_pools, split_disks, split_origins = [], [], []
+    for pool, disks, origin in zip(pools, pool_disks, origins):
+        if "numa" not in pool or not disks:
+            split_pools.append(pool)
+            split_disks.append(disks)
+            split_origins.append(origin)
+            continue
+
+        node_disks = {}
+        for disk in disks:
+            node = numa.device_node(disk.raw_info["kname"])
+            node_disks.setdefault(node, []).append(disk)
+
+        for node, disks in sorted(node_disks.items()):
+            split_pools.append(numa_pool(pool, node))
+            split_disks.append(disks)
+            split_origins.append(None)
+
+    return split_pools, split_disks, split_origins
+
+
+def record_numa(config):
+    """
+    Record the NUMA node of a pool's array in the run report, with the node's
+    CPUs, for pinning workers next to the storage.
+    """
+
+    node = config["numa_node"]
+    report.current.add_to_section(
+        "numa",
+        pool_name(config),
+        {
+            "node": node,
+            "cpulist": numa.cpulist(node),
+            "mount_point": config["mount"]["mount_point"]["path"],
+        },
+    )
+
+
+def resume_pool(config):
+    """
+    Reuse the pool's arrays from the last run, like resume.resume. A NUMA pool
+    is reused if any node had an array, and all such arrays are reused; nodes
+    without disks never have one.
+    """
+
+    if "numa" not in config:
+        return resume.resume(config)
+
+    path = resume.state_path(config)
+    state = (resume.load_state(path) if path else None) or {"arrays": {}}
+    saved = [
+        pool
+        for pool in (numa_pool(config, node) for node in numa.online_nodes())
+        if pool_name(pool) in state["arrays"]
+    ]
+
+    resumed = True
+    for pool in saved:
+        if resume.resume(pool):
+            record_numa(pool)
+        else:
+            resumed = False
+
+    return bool(saved) and resumed
+
+
+def match_disks(pools, devs):
+    """
+    Return the member disks of each pool among the scanned devices, and the
+    cache origin device of each pool (None for pools without a cache). Origins
+    are selected first, so they are never used as members. Each member disk is
+    assigned to the first pool whose detect configuration it matches.
+    """
+
+    pool_disks = []
+    origins = []
+    for pool in pools:
+        origin = None
+        if "cache" in pool:
+            origin = cache.select_origin(devs, pool["cache"].get("detect", {}))
+            devs = [dev for dev in devs if dev is not origin]
+        origins.append(origin)
+
+    for pool in pools:
+        disks = select_disks(devs, pool.get("detect", {}))
+        devs = [dev for dev in devs if dev not in disks]
+        pool_disks.append(disks)
+
+    return pool_disks, origins
+
+
+def find_disks(pools):
+    """
+    Scan, and return the member disks and cache origin of each pool, as
+    returned by match_disks. If any pool has a `wait` section, scan again on
+    every block device event until all such pools have the expected disks, or
+    the deadline passes.
+    """
+
+    wait_configs = [pool["wait"] for pool in pools if "wait" in pool]
+    if not wait_configs:
+        with report.phase("scan"):
+            devs = devices.scan_devices()
+
+        with report.phase("filter"):
+            return match_disks(pools, devs)
+
+    def check():
+        try:
+            pool_disks, origins = match_disks(pools, devices.scan_devices())
+        except RuntimeError as e:
+            # The cache origin may not be attached yet.
+            return False, e
+
+        ready = all(
+            hotplug.satisfied(disks, pool.get("wait"))
+            for pool, disks in zip(pools, pool_disks)
+        )
+        return ready, (pool_disks, origins)
+
+    timeout = max(float(c.get("timeout", 30)) for c in wait_configs)
+    settle = max(float(c.get("settle", 0)) for c in wait_configs)
+    with report.phase("wait", timeout=timeout, settle=settle):
+        ready, result = hotplug.wait_for(check, timeout, settle)
+
+    if isinstance(result, Exception):
+        raise result
+
+    pool_disks, origins = result
+    for pool, disks in zip(pools, pool_disks):
+        if hotplug.satisfied(disks, pool.get("wait")):
+            continue
+
+        logger.warning(
+            "expected disks did not appear in time",
+            extra={"pool": pool_name(pool), "found": len(disks), **pool["wait"]},
+        )
+        if pool["wait"].get("on_timeout", "proceed") == "fail":
+            raise RuntimeError(
+                f"expected disks for {pool_name(pool)} did not appear in time; "
+                f"found {len(disks)}"
+            )
+
+    return pool_disks, origins
+
+
+def probe_disks(pools, pool_disks):
+    """
+    Probe the disks of pools with a probe section, and return the member disks
+    of each pool, without the disks found out of tolerance.
+    """
+
+    probed = []
+    for pool, disks in zip(pools, pool_disks):
+        if "probe" in pool and disks:
+            with report.phase("probe", pool=pool_name(pool), disks=len(disks)):
+                disks = probe.check(disks, pool["probe"])
+        probed.append(disks)
+
+    return probed
+
+
+def build_pipeline(config, disks, steps=None, prefix="", origin=None):
+    """
+    Add the setup steps for a pool with the given member disks to the
+    dependency graph, and return it. Step names get the given prefix, so that
+    several pools can be built by the same graph.
+
+    With a cache origin device, the array becomes a cache in front of it, and
+    the filesystem lives on the cache device. The origin is only formatted and
+    populated if it has no filesystem yet, and it's mounted without an fstab
+    entry, since the cache device only exists once this has run.
+
+    With a crypt section, the array is encrypted, either by a crypt device over
+    it, or by a crypt device under it for each member.
+    """
+
+    mdraid_config = config.get("mdraid", {})
+    md_name = mdraid_config.get("name", "ephemeral")
+    mount_point_path = config.get("mount", {}).get("mount_point", {}).get("path")
+    populate_config = config.get("populate", {})
+
+    if steps is None:
+        steps = pipeline.Pipeline()
+
+    def step(name):
+        return f"{prefix}{name}"
+
+    partition_steps = []
+    for disk in disks:
+        name = step(f"partition:{disk.path}")
+        steps.add(
+            name,
+            lambda results, disk=disk: disk.write_single_partition(),
+            group=step("partition"),
+        )
+        partition_steps.append(name)
+
+    def resolve_partitions(results):
+        partitions = devices.resolve_partitions(
+            disks,
+            {disk.path: results[step(f"partition:{disk.path}")] for disk in disks},
+        )
+        for disk, partition in zip(disks, partitions):
+            logger.info(f"Created partition {partition.path} on disk {disk.path}")
+        return partitions
+
+    steps.add(step("partitions"), resolve_partitions, requires=partition_steps)
+
+    crypt_config = config.get("crypt")
+    if crypt_config is not None and origin is not None:
+        raise ValueError("crypt and cache can't be combined")
+
+    encrypt_members = (
+        crypt_config is not None and crypt.layout(crypt_config) == "members"
+    )
+    if encrypt_members:
+        member_steps = []
+        for index, disk in enumerate(disks):
+            name = step(f"crypt:{disk.path}")
+
+            def encrypt_member(results, index=index):
+                return crypt.create(
+                    crypt.device_name(crypt_config, md_name, index),
+                    results[step("partitions")][index].path,
+                    crypt_config,
+                )
+
+            steps.add(name, encrypt_member, requires=[step("partitions")])
+            member_steps.append(name)
+
+        def members(results):
+            return [results[name] for name in member_steps]
+
+    else:
+        member_steps = [step("partitions")]
+
+        def members(results):
+            return results[step("partitions")]
+
+    def assemble(results):
+        logger.info(f"Creating mdraid device from {len(disks)} partitions")
+        return devices.create_mdraid(members(results), mdraid_config)
+
+    steps.add(step("assemble"), assemble, requires=member_steps)
+
+    # Tune before mkfs, so that mkfs and populate benefit too.
+    tuned = [step("assemble")]
+    level = mdraid_config.get("level", 0)
+    if geometry.is_redundant(level):
+
+        def tune_md(results):
+            tune.tune_md(
+                results[step("assemble")].raw_info["kname"],
+                level,
+                len(disks),
+                mdraid_config,
+            )
+
+        steps.add(step("md-settings"), tune_md, requires=[step("assemble")])
+        tuned.append(step("md-settings"))
+
+    if "tune" in config:
+
+        def tune_queues(results):
+            tune.tune(disks, results[step("assemble")], md_name, config["tune"])
+
+        steps.add(step("tune"), tune_queues, requires=[step("assemble")])
+        tuned.append(step("tune"))
+
+    if crypt_config is not None and not encrypt_members:
+        device_step = step("crypt")
+
+        def encrypt_array(results):
+            return crypt.create(
+                crypt.device_name(crypt_config, md_name),
+                results[step("assemble")].path,
+                crypt_config,
+            )
+
+        steps.add(device_step, encrypt_array, requires=tuned)
+        tuned = [device_step]
+
+        def device_path(results):
+            return results[device_step].path
+
+        def device_stripe(results):
+            return geometry.device_stripe(results[step("assemble")].raw_info)
+
+        format_filesystem = True
+    elif origin is None:
+        device_step = step("assemble")
+
+        def device_path(results):
+            return results[device_step].path
+
+        def device_stripe(results):
+            return geometry.device_stripe(results[device_step].raw_info)
+
+        format_filesystem = True
+    else:
+        device_step = step("cache")
+
+        def attach_cache(results):
+            return cache.attach(
+                results[step("assemble")].path, origin.path, config["cache"], True
+            )
+
+        steps.add(device_step, attach_cache, requires=tuned)
+        tuned = [device_step]
+
+        def device_path(results):
+            return results[device_step]
+
+        def device_stripe(results):
+            return None
+
+        format_filesystem = origin.raw_info.get("fstype") is None
+
+    if format_filesystem:
+
+        def make_filesystem(results):
+            fsuuid = utils.mkfs(
+                device_path(results),
+                config.get("mkfs", {}),
+                stripe=device_stripe(results),
+            )
+            devices.topology.invalidate("mkfs")
+            return fsuuid
+
+        steps.add(step("mkfs"), make_filesystem, requires=tuned)
+        filesystem_ready = [step("mkfs")]
     else:
-        logger.info(f"Found {len(disks)} member devices: {', '.join([d.path for d in disks])}")
+        logger.info(
+            f"Cache origin {origin.path} already has a filesystem; not formatting"
+        )
+        filesystem_ready = tuned
+
+    def fsuuid(results):
+        # A custom mkfs command doesn't report the UUID; read it back then.
+        if origin is not None and not format_filesystem:
+            return origin.raw_info["uuid"].lower()
+        if results[step("mkfs")]:
+            return results[step("mkfs")]
+        if origin is None and crypt_config is None:
+            return results[step("assemble")].uuid
+        return resume.read_filesystem_uuid(device_path(results))
+
+    def mount(results):
+        utils.mount_filesystem(device_path(results), config)
+
+    steps.add(step("mount"), mount, requires=filesystem_ready)
+    done = [step("mount")]
+
+    mount_config = config.get("mount", {})
+    persist = utils.persist_method(mount_config)
+    # Encrypted filesystems can't be mounted on boot, as their key is gone.
+    if origin is None and crypt_config is None and persist != "none":
+        # Named after the method: "fstab", or "mount-unit".
+        persist_step = step("fstab" if persist == "fstab" else "mount-unit")
 
-    partitions = []
-    for dev in disks:
-        new_partition = dev.create_single_partition()
-        partitions.append(new_partition)
-        logger.info(f"Created partition {new_partition} on disk {dev.path}")
+        def persist_mount(results):
+            utils.persist_mount(fsuuid(results), config)
 
-    logging.info(f"Creating mdraid device from {len(partitions)} partitions")
+        steps.add(persist_step, persist_mount, requires=filesystem_ready)
+        done.append(persist_step)
 
-    mdraid = devices.create_mdraid(partitions, config.get("mdraid", {}))
-    utils.mkfs(mdraid.path, config.get("mkfs", {}))
-    utils.activate_mount(mdraid, config)
+    if utils.discard_strategy(mount_config) == "periodic":
+        steps.add(
+            step("fstrim"),
+            lambda results: utils.add_fstrim_timer(config),
+            requires=[step("mount")],
+        )
+        done.append(step("fstrim"))
+
+    # Only populate new filesystems, never existing data on a cache origin.
+    if format_filesystem:
+        # Warm the page cache with the populate source while the array and
+        # filesystem are being created.
+        populate_requires = [step("mount")]
+        source = utils.populate_source(populate_config)
+        if source:
+            steps.add(step("stage-populate"), lambda results: populate.prefetch(source))
+            populate_requires.append(step("stage-populate"))
+
+        def populate_mount_point(results):
+            utils.populate_directory(mount_point_path, populate_config)
+
+        steps.add(step("populate"), populate_mount_point, requires=populate_requires)
+        done.append(step("populate"))
+
+    def save_state(results):
+        mdraid = results[step("assemble")]
+        if geometry.is_redundant(level):
+            report.current.add_to_section(
+                "resync", md_name, tune.resync_status(mdraid.raw_info["kname"])
+            )
+        if "numa_node" in config:
+            record_numa(config)
+
+        resume.save_state(
+            config,
+            md_name,
+            fsuuid(results),
+            [
+                partition.raw_info["partuuid"].lower()
+                for partition in results[step("partitions")]
+            ],
+        )
+
+    steps.add(step("save-state"), save_state, requires=done)
+
+    return steps
+
+
+def build_pools(config, pools, pool_disks, origins, allow_empty=False):
+    """
+    Return a single dependency graph building all pools that have disks, so
+    that independent steps of different pools run concurrently. With
+    allow_empty, pools without disks are included too, which is useful for
+    showing the plan.
+    """
+
+    prefixed = "pools" in config or any("numa_node" in pool for pool in pools)
+    steps = pipeline.Pipeline()
+    for pool, disks, origin in zip(pools, pool_disks, origins):
+        name = pool_name(pool)
+        if len(disks) == 0 and not allow_empty:
+            if pool.get("optional", False):
+                logger.warning(f"No member devices found for optional pool {name}")
+                continue
+
+            logger.error("no member devices found", extra={"pool": name})
+            raise RuntimeError(f"no member devices found for {name}")
+
+        logger.info(
+            f"Found {len(disks)} member devices for {name}: "
+            f"{', '.join([d.path for d in disks])}"
+        )
+
+        prefix = f"{name}:" if prefixed else ""
+        build_pipeline(pool, disks, steps, prefix, origin)
+
+    return steps
+
+
+def setup(config):
+    pools = []
+    for pool in pool_configs(config):
+        with report.phase("resume", pool=pool_name(pool)):
+            if not resume_pool(pool):
+                pools.append(pool)
+
+    if not pools:
+        return
+
+    pool_disks, origins = find_disks(pools)
+    pool_disks = probe_disks(pools, pool_disks)
+
+    steps = build_pools(config, *split_numa(pools, pool_disks, origins))
+    steps.run(max_workers=config.get("pipeline", {}).get("max_workers", 8))
+
+
+def plan(config):
+    """
+    Print the setup steps for the currently detected disks, with step
+    durations and the critical path from the last run report.
+    """
+
+    pools = pool_configs(config)
+    steps = build_pools(
+        config, *split_numa(pools, *find_disks(pools)), allow_empty=True
+    )
+    last_report = report.read(
+        config.get("report", {}).get("path", report.DEFAULT_REPORT_PATH)
+    )
+    print(steps.plan(last_report))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="ephemeral-storage-setup",
+        description="Set up ephemeral storage.",
+    )
+    parser.add_argument("config", nargs="?", help="configuration file")
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="print the setup steps, with timings from the last run, and exit",
+    )
+    args = parser.parse_args(sys.argv[1:])
+
+    config = load_config(args.config)
+
+    if args.plan:
+        plan(config)
+        return
+
+    run_report = report.reset()
+    try:
+        setup(config)
+    except BaseException:
+        run_report.finish("error")
+        raise
+    else:
+        run_report.finish("ok")
+    finally:
+        try:
+            report.write(config.get("report", {}))
+        except OSError as e:
+            logger.error("error writing run report", extra={"exception": e})
+
+
+def bench_main():
+    parser = argparse.ArgumentParser(
+        prog="ephemeral-storage-setup bench",
+        description="Benchmark the assembled array.",
+    )
+    parser.add_argument("config", nargs="?", help="configuration file")
+    parser.add_argument(
+        "--target",
+        help="block device or file to benchmark (default: from config)",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="exit non-zero if results are below bench.thresholds",
+    )
+    parser.add_argument(
+        "--encryption-overhead",
+        action="store_true",
+        help="compare reads from the crypt device to the plaintext device under it",
+    )
+    args = parser.parse_args(sys.argv[2:])
+
+    config = load_config(args.config)
+    if args.encryption_overhead:
+        results = bench.compare_encryption(config)
+    else:
+        results = bench.run(config, target=args.target)
+
+    if args.check:
+        try:
+            bench.check_thresholds(
+                results, config.get("bench", {}).get("thresholds", {})
+            )
+        except bench.BelowThreshold as e:
+            logger.error("benchmark check failed", extra={"failures": str(e)})
+            sys.exit(EXIT_BELOW_THRESHOLD)
+
+        logger.info("benchmark check passed")
+
+
+subcommands = {
+    "bench": bench_main,
+}
 
 
 def cli():
@@ -86,8 +731,12 @@ def cli():
     logger.addHandler(logHandler)
     logger.setLevel(logging.NOTSET)
 
+    command = main
+    if len(sys.argv) > 1 and sys.argv[1] in subcommands:
+        command = subcommands[sys.argv[1]]
+
     try:
-        main()
+        command()
     except Exception as e:
         logger.error(
             "unhandled exception; exiting",
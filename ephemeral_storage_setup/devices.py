@@ -1,18 +1,22 @@
 """
 Classes and methods for interacting with block devices, based on data obtained
-from lsblk/udev.
+from lsblk/udev, or directly from sysfs and the udev database.
 """
 
 import json
 import logging
 import os
 import stat
+import threading
 import uuid
 
-from ephemeral_storage_setup import execute, utils
+from ephemeral_storage_setup import execute, geometry, readiness, sysfs, utils
 
 logger = logging.getLogger()
 
+# Device scanner backend: "lsblk" or "sysfs". See configure_scanner.
+scanner = "lsblk"
+
 
 class BlockDevice:
     class Unknown(Exception):
@@ -68,8 +72,18 @@ class BlockDevice:
     def sector_size(self):
         return self.raw_info["phy-sec"]
 
+    @property
+    def rotational(self) -> bool:
+        # Older lsblk versions report "0"/"1" strings rather than booleans.
+        return self.raw_info.get("rota") in (True, 1, "1")
+
     def rescan(self):
-        self.raw_info = scan_devices_raw(self.path)[0]
+        """
+        Refresh the device info from the shared topology snapshot. This only
+        scans if the snapshot was invalidated since the last scan.
+        """
+
+        self.raw_info = topology.lookup(self.path)
 
     def matches_config(self, config) -> bool:
         # Check device model.
@@ -93,6 +107,16 @@ class BlockDevice:
             if max_size > 0 and self.raw_info["size"] > max_size:
                 return False
 
+        # Check transport, e.g. nvme, sata or sas.
+        if "transports" in config:
+            if self.raw_info.get("tran") not in config["transports"]:
+                return False
+
+        # Check rotational flag.
+        if "rotational" in config:
+            if self.rotational != bool(config["rotational"]):
+                return False
+
         return True
 
 
@@ -126,12 +150,14 @@ class Disk(BlockDevice):
 
         return False
 
-    @utils.udev_settle
-    def create_single_partition(self):
+    def write_single_partition(self):
         """
         Create a single GPT partition using sgdisk. Align the start of the
         partition at 4 MiB for the least likelihood of performance issues. Use
         the "Linux RAID" partition type to ensure auto assembly on boot.
+
+        Return the partition GUID. This method does not wait for udev, nor does
+        it rescan the device; see resolve_partitions.
         """
 
         # Calculate the starting sector corresponding to 4 MiB, as sgdisk only
@@ -152,12 +178,9 @@ class Disk(BlockDevice):
             partition_type=partition_type,
             partition_guid=partition_guid,
         )
+        topology.invalidate("sgdisk")
 
-        for child in self.children:
-            if child.partuuid == partition_guid:
-                return child
-
-        return None
+        return partition_guid
 
 
 class Partition(BlockDevice):
@@ -174,6 +197,98 @@ class MDRaid(BlockDevice):
         super().__init__(raw_info)
 
 
+class Crypt(BlockDevice):
+    device_type_prefix = "crypt"
+
+    def __init__(self, raw_info):
+        super().__init__(raw_info)
+
+
+class Topology:
+    """
+    Shared snapshot of the block device topology, keyed by device path.
+
+    The snapshot is taken with a single scan, and reused until it is
+    explicitly invalidated, which must be done after every operation that
+    changes devices (sgdisk, mdadm, mkfs, etc). Each invalidation bumps the
+    generation counter. The scan counter counts every scan performed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._devices_raw = None
+            self._by_path = {}
+            self.generation = 0
+            self.scan_count = 0
+
+    def invalidate(self, reason):
+        with self._lock:
+            self._devices_raw = None
+            self._by_path = {}
+            self.generation += 1
+
+        logger.debug(
+            "device topology invalidated",
+            extra={"reason": reason, "generation": self.generation},
+        )
+
+    def _scan(self, device_path=None):
+        self.scan_count += 1
+        return scan_devices_raw(device_path)
+
+    def _refresh(self):
+        self._devices_raw = self._scan()
+        self._by_path = {}
+        for raw_info in walk_raw(self._devices_raw):
+            self._by_path.setdefault(raw_info["path"], raw_info)
+
+    def refresh(self):
+        """
+        Take a new snapshot, and return the raw info of top-level devices.
+        """
+
+        with self._lock:
+            self._refresh()
+            return self._devices_raw
+
+    def devices_raw(self):
+        """
+        Return the raw info of top-level devices, scanning only if needed.
+        """
+
+        with self._lock:
+            if self._devices_raw is None:
+                self._refresh()
+            return self._devices_raw
+
+    def lookup(self, device_path):
+        """
+        Return the raw info for the given device path, scanning only if the
+        snapshot was invalidated, or if the device is not part of it.
+        """
+
+        with self._lock:
+            if self._devices_raw is None:
+                self._refresh()
+
+            for path in (device_path, os.path.realpath(device_path)):
+                if path in self._by_path:
+                    return self._by_path[path]
+
+            # Not part of the snapshot, for example a device node symlink
+            # that cannot be resolved here; scan the device directly.
+            raw_info = self._scan(device_path)[0]
+            self._by_path[device_path] = raw_info
+            return raw_info
+
+
+topology = Topology()
+
+
 def get_lsblk_output(device_path=None):
     """
     Run lsblk and return its standard output.
@@ -193,21 +308,62 @@ def get_lsblk_output(device_path=None):
     return stdout
 
 
+def configure_scanner(name):
+    """
+    Select the device scanner backend: "lsblk" (default) or "sysfs".
+    """
+
+    global scanner
+
+    if name not in ("lsblk", "sysfs"):
+        raise ValueError(f"unknown scanner: {name}")
+
+    scanner = name
+
+
 def scan_devices_raw(device_path=None):
     """
-    Return JSON-decoded lsblk output.
+    Return raw device info, as JSON-decoded lsblk output. With the sysfs
+    scanner, the same structure is built from sysfs and the udev database,
+    falling back to lsblk if that fails.
     """
 
+    if scanner == "sysfs":
+        try:
+            return sysfs.scan_devices_raw(BlockDevice._registry, device_path)
+        except OSError as e:
+            logger.warning(
+                "sysfs scan failed; falling back to lsblk",
+                extra={"path": device_path, "exception": e},
+            )
+
     return json.loads(get_lsblk_output(device_path))["blockdevices"]
 
 
+def walk_raw(devices_raw):
+    """
+    Yield the given raw device info dicts and all their descendants.
+    """
+
+    for raw_info in devices_raw:
+        yield raw_info
+        yield from walk_raw(raw_info.get("children", []))
+
+
 def scan_devices(device_path=None):
     """
-    Scan for block devices and return a list of BlockDevice objects.
+    Scan for block devices and return a list of BlockDevice objects. A full
+    scan always takes a new topology snapshot, while scanning a single device
+    uses the current snapshot if it is still valid.
     """
 
+    if device_path is None:
+        devices_raw = topology.refresh()
+    else:
+        devices_raw = [topology.lookup(device_path)]
+
     devices = []
-    for raw_info in scan_devices_raw(device_path):
+    for raw_info in devices_raw:
         try:
             block_device = BlockDevice(raw_info)
         except BlockDevice.Unknown:
@@ -218,33 +374,134 @@ def scan_devices(device_path=None):
     return devices
 
 
-@utils.udev_settle
+class PartitionError(RuntimeError):
+    """
+    Raised when one or more disks could not be partitioned. The errors
+    attribute maps each failed disk path to its exception.
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__(
+            "failed to partition disks: "
+            + "; ".join(f"{path}: {e}" for path, e in errors.items())
+        )
+
+
+def partuuid_node(partition_guid):
+    """
+    Return the udev symlink path for the given partition GUID.
+    """
+
+    return f"/dev/disk/by-partuuid/{partition_guid}"
+
+
+def resolve_partitions(disks, partition_guids):
+    """
+    Given a dict of disk path to new partition GUID, wait once for all the new
+    partition nodes, and resolve the new partitions from a single scan. Return
+    a list of Partition objects, in the order of disks.
+    """
+
+    readiness.wait_for_nodes([partuuid_node(guid) for guid in partition_guids.values()])
+
+    partitions_raw = {}
+    for raw_info in walk_raw(topology.devices_raw()):
+        if raw_info.get("partuuid"):
+            partitions_raw[raw_info["partuuid"].lower()] = raw_info
+
+    partitions = []
+    errors = {}
+    for disk in disks:
+        raw_info = partitions_raw.get(partition_guids[disk.path])
+        if raw_info is None:
+            errors[disk.path] = RuntimeError(
+                f"partition {partition_guids[disk.path]} not found"
+            )
+            continue
+
+        partitions.append(BlockDevice(raw_info))
+
+    if errors:
+        raise PartitionError(errors)
+
+    return partitions
+
+
 def create_mdraid(member_devices, config):
     """
     Create an MD RAID device using the supplied config.
     """
 
     md_name = config.get("name", "ephemeral")
+    level = config.get("level", 0)
     argv = [
         "mdadm",
         "--create",
         md_name,
         "--homehost=any",
-        f"""--level={str(config.get("level", 0))}""",
+        f"""--level={str(level)}""",
     ]
 
     member_count = len(member_devices)
+    if member_count < geometry.min_members(level):
+        raise ValueError(
+            f"RAID level {level} needs at least {geometry.min_members(level)} "
+            f"members, found {member_count}"
+        )
+
     if member_count == 1:
         argv.append("--force")
 
+    if geometry.has_chunks(level):
+        chunk = config.get("chunk", "auto")
+        if chunk == "auto":
+            chunk_size = geometry.choose_chunk_size(
+                [member.raw_info for member in member_devices], level
+            )
+        else:
+            chunk_size = utils.to_bytes(chunk)
+
+        logger.info(
+            "md chunk size",
+            extra={
+                "chunk_size": chunk_size,
+                "auto": chunk == "auto",
+                "data_disks": geometry.data_disk_count(level, member_count),
+            },
+        )
+        argv.append(f"--chunk={chunk_size // 1024}K")
+
+    if geometry.is_redundant(level):
+        resync = config.get("resync", "default")
+        if resync not in ("default", "assume-clean", "throttled"):
+            raise ValueError(f"unknown resync mode: {resync}")
+
+        # Only safe if the members read back as zeros (like new instance store
+        # disks, or after a full discard), which is consistent for mirrors and
+        # parity alike. Otherwise, the initial resync is what makes it so.
+        if resync == "assume-clean":
+            argv.append("--assume-clean")
+
+        bitmap = config.get("bitmap")
+        if bitmap:
+            argv.append(f"--bitmap={bitmap}")
+
+        bitmap_chunk = config.get("bitmap_chunk")
+        if bitmap_chunk:
+            argv.append(f"--bitmap-chunk={utils.to_bytes(bitmap_chunk) // 1024}K")
+
     argv.append(f"--raid-devices={member_count}")
 
     for member in member_devices:
         argv.append(member.path)
 
-    execute.simple(argv)
+    # Members may briefly be held open by udev after partitioning.
+    execute.run_sync(argv, retry=execute.Retry())
+    topology.invalidate("mdadm")
 
     device_path = f"/dev/md/{md_name}"
+    readiness.wait_for_nodes([device_path])
     if not stat.S_ISBLK(os.stat(device_path).st_mode):
         raise RuntimeError(f"not a block device: {device_path}")
 
@@ -1,5 +1,11 @@
 import logging
 import subprocess
+import time
+
+from ephemeral_storage_setup import lazy, report
+
+# By far the most expensive import, and not needed by every run.
+asyncio = lazy.module("asyncio")
 
 logger = logging.getLogger(__name__)
 
@@ -8,18 +14,71 @@ class NonZeroExitException(Exception):
     pass
 
 
-def popen(argv):
+class TimeoutException(Exception):
+    pass
+
+
+class Retry:
+    """
+    Retry policy for transient failures: retry a command that exits non-zero
+    with stderr matching one of the patterns, with exponential backoff.
+    """
+
+    def __init__(
+        self,
+        attempts=3,
+        delay=0.5,
+        backoff=2.0,
+        patterns=("Device or resource busy",),
+    ):
+        self.attempts = attempts
+        self.delay = delay
+        self.backoff = backoff
+        self.patterns = patterns
+
+    def should_retry(self, attempt, stderr):
+        if attempt >= self.attempts:
+            return False
+
+        return any(pattern in stderr for pattern in self.patterns)
+
+    def delay_for(self, attempt):
+        return self.delay * self.backoff ** (attempt - 1)
+
+
+def popen(argv, stdin=None):
     return subprocess.Popen(
         argv,
+        stdin=stdin,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
     )
 
 
-def simple(argv, timeout=30.0, encoding="utf-8"):
+def record(argv, rc, start):
+    """
+    Record the subprocess timing in the run report, and log it.
+    """
+
+    entry = report.current.record_command(argv, rc, time.monotonic() - start)
+    logger.info("subprocess finished", extra=entry)
+
+
+def simple(argv, timeout=30.0, encoding="utf-8", input=None):
+    """
+    Run the command, and return (stdout, stderr). The optional input is
+    written to its stdin; unlike argv, it's never logged or recorded, which
+    makes it the way to pass secrets.
+    """
+
+    start = time.monotonic()
     try:
-        p = popen(argv)
+        if input is None:
+            p = popen(argv)
+        else:
+            p = popen(argv, stdin=subprocess.PIPE)
     except Exception as e:
+        record(argv, None, start)
         logger.error(
             "error starting subprocess",
             extra={
@@ -30,7 +89,9 @@ def simple(argv, timeout=30.0, encoding="utf-8"):
         raise
 
     try:
-        stdout, stderr = p.communicate(timeout=timeout)
+        stdout, stderr = p.communicate(
+            input=None if input is None else input.encode(encoding), timeout=timeout
+        )
     except subprocess.TimeoutExpired:
         logger.error(
             "subprocess timed out",
@@ -39,6 +100,8 @@ def simple(argv, timeout=30.0, encoding="utf-8"):
         p.kill()
         stdout, stderr = p.communicate()
 
+    record(argv, p.returncode, start)
+
     if p.returncode != 0:
         logger.error(
             "subprocess returned non-zero exit code",
@@ -52,3 +115,139 @@ def simple(argv, timeout=30.0, encoding="utf-8"):
         raise NonZeroExitException(f"return code: {p.returncode}")
 
     return stdout.decode(encoding).strip(), stderr.decode(encoding).strip()
+
+
+async def create_process(argv):
+    return await asyncio.create_subprocess_exec(
+        *argv,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+
+
+async def stream_lines(stream, name, argv, lines, encoding):
+    """
+    Read the stream line by line, logging each line as it arrives.
+    """
+
+    while True:
+        line = await stream.readline()
+        if not line:
+            return
+
+        line = line.decode(encoding, errors="replace").rstrip("\n")
+        lines.append(line)
+        logger.info("subprocess output", extra={"argv": argv, name: line})
+
+
+async def run_once(argv, timeout, encoding):
+    """
+    Run the command once, and return (rc, stdout, stderr). Raise
+    TimeoutException if the command doesn't finish before the timeout.
+    """
+
+    start = time.monotonic()
+    try:
+        p = await create_process(argv)
+    except Exception as e:
+        record(argv, None, start)
+        logger.error(
+            "error starting subprocess",
+            extra={
+                "argv": argv,
+                "exception": e,
+            },
+        )
+        raise
+
+    stdout, stderr = [], []
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(
+                stream_lines(p.stdout, "stdout", argv, stdout, encoding),
+                stream_lines(p.stderr, "stderr", argv, stderr, encoding),
+                p.wait(),
+            ),
+            timeout,
+        )
+    except asyncio.TimeoutError:
+        p.kill()
+        await p.wait()
+        record(argv, p.returncode, start)
+        logger.error(
+            "subprocess timed out",
+            extra={"argv": argv, "timeout": timeout},
+        )
+        raise TimeoutException(f"timed out after {timeout} seconds: {argv[0]}")
+
+    record(argv, p.returncode, start)
+    return p.returncode, "\n".join(stdout).strip(), "\n".join(stderr).strip()
+
+
+async def run(argv, timeout=30.0, retry=None, encoding="utf-8"):
+    """
+    Run the command asynchronously, streaming its output line by line into
+    the log, and return (stdout, stderr). The timeout applies per attempt.
+    Failures are retried according to the optional Retry policy.
+    """
+
+    attempt = 0
+    while True:
+        attempt += 1
+        rc, stdout, stderr = await run_once(argv, timeout, encoding)
+        if rc == 0:
+            return stdout, stderr
+
+        if retry is not None and retry.should_retry(attempt, stderr):
+            delay = retry.delay_for(attempt)
+            logger.warning(
+                "subprocess failed; retrying",
+                extra={"argv": argv, "rc": rc, "attempt": attempt, "delay": delay},
+            )
+            await asyncio.sleep(delay)
+            continue
+
+        logger.error(
+            "subprocess returned non-zero exit code",
+            extra={
+                "argv": argv,
+                "rc": rc,
+                "stdout": stdout,
+                "stderr": stderr,
+                "attempts": attempt,
+            },
+        )
+        raise NonZeroExitException(f"return code: {rc}")
+
+
+async def run_all(commands, **kwargs):
+    """
+    Run the commands (a list of argv) concurrently, and return their
+    (stdout, stderr) in order. All commands run to completion; the first
+    failure is then raised.
+    """
+
+    results = await asyncio.gather(
+        *(run(argv, **kwargs) for argv in commands), return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+    return results
+
+
+def run_sync(argv, **kwargs):
+    """
+    Run a single command with the async engine, from synchronous code.
+    """
+
+    return asyncio.run(run(argv, **kwargs))
+
+
+def run_all_sync(commands, **kwargs):
+    """
+    Run the commands concurrently with the async engine, from synchronous code.
+    """
+
+    return asyncio.run(run_all(commands, **kwargs))
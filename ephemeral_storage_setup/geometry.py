@@ -0,0 +1,192 @@
+"""
+RAID and filesystem geometry: choose the md chunk size from the geometry of the
+member devices, and derive filesystem stripe options that match the array.
+"""
+
+import logging
+
+logger = logging.getLogger()
+
+# mdadm's own default chunk size.
+DEFAULT_CHUNK_SIZE = 512 * 1024
+
+# Bounds for automatically chosen chunk sizes.
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 4 * 1024**2
+
+# Full stripe size (chunk size times data disks) that automatically chosen
+# chunk sizes stay within, so that large writes still span full stripes on
+# wide arrays.
+MAX_STRIPE_SIZE = 4 * 1024**2
+
+# Default ext4 block size for filesystems of the sizes we deal with.
+DEFAULT_BLOCK_SIZE = 4096
+
+# md stripe cache bounds, in entries (the kernel default is 256), and the share
+# of memory an automatically sized stripe cache may use.
+MIN_STRIPE_CACHE_SIZE = 256
+MAX_STRIPE_CACHE_SIZE = 32768
+STRIPE_CACHE_MEMORY_FRACTION = 1 / 64
+
+# Each stripe cache entry holds one page per member device.
+STRIPE_CACHE_PAGE_SIZE = 4096
+
+# Minimum number of members per RAID level.
+MIN_MEMBERS = {"0": 1, "linear": 1, "1": 2, "10": 2, "4": 3, "5": 3, "6": 4}
+
+
+def normalize_level(level):
+    """
+    Return the RAID level as a string without the "raid" prefix, e.g. "10".
+    """
+
+    return str(level).lower().replace("raid", "")
+
+
+def data_disk_count(level, member_count):
+    """
+    Return the number of data-bearing disks in a stripe, for the given RAID
+    level and member count.
+    """
+
+    level = normalize_level(level)
+    if level in ("0", "linear"):
+        return member_count
+    if level == "1":
+        return 1
+    if level == "10":
+        # Default "near 2" layout: every chunk is stored twice.
+        return max(1, member_count // 2)
+    if level in ("4", "5"):
+        return max(1, member_count - 1)
+    if level == "6":
+        return max(1, member_count - 2)
+
+    raise ValueError(f"unsupported RAID level: {level}")
+
+
+def is_redundant(level):
+    """
+    Return True if the given RAID level survives a member failure, and thus
+    needs an initial resync.
+    """
+
+    return normalize_level(level) in ("1", "10", "4", "5", "6")
+
+
+def has_parity(level):
+    """
+    Return True if the given RAID level uses parity, and thus a stripe cache.
+    """
+
+    return normalize_level(level) in ("4", "5", "6")
+
+
+def min_members(level):
+    level = normalize_level(level)
+    if level not in MIN_MEMBERS:
+        raise ValueError(f"unsupported RAID level: {level}")
+
+    return MIN_MEMBERS[level]
+
+
+def stripe_cache_size(member_count, memory_bytes):
+    """
+    Return the md stripe cache size, in entries, for a parity array: as large
+    as possible, up to the kernel maximum, while using no more than a small
+    share of memory. Each entry takes one page per member.
+    """
+
+    budget = int(memory_bytes * STRIPE_CACHE_MEMORY_FRACTION)
+    entries = budget // (STRIPE_CACHE_PAGE_SIZE * max(1, member_count))
+    if entries < MIN_STRIPE_CACHE_SIZE:
+        return MIN_STRIPE_CACHE_SIZE
+
+    return min(1 << (entries.bit_length() - 1), MAX_STRIPE_CACHE_SIZE)
+
+
+def has_chunks(level):
+    """
+    Return True if the given RAID level stripes data in chunks.
+    """
+
+    return normalize_level(level) != "1"
+
+
+def next_power_of_two(value):
+    return 1 << (value - 1).bit_length()
+
+
+def previous_power_of_two(value):
+    return 1 << (value.bit_length() - 1)
+
+
+def choose_chunk_size(members_raw, level=0):
+    """
+    Choose the md chunk size from member geometry (lsblk `phy-sec`, `min-io`
+    and `opt-io`) and the number of data disks at the given RAID level.
+
+    Start from mdadm's default, smaller if needed to keep the full stripe
+    within MAX_STRIPE_SIZE. Members reporting a larger optimal I/O size get
+    that instead, and the chunk is never smaller than their minimum I/O size
+    or physical sector, so that chunks stay aligned to the members.
+    """
+
+    def largest(field, default):
+        return max(
+            (raw_info.get(field) or default for raw_info in members_raw),
+            default=default,
+        )
+
+    opt_io = largest("opt-io", 0)
+    min_io = largest("min-io", 512)
+    phy_sec = largest("phy-sec", 512)
+    data_disks = data_disk_count(level, max(1, len(members_raw)))
+
+    chunk_size = min(
+        DEFAULT_CHUNK_SIZE, previous_power_of_two(MAX_STRIPE_SIZE // data_disks)
+    )
+    if opt_io > chunk_size:
+        chunk_size = min(next_power_of_two(opt_io), MAX_CHUNK_SIZE)
+
+    return max(
+        chunk_size,
+        MIN_CHUNK_SIZE,
+        next_power_of_two(min_io),
+        next_power_of_two(phy_sec),
+    )
+
+
+def device_stripe(raw_info):
+    """
+    Return the (chunk size, full stripe size) in bytes, as reported by the
+    kernel for an md device (lsblk `min-io` and `opt-io`), or None if the
+    device doesn't report a stripe.
+    """
+
+    chunk_size = raw_info.get("min-io") or 0
+    stripe_size = raw_info.get("opt-io") or 0
+    if chunk_size < DEFAULT_BLOCK_SIZE or stripe_size < chunk_size:
+        return None
+
+    return chunk_size, stripe_size
+
+
+def ext4_stripe(stripe, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Return the ext4 (stride, stripe_width), in filesystem blocks, for the
+    given (chunk size, full stripe size) in bytes.
+    """
+
+    chunk_size, stripe_size = stripe
+    return chunk_size // block_size, stripe_size // block_size
+
+
+def xfs_stripe(stripe):
+    """
+    Return the XFS (su, sw), i.e. the stripe unit in bytes and the stripe
+    width in stripe units, for the given (chunk size, full stripe size).
+    """
+
+    chunk_size, stripe_size = stripe
+    return chunk_size, stripe_size // chunk_size
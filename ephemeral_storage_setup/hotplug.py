@@ -0,0 +1,220 @@
+"""
+Wait for late-attaching disks, like NVMe devices that show up a few seconds
+after boot, or volumes attached while the instance starts. The disks are
+scanned again on every block device uevent, instead of sleeping and retrying.
+"""
+
+import errno
+import logging
+import os
+import select
+import socket
+import struct
+import time
+
+from ephemeral_storage_setup import readiness, utils
+
+logger = logging.getLogger()
+
+# netlink(7) uevent protocol, and its multicast groups: raw kernel events, and
+# events re-broadcast by udev after processing them.
+NETLINK_KOBJECT_UEVENT = 15
+KERNEL_GROUP = 1
+UDEV_GROUP = 2
+
+# Exists while udev is running.
+UDEV_CONTROL_PATH = "/run/udev/control"
+
+# Messages from udev start with this header, followed by the offset of the
+# properties at byte 16. Only the magic and filter hashes are big-endian; the
+# sizes and offsets are in host byte order.
+UDEV_HEADER_PREFIX = b"libudev\0"
+UDEV_PROPERTIES_OFFSET = struct.Struct("=I")
+
+# Scan again at least this often, in case an event was missed.
+RECHECK_INTERVAL = 5.0
+
+# Scan interval without any event source.
+POLL_INTERVAL = 1.0
+
+
+def is_block_event(data):
+    """
+    Return True if the uevent message is about a block device.
+    """
+
+    if data.startswith(UDEV_HEADER_PREFIX):
+        (offset,) = UDEV_PROPERTIES_OFFSET.unpack_from(data, 16)
+        data = data[offset:]
+
+    return b"SUBSYSTEM=block" in data.split(b"\0")
+
+
+class UeventMonitor:
+    """
+    Block device uevents over netlink. With udev running, listen for events
+    re-broadcast by udev, so that device nodes and the udev database are
+    ready by the time the disks are scanned again. Otherwise, listen for
+    kernel events.
+    """
+
+    def __init__(self):
+        group = UDEV_GROUP if os.path.exists(UDEV_CONTROL_PATH) else KERNEL_GROUP
+        self.sock = socket.socket(
+            socket.AF_NETLINK,
+            socket.SOCK_DGRAM | socket.SOCK_NONBLOCK | socket.SOCK_CLOEXEC,
+            NETLINK_KOBJECT_UEVENT,
+        )
+        try:
+            self.sock.bind((0, group))
+        except OSError:
+            self.sock.close()
+            raise
+
+    def wait(self, timeout):
+        """
+        Wait for events, and return True if any were about block devices.
+        """
+
+        poller = select.poll()
+        poller.register(self.sock.fileno(), select.POLLIN)
+        if not poller.poll(timeout * 1000):
+            return False
+
+        block = False
+        try:
+            while True:
+                if is_block_event(self.sock.recv(65536)):
+                    block = True
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            if e.errno != errno.ENOBUFS:
+                raise
+            # The receive buffer overflowed, and events were lost.
+            block = True
+
+        return block
+
+    def close(self):
+        self.sock.close()
+
+
+class DevInotify(readiness.Inotify):
+    """
+    Fallback event source: new entries in /dev.
+    """
+
+    def __init__(self):
+        super().__init__()
+        try:
+            self.watch("/dev")
+        except OSError:
+            self.close()
+            raise
+
+
+def open_events():
+    """
+    Return the best available event source, or None if there is none, and the
+    disks must be polled.
+    """
+
+    for source in (UeventMonitor, DevInotify):
+        try:
+            return source()
+        except (OSError, AttributeError) as e:
+            logger.debug(
+                "event source not available",
+                extra={"source": source.__name__, "exception": e},
+            )
+
+    return None
+
+
+def satisfied(disks, config):
+    """
+    Return True if the disks meet the expectations of a `wait` config section:
+    a minimum number of disks, and a minimum total size.
+    """
+
+    if config is None:
+        return True
+
+    if len(disks) < config.get("disks", 1):
+        return False
+
+    if "size" in config:
+        total = sum(disk.raw_info["size"] for disk in disks)
+        if total < utils.to_bytes(config["size"]):
+            return False
+
+    return True
+
+
+def next_event(events, until):
+    """
+    Wait for a block device event until the given monotonic time. Return True
+    if there was one.
+    """
+
+    while True:
+        remaining = until - time.monotonic()
+        if remaining <= 0:
+            return False
+        if events.wait(remaining):
+            return True
+
+
+def wait_for(check, timeout, settle=0.0):
+    """
+    Call check() until it returns (True, result), calling it again on every
+    block device event, until the timeout in seconds. Once satisfied, wait
+    until there have been no events for the settle window, for stragglers,
+    and check once more. Return the last (satisfied, result).
+    """
+
+    start = time.monotonic()
+    deadline = start + timeout
+
+    # Listen before the first check, to not miss any event in between.
+    events = open_events()
+    scans = 1
+    try:
+        ready, result = check()
+        while not ready and time.monotonic() < deadline:
+            if events is None:
+                time.sleep(min(deadline - time.monotonic(), POLL_INTERVAL))
+            else:
+                # Also check again every so often, in case an event was missed.
+                next_event(events, min(deadline, time.monotonic() + RECHECK_INTERVAL))
+
+            ready, result = check()
+            scans += 1
+
+        if ready and settle > 0:
+            if events is None:
+                time.sleep(max(0.0, min(settle, deadline - time.monotonic())))
+                changed = True
+            else:
+                changed = False
+                while next_event(events, min(deadline, time.monotonic() + settle)):
+                    changed = True
+
+            if changed:
+                ready, result = check()
+                scans += 1
+    finally:
+        if events is not None:
+            events.close()
+
+    logger.info(
+        "finished waiting for disks",
+        extra={
+            "ready": ready,
+            "scans": scans,
+            "elapsed": round(time.monotonic() - start, 6),
+            "events": type(events).__name__ if events is not None else None,
+        },
+    )
+    return ready, result
@@ -0,0 +1,28 @@
+"""
+Lazy module imports, to keep startup fast: the tool runs early in boot, and
+most runs (like the reboot fast path) only need a few of its subsystems.
+"""
+
+import importlib
+
+
+class LazyModule:
+    """
+    Stand-in for a module, which imports it on first attribute access.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+    def __repr__(self):
+        return f"<lazy module {self._name!r}>"
+
+
+def module(name):
+    return LazyModule(name)
@@ -0,0 +1,62 @@
+"""
+NUMA topology from sysfs: the online nodes, the CPUs of each node, and the node
+each disk is attached to, for building one array per node.
+"""
+
+import os.path
+
+NODE_DIR = "/sys/devices/system/node"
+
+SYSFS_BLOCK_DIR = "/sys/block"
+
+
+def parse_list(text):
+    """
+    Parse a kernel list format string, like "0-3,8,10-11", into a list of ints.
+    """
+
+    values = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        values.extend(range(int(first), int(last or first) + 1))
+
+    return values
+
+
+def online_nodes():
+    """
+    Return the online NUMA nodes, or just node 0 on kernels without NUMA.
+    """
+
+    try:
+        with open(os.path.join(NODE_DIR, "online"), "r") as f:
+            return parse_list(f.read())
+    except FileNotFoundError:
+        return [0]
+
+
+def cpulist(node):
+    """
+    Return the CPUs of the node in kernel list format, like "0-15,32-47",
+    as accepted by e.g. `taskset -c` and cpusets.
+    """
+
+    with open(os.path.join(NODE_DIR, f"node{node}", "cpulist"), "r") as f:
+        return f.read().strip()
+
+
+def device_node(kname):
+    """
+    Return the NUMA node the disk is attached to. Disks without a node (-1,
+    like on single-node hosts) count as node 0.
+    """
+
+    try:
+        with open(os.path.join(SYSFS_BLOCK_DIR, kname, "device", "numa_node")) as f:
+            node = int(f.read())
+    except FileNotFoundError:
+        return 0
+
+    return max(node, 0)
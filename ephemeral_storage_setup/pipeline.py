@@ -0,0 +1,175 @@
+"""
+Dependency graph of setup steps, and a scheduler that runs every step as soon as
+the steps it requires are done, with a bounded number of steps at a time.
+"""
+
+import concurrent.futures
+import logging
+
+from ephemeral_storage_setup import report
+
+logger = logging.getLogger()
+
+
+class StepError(RuntimeError):
+    """
+    Raised when one or more steps fail. The errors attribute maps each failed
+    step name to its exception.
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__(
+            "pipeline steps failed: "
+            + "; ".join(f"{name}: {e}" for name, e in errors.items())
+        )
+
+
+class Step:
+    def __init__(self, name, func, requires=(), group=None):
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+        self.group = group
+
+
+class Pipeline:
+    """
+    A dependency graph of steps. Each step's function is called with a dict
+    of the results of all steps finished so far, keyed by step name.
+
+    Steps can only require steps that were added before them, which keeps
+    the graph acyclic, and the insertion order a valid topological order.
+
+    Steps of the same group, like the partition steps of all disks, are
+    siblings: once one fails, the others still run, so that all their
+    failures are reported together.
+    """
+
+    def __init__(self):
+        self.steps = {}
+
+    def add(self, name, func, requires=(), group=None):
+        if name in self.steps:
+            raise ValueError(f"duplicate step: {name}")
+
+        for required in requires:
+            if required not in self.steps:
+                raise ValueError(f"step {name} requires unknown step: {required}")
+
+        self.steps[name] = Step(name, func, requires, group)
+
+    def run_step(self, step, results):
+        with report.phase(step.name, requires=list(step.requires)):
+            return step.func(results)
+
+    def run(self, max_workers=4):
+        """
+        Run all steps, and return their results. After a failure, no new
+        steps are started, other than siblings of a failed step; running steps
+        are allowed to finish, and all failures are then raised together as a
+        StepError.
+        """
+
+        results = {}
+        pending = list(self.steps)
+        running = {}
+        errors = {}
+        failed_groups = set()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while pending or running:
+                for name in list(pending):
+                    if len(running) >= max_workers:
+                        break
+
+                    step = self.steps[name]
+                    if errors and step.group not in failed_groups:
+                        continue
+
+                    if all(required in results for required in step.requires):
+                        pending.remove(name)
+                        future = executor.submit(self.run_step, step, dict(results))
+                        running[future] = name
+
+                if not running:
+                    break
+
+                finished, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        logger.error(
+                            "pipeline step failed",
+                            extra={"step": name, "exception": e},
+                        )
+                        errors[name] = e
+                        if self.steps[name].group is not None:
+                            failed_groups.add(self.steps[name].group)
+
+        if errors:
+            raise StepError(errors)
+
+        return results
+
+    def critical_path(self, durations):
+        """
+        Return (total duration, list of step names) of the longest path
+        through the graph, given a dict of step name to duration. Steps
+        without a known duration count as zero.
+        """
+
+        finish = {}
+        previous = {}
+        for name, step in self.steps.items():
+            start = 0.0
+            previous[name] = None
+            for required in step.requires:
+                if finish[required] > start:
+                    start = finish[required]
+                    previous[name] = required
+            finish[name] = start + durations.get(name, 0.0)
+
+        if not finish:
+            return 0.0, []
+
+        name = max(finish, key=finish.get)
+        total = finish[name]
+        path = []
+        while name is not None:
+            path.append(name)
+            name = previous[name]
+
+        return total, list(reversed(path))
+
+    def plan(self, last_report=None):
+        """
+        Return a human readable description of the graph, with step durations
+        and the critical path from the last run report, if any.
+        """
+
+        durations = {}
+        if last_report is not None:
+            for entry in last_report.get("phases", []):
+                durations[entry["phase"]] = entry["elapsed"]
+
+        total, path = self.critical_path(durations)
+
+        lines = []
+        for name, step in self.steps.items():
+            duration = f"{durations[name]:.3f}s" if name in durations else "unknown"
+            marker = "*" if name in path else " "
+            requires = ", ".join(step.requires) or "-"
+            lines.append(f"{marker} {name:<32} {duration:>10}  requires: {requires}")
+
+        lines.append("")
+        if durations:
+            lines.append(f"critical path ({total:.3f}s): {' -> '.join(path)}")
+        else:
+            lines.append("critical path: unknown (no previous run report)")
+
+        return "\n".join(lines)
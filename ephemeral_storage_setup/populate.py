@@ -0,0 +1,641 @@
+"""
+Populate the mount point from a directory skeleton, streaming file contents in
+kernel space, with bounded memory use regardless of the size of the tree.
+"""
+
+import concurrent.futures
+import errno
+import functools
+import grp
+import logging
+import os
+import os.path
+import pwd
+import shutil
+import stat
+import threading
+import time
+
+from ephemeral_storage_setup import execute
+
+logger = logging.getLogger()
+
+# Maximum number of bytes per copy_file_range/sendfile call.
+COPY_CHUNK_SIZE = 64 * 1024**2
+
+# Errors meaning "this copy method isn't supported here; try the next one".
+UNSUPPORTED_ERRNOS = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP)
+
+
+def copy_file_data(source_fd, target_fd, size):
+    """
+    Copy file contents in kernel space, using copy_file_range, falling back
+    to sendfile, and finally to a userspace copy.
+    """
+
+    offset = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            while offset < size:
+                copied = os.copy_file_range(
+                    source_fd, target_fd, min(COPY_CHUNK_SIZE, size - offset)
+                )
+                if copied == 0:
+                    return
+                offset += copied
+            return
+        except OSError as e:
+            if e.errno not in UNSUPPORTED_ERRNOS or offset > 0:
+                raise
+
+    try:
+        while offset < size:
+            copied = os.sendfile(
+                target_fd, source_fd, offset, min(COPY_CHUNK_SIZE, size - offset)
+            )
+            if copied == 0:
+                return
+            offset += copied
+        return
+    except OSError as e:
+        if e.errno not in UNSUPPORTED_ERRNOS or offset > 0:
+            raise
+
+    with open(source_fd, "rb", closefd=False) as source, open(
+        target_fd, "wb", closefd=False
+    ) as target:
+        shutil.copyfileobj(source, target)
+
+
+def copy_xattrs(source, target):
+    """
+    Copy extended attributes, without following symlinks. Filesystems without
+    xattr support are silently skipped.
+    """
+
+    try:
+        names = os.listxattr(source, follow_symlinks=False)
+    except OSError as e:
+        if e.errno in (errno.ENOTSUP, errno.ENODATA):
+            return
+        raise
+
+    for name in names:
+        try:
+            value = os.getxattr(source, name, follow_symlinks=False)
+            os.setxattr(target, name, value, follow_symlinks=False)
+        except OSError as e:
+            if e.errno not in (errno.ENOTSUP, errno.EPERM):
+                raise
+            logger.debug(
+                "skipped extended attribute",
+                extra={"path": target, "xattr": name, "exception": e},
+            )
+
+
+def copy_metadata(source, target, st):
+    """
+    Copy ownership, mode, extended attributes and timestamps. Symlinks are
+    never followed.
+    """
+
+    is_symlink = stat.S_ISLNK(st.st_mode)
+    try:
+        os.chown(target, st.st_uid, st.st_gid, follow_symlinks=False)
+    except PermissionError:
+        # Only root can give files away; keep going as a regular user.
+        pass
+
+    if not is_symlink:
+        os.chmod(target, stat.S_IMODE(st.st_mode))
+
+    copy_xattrs(source, target)
+
+    if not is_symlink or os.utime in os.supports_follow_symlinks:
+        os.utime(target, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+
+
+def copy_file(source, target, st):
+    """
+    Copy a regular file, including its metadata.
+    """
+
+    source_fd = os.open(source, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        target_fd = os.open(
+            target,
+            os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC,
+            0o600,
+        )
+        try:
+            copy_file_data(source_fd, target_fd, st.st_size)
+        finally:
+            os.close(target_fd)
+    finally:
+        os.close(source_fd)
+
+    copy_metadata(source, target, st)
+
+
+def create_file(path):
+    """
+    Create an empty file, for its contents to be written later by a worker.
+    """
+
+    os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_CLOEXEC, 0o600))
+
+
+class DirectoryMetadata:
+    """
+    Directory metadata, applied in post-order: as soon as nothing is pending
+    under a directory anymore, since creating entries in a directory changes
+    its timestamps. Each directory is pending until released once for being
+    opened, and once for each hold; releasing a directory for the last time
+    applies its metadata, and releases its parent.
+
+    Only unfinished directories are held, so memory use depends on the shape
+    of the tree, not on its size.
+    """
+
+    def __init__(self, apply):
+        self.apply = apply
+        self.lock = threading.Lock()
+        self.directories = {}
+
+    def open(self, path, parent=None, metadata=None):
+        """
+        Start tracking a directory, under the given (tracked) parent. The
+        metadata is passed to apply; directories without any are not touched.
+        """
+
+        with self.lock:
+            self.directories[path] = [1, parent, metadata]
+            if parent is not None:
+                self.directories[parent][0] += 1
+
+    def hold(self, path):
+        with self.lock:
+            self.directories[path][0] += 1
+
+    def release(self, path):
+        while path is not None:
+            with self.lock:
+                entry = self.directories[path]
+                entry[0] -= 1
+                if entry[0]:
+                    return
+                del self.directories[path]
+
+            _, parent, metadata = entry
+            if metadata is not None:
+                self.apply(path, metadata)
+            path = parent
+
+
+class TreeCopier:
+    """
+    Copy a directory tree, with file contents copied by a small pool of
+    worker threads. The number of queued files is bounded, and directory
+    metadata is applied as each directory is finished, so memory use does not
+    grow with the number of files.
+    """
+
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        self.slots = threading.BoundedSemaphore(max_workers * 4)
+        self.directories = DirectoryMetadata(self.apply_directory_metadata)
+        # Files with links not seen yet, by (device, inode), to recreate
+        # hardlinks: the first link's target path and the number of links left.
+        self.inodes = {}
+        self.errors = []
+        self.files = 0
+        self.bytes = 0
+
+    def apply_directory_metadata(self, path, metadata):
+        source_path, st = metadata
+        copy_metadata(source_path, path, st)
+
+    def submit(self, executor, directory, fn, *args):
+        """
+        Run fn(*args) on the worker pool, keeping the directory it writes to
+        pending until it's done.
+        """
+
+        self.slots.acquire()
+        self.directories.hold(directory)
+        try:
+            future = executor.submit(fn, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(functools.partial(self.done, directory))
+
+    def done(self, directory, future):
+        self.slots.release()
+        if future.exception() is not None:
+            self.errors.append(future.exception())
+            return
+
+        # Exceptions raised by done callbacks would only be logged.
+        try:
+            self.directories.release(directory)
+        except Exception as e:
+            self.errors.append(e)
+
+    def copy_regular_file(self, executor, source_path, target_path, target_dir, st):
+        if st.st_nlink > 1:
+            key = (st.st_dev, st.st_ino)
+            if key in self.inodes:
+                link_target, links = self.inodes[key]
+                # The first link was created right away, below.
+                os.link(link_target, target_path)
+                if links > 1:
+                    self.inodes[key] = (link_target, links - 1)
+                else:
+                    del self.inodes[key]
+                return
+
+            # Links from outside the tree are never seen, and kept until the
+            # end; there are usually few of those.
+            self.inodes[key] = (target_path, st.st_nlink - 1)
+            create_file(target_path)
+
+        self.files += 1
+        self.bytes += st.st_size
+        self.submit(executor, target_dir, copy_file, source_path, target_path, st)
+
+    def copy(self, source, target):
+        # The target directory's own metadata is left alone.
+        self.directories.open(target)
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_workers
+        ) as executor:
+            pending = [(source, target)]
+            while pending and not self.errors:
+                source_dir, target_dir = pending.pop()
+                with os.scandir(source_dir) as entries:
+                    for entry in entries:
+                        source_path = entry.path
+                        target_path = os.path.join(target_dir, entry.name)
+                        st = entry.stat(follow_symlinks=False)
+
+                        if stat.S_ISDIR(st.st_mode):
+                            os.makedirs(target_path, exist_ok=True)
+                            self.directories.open(
+                                target_path, target_dir, (source_path, st)
+                            )
+                            pending.append((source_path, target_path))
+
+                        elif stat.S_ISLNK(st.st_mode):
+                            os.symlink(os.readlink(source_path), target_path)
+                            copy_metadata(source_path, target_path, st)
+
+                        elif stat.S_ISREG(st.st_mode):
+                            self.copy_regular_file(
+                                executor, source_path, target_path, target_dir, st
+                            )
+
+                        else:
+                            # FIFOs, sockets and device nodes.
+                            os.mknod(target_path, st.st_mode, st.st_rdev)
+                            copy_metadata(source_path, target_path, st)
+
+                # All entries exist; what's left are file copies in progress.
+                self.directories.release(target_dir)
+
+        if self.errors:
+            raise self.errors[0]
+
+
+def copy_tree(source, target, max_workers=8):
+    """
+    Copy the contents of the source directory into the existing target
+    directory, preserving hardlinks, symlinks, ownership, modes, extended
+    attributes and timestamps. The target directory's own metadata is left
+    alone, as it is managed by the mount configuration.
+    """
+
+    start = time.monotonic()
+    copier = TreeCopier(max_workers=max_workers)
+    copier.copy(source, target)
+    elapsed = time.monotonic() - start
+
+    logger.info(
+        "copied directory tree",
+        extra={
+            "source": source,
+            "target": target,
+            "files": copier.files,
+            "bytes": copier.bytes,
+            "elapsed": round(elapsed, 6),
+        },
+    )
+
+
+# Archive magic numbers for compressors that tarfile doesn't handle.
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+LZ4_MAGIC = b"\x04\x22\x4d\x18"
+
+# External decompression programs, by compression, for GNU tar's
+# --use-compress-program. Other compressions are detected by tar itself.
+EXTERNAL_DECOMPRESSORS = {
+    "zstd": "zstd",
+    "lz4": "lz4",
+}
+
+# Regular files up to this size are read into memory and written by the worker
+# pool. Larger files are streamed to disk directly, to bound memory use.
+SMALL_FILE_SIZE = 1024**2
+
+
+def archive_compression(path):
+    """
+    Return "zstd" or "lz4" for archives with those compressions, or None for
+    anything else, which is left to tarfile (or tar) to detect.
+    """
+
+    with open(path, "rb") as f:
+        magic = f.read(4)
+
+    if magic == ZSTD_MAGIC:
+        return "zstd"
+    if magic == LZ4_MAGIC:
+        return "lz4"
+
+    return None
+
+
+def open_decompressed(path, compression):
+    """
+    Return a file object streaming the decompressed contents of the archive.
+    zstd and lz4 are optional dependencies: the `zstandard` and `lz4` packages.
+    """
+
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError(
+                "zstd archives need the zstandard package, or method: external"
+            )
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+
+    if compression == "lz4":
+        try:
+            import lz4.frame
+        except ImportError:
+            raise RuntimeError("lz4 archives need the lz4 package, or method: external")
+        return lz4.frame.open(path, "rb")
+
+    return open(path, "rb")
+
+
+def member_path(target, name):
+    """
+    Return the target path for the archive member, refusing members that
+    would end up outside the target directory.
+    """
+
+    path = os.path.normpath(os.path.join(target, name))
+    if path != target and not path.startswith(target.rstrip(os.sep) + os.sep):
+        raise ValueError(f"archive member outside target directory: {name}")
+
+    return path
+
+
+def member_owner(member):
+    """
+    Return the (uid, gid) for the archive member, preferring the user and
+    group names over the numeric IDs, like tar does.
+    """
+
+    uid, gid = member.uid, member.gid
+    try:
+        if member.uname:
+            uid = pwd.getpwnam(member.uname).pw_uid
+    except KeyError:
+        pass
+    try:
+        if member.gname:
+            gid = grp.getgrnam(member.gname).gr_gid
+    except KeyError:
+        pass
+
+    return uid, gid
+
+
+def apply_member_metadata(member, path):
+    """
+    Apply ownership, mode and modification time from the archive member.
+    """
+
+    try:
+        os.chown(path, *member_owner(member), follow_symlinks=False)
+    except PermissionError:
+        pass
+
+    if not member.issym():
+        os.chmod(path, member.mode)
+
+    os.utime(path, (member.mtime, member.mtime), follow_symlinks=False)
+
+
+def write_member(path, data, member):
+    with open(path, "wb") as f:
+        f.write(data)
+
+    apply_member_metadata(member, path)
+
+
+def is_within(path, directory):
+    return path == directory or path.startswith(directory.rstrip(os.sep) + os.sep)
+
+
+class ArchiveExtractor(TreeCopier):
+    """
+    Extract a tar archive as a stream, with small files written by a pool of
+    worker threads. Like with copies, directory metadata is applied as each
+    directory is finished.
+    """
+
+    def apply_directory_metadata(self, path, member):
+        apply_member_metadata(member, path)
+
+    def extract(self, fileobj, target):
+        import tarfile
+
+        target = os.path.abspath(target)
+        self.directories.open(target)
+        # Directory members that are ancestors of the current member. Archives
+        # list a directory's contents right after it, so a member outside a
+        # directory means the directory is finished, like in GNU tar.
+        open_directories = [target]
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_workers
+        ) as executor, tarfile.open(fileobj=fileobj, mode="r|*") as tar:
+            for member in tar:
+                if self.errors:
+                    break
+
+                path = member_path(target, member.name)
+                while not is_within(path, open_directories[-1]):
+                    self.directories.release(open_directories.pop())
+                parent = open_directories[-1]
+
+                if member.isdir():
+                    os.makedirs(path, exist_ok=True)
+                    if path != parent:
+                        self.directories.open(path, parent, member)
+                        open_directories.append(path)
+                    continue
+
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                if member.isreg():
+                    self.files += 1
+                    self.bytes += member.size
+                    source = tar.extractfile(member)
+                    if member.size <= SMALL_FILE_SIZE:
+                        # Created here, so that hardlinks to it can be made
+                        # before the worker is done.
+                        create_file(path)
+                        self.submit(
+                            executor, parent, write_member, path, source.read(), member
+                        )
+                    else:
+                        with open(path, "wb") as f:
+                            shutil.copyfileobj(source, f, COPY_CHUNK_SIZE)
+                        apply_member_metadata(member, path)
+
+                elif member.issym():
+                    os.symlink(member.linkname, path)
+                    apply_member_metadata(member, path)
+
+                elif member.islnk():
+                    os.link(member_path(target, member.linkname), path)
+
+                elif member.isfifo():
+                    os.mkfifo(path)
+                    apply_member_metadata(member, path)
+
+                elif member.isdev():
+                    mode = stat.S_IFCHR if member.ischr() else stat.S_IFBLK
+                    os.mknod(path, mode, os.makedev(member.devmajor, member.devminor))
+                    apply_member_metadata(member, path)
+
+            if not self.errors:
+                for path in reversed(open_directories):
+                    self.directories.release(path)
+
+        if self.errors:
+            raise self.errors[0]
+
+
+def extract_external(path, target, compression, timeout):
+    """
+    Extract the archive by running tar, with an external decompressor for
+    compressions that tar doesn't detect itself.
+    """
+
+    argv = ["tar", "--extract", "--preserve-permissions", "--same-owner"]
+    if compression in EXTERNAL_DECOMPRESSORS:
+        argv.append(f"--use-compress-program={EXTERNAL_DECOMPRESSORS[compression]}")
+    argv.extend(["--directory", target, "--file", path])
+
+    execute.simple(argv, timeout=timeout)
+
+
+def prefetch(path):
+    """
+    Ask the kernel to read the given file, or all regular files under the given
+    directory, into the page cache in the background, so that populating the
+    mount point later reads from memory. Best effort: errors are logged, but
+    not raised.
+    """
+
+    start = time.monotonic()
+    files = 0
+    total = 0
+
+    if os.path.isdir(path):
+        paths = (
+            os.path.join(dirpath, filename)
+            for dirpath, _, filenames in os.walk(path)
+            for filename in filenames
+        )
+    else:
+        paths = [path]
+
+    for file_path in paths:
+        try:
+            fd = os.open(file_path, os.O_RDONLY | os.O_NOFOLLOW)
+        except OSError as e:
+            # Symlinks (ELOOP), sockets, etc: nothing to prefetch.
+            logger.debug("not prefetching", extra={"path": file_path, "exception": e})
+            continue
+
+        try:
+            st = os.fstat(fd)
+            if stat.S_ISREG(st.st_mode):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+                files += 1
+                total += st.st_size
+        except OSError as e:
+            logger.warning(
+                "error prefetching", extra={"path": file_path, "exception": e}
+            )
+        finally:
+            os.close(fd)
+
+    logger.info(
+        "prefetched populate source",
+        extra={
+            "path": path,
+            "files": files,
+            "bytes": total,
+            "elapsed": round(time.monotonic() - start, 6),
+        },
+    )
+
+
+def extract_archive(path, target, max_workers=8, method="python", timeout=600.0):
+    """
+    Extract the archive at path into the target directory. The method is
+    either "python", streaming and extracting in-process, or "external",
+    running tar.
+    """
+
+    start = time.monotonic()
+    compression = archive_compression(path)
+
+    extractor = None
+    if method == "external":
+        extract_external(path, target, compression, timeout)
+    elif method == "python":
+        extractor = ArchiveExtractor(max_workers=max_workers)
+        with open_decompressed(path, compression) as fileobj:
+            extractor.extract(fileobj, target)
+    else:
+        raise ValueError(f"unknown archive extraction method: {method}")
+
+    elapsed = time.monotonic() - start
+    archive_size = os.path.getsize(path)
+    fields = {
+        "archive": path,
+        "target": target,
+        "method": method,
+        "compression": compression,
+        "archive_bytes": archive_size,
+        "archive_mbps": round(archive_size / elapsed / 1024**2, 1),
+        "elapsed": round(elapsed, 6),
+    }
+    if extractor is not None:
+        fields.update(
+            files=extractor.files,
+            bytes=extractor.bytes,
+            mbps=round(extractor.bytes / elapsed / 1024**2, 1),
+            files_per_second=round(extractor.files / elapsed, 1),
+        )
+
+    logger.info("extracted archive", extra=fields)
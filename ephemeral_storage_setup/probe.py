@@ -0,0 +1,140 @@
+"""
+Pre-flight latency probe: a short, bounded, read-only direct I/O test of each
+candidate disk, to keep slow or degraded disks out of the array, since a
+striped array runs at the speed of its slowest member.
+"""
+
+import concurrent.futures
+import logging
+import os
+import statistics
+
+from ephemeral_storage_setup import bench, report, utils
+
+logger = logging.getLogger()
+
+
+class ProbeFailed(RuntimeError):
+    pass
+
+
+def probe_disk(path, config):
+    """
+    Run random 4K direct reads against the disk, and return the result, as
+    returned by bench.run_job.
+    """
+
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECT)
+    try:
+        size = min(
+            os.lseek(fd, 0, os.SEEK_END),
+            utils.to_bytes(config.get("size", "1G")),
+        )
+        result = bench.run_job(
+            fd,
+            "probe",
+            4096,
+            True,
+            False,
+            config.get("threads", 4),
+            size,
+            float(config.get("runtime", 1)),
+        )
+    finally:
+        os.close(fd)
+
+    result["path"] = path
+    return result
+
+
+def probe_disks(paths, config):
+    """
+    Probe all disks concurrently. Return a dict of path to result, or to the
+    exception raised while probing.
+    """
+
+    results = {}
+    if not paths:
+        return results
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(paths)) as executor:
+        futures = {executor.submit(probe_disk, path, config): path for path in paths}
+        for future in concurrent.futures.as_completed(futures):
+            path = futures[future]
+            try:
+                results[path] = future.result()
+            except Exception as e:
+                logger.error("error probing disk", extra={"path": path, "exception": e})
+                results[path] = e
+
+    return results
+
+
+def outliers(results, config):
+    """
+    Return a dict of path to the reason the disk is out of tolerance. A disk
+    is out of tolerance if probing failed, if its p99 latency is more than
+    max_p99_ratio times the median p99 of the other disks, or over max_p99_us,
+    or if its IOPS are less than their median divided by max_p99_ratio. Each
+    disk is compared against the others only, so that a slow disk doesn't pull
+    up the median it's compared against, like with just two disks.
+    """
+
+    ratio = float(config.get("max_p99_ratio", 3.0))
+    max_p99_us = config.get("max_p99_us")
+
+    reasons = {}
+    measured = {}
+    for path, result in results.items():
+        if isinstance(result, Exception):
+            reasons[path] = f"probe failed: {result}"
+        else:
+            measured[path] = result
+
+    for path, result in measured.items():
+        others = [r for other, r in measured.items() if other != path]
+        if others:
+            median_p99 = statistics.median(r["lat_p99_us"] for r in others)
+            median_iops = statistics.median(r["iops"] for r in others)
+        else:
+            median_p99 = median_iops = None
+
+        if median_p99 is not None and result["lat_p99_us"] > median_p99 * ratio:
+            reasons[path] = (
+                f"p99 latency {result['lat_p99_us']}us > {ratio} x median "
+                f"{median_p99}us"
+            )
+        elif max_p99_us is not None and result["lat_p99_us"] > max_p99_us:
+            reasons[path] = f"p99 latency {result['lat_p99_us']}us > {max_p99_us}us"
+        elif median_iops is not None and result["iops"] < median_iops / ratio:
+            reasons[path] = (
+                f"{result['iops']} IOPS < median {median_iops} IOPS / {ratio}"
+            )
+
+    return reasons
+
+
+def check(disks, config):
+    """
+    Probe the disks, log and report the results, and return the disks within
+    tolerance. With `on_outlier: fail`, raise ProbeFailed instead if any disk
+    is out of tolerance.
+    """
+
+    results = probe_disks([disk.path for disk in disks], config)
+    for path, result in results.items():
+        if not isinstance(result, Exception):
+            logger.info("probe result", extra=result)
+            report.current.add_to_section("probe", path, result)
+
+    reasons = outliers(results, config)
+    for path, reason in reasons.items():
+        logger.warning("disk out of tolerance", extra={"path": path, "reason": reason})
+
+    if reasons and config.get("on_outlier", "exclude") == "fail":
+        raise ProbeFailed(
+            "disks out of tolerance: "
+            + "; ".join(f"{path}: {reason}" for path, reason in reasons.items())
+        )
+
+    return [disk for disk in disks if disk.path not in reasons]
@@ -0,0 +1,191 @@
+"""
+Wait for specific device nodes to become ready, like the udev symlinks in
+/dev/disk/by-partuuid, instead of waiting for the whole udev event queue to
+settle with `udevadm settle`.
+"""
+
+import logging
+import os
+import os.path
+import select
+import time
+
+from ephemeral_storage_setup import execute, lazy
+
+# Only needed when actually waiting for device nodes.
+ctypes = lazy.module("ctypes")
+ctypes_util = lazy.module("ctypes.util")
+
+logger = logging.getLogger()
+
+# inotify(7) constants.
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# Re-check the paths at least this often, in case an event was missed.
+RECHECK_INTERVAL = 0.5
+
+# Wait mode: "targeted" waits for the given device nodes, falling back to
+# `udevadm settle` on timeout; "settle" always runs `udevadm settle`.
+mode = "targeted"
+
+# Default deadline for targeted waits, in seconds.
+default_timeout = 10.0
+
+
+def configure(config):
+    """
+    Configure the wait mode and timeout from the `udev` config section.
+    """
+
+    global mode, default_timeout
+
+    mode = config.get("wait", "targeted")
+    if mode not in ("targeted", "settle"):
+        raise ValueError(f"unknown udev wait mode: {mode}")
+
+    default_timeout = float(config.get("timeout", 10.0))
+
+
+def settle():
+    """
+    Run `udevadm settle`, waiting for the whole udev event queue.
+    """
+
+    start = time.monotonic()
+    execute.simple(["udevadm", "settle"])
+    logger.debug(
+        "udev settled",
+        extra={"elapsed": round(time.monotonic() - start, 6)},
+    )
+
+
+class Inotify:
+    """
+    Minimal inotify wrapper, watching directories for new entries.
+    """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes_util.find_library("c"), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def watch(self, directory):
+        wd = self._add_watch(self.fd, os.fsencode(directory), IN_CREATE | IN_MOVED_TO)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed: {directory}")
+
+    def wait(self, timeout):
+        """
+        Wait for events, and discard them. The caller re-checks its paths.
+        Return True if there were any events.
+        """
+
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+        if not poller.poll(timeout * 1000):
+            return False
+
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+def nearest_existing_directory(path):
+    """
+    Return the nearest existing ancestor directory of the given path.
+    """
+
+    directory = os.path.dirname(path)
+    while not os.path.isdir(directory):
+        directory = os.path.dirname(directory)
+
+    return directory
+
+
+def wait_for_paths(paths, deadline):
+    """
+    Wait until all paths exist, or the deadline (monotonic time) passes.
+    Return the list of paths that are still missing.
+    """
+
+    missing = [path for path in paths if not os.path.exists(path)]
+    if not missing:
+        return missing
+
+    try:
+        inotify = Inotify()
+    except (OSError, AttributeError) as e:
+        logger.debug("inotify not available; polling", extra={"exception": e})
+        inotify = None
+
+    try:
+        while missing:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            interval = min(remaining, RECHECK_INTERVAL)
+            if inotify is None:
+                time.sleep(min(interval, 0.05))
+            else:
+                # Watch the nearest existing ancestor of each missing path, so
+                # that intermediate directories being created also wake us up.
+                for path in missing:
+                    inotify.watch(nearest_existing_directory(path))
+
+                # Check again after adding watches, to avoid a race.
+                missing = [path for path in missing if not os.path.exists(path)]
+                if not missing:
+                    break
+
+                inotify.wait(interval)
+
+            missing = [path for path in missing if not os.path.exists(path)]
+    finally:
+        if inotify is not None:
+            inotify.close()
+
+    return missing
+
+
+def wait_for_nodes(paths, timeout=None):
+    """
+    Wait for the given device nodes to appear. In "settle" mode, if no nodes
+    are given (because they are not known), or if they do not appear before
+    the deadline, fall back to `udevadm settle`.
+    """
+
+    paths = list(paths)
+    if mode == "settle" or not paths:
+        settle()
+        return
+
+    if timeout is None:
+        timeout = default_timeout
+
+    start = time.monotonic()
+    missing = wait_for_paths(paths, start + timeout)
+    elapsed = round(time.monotonic() - start, 6)
+
+    if missing:
+        logger.warning(
+            "device nodes did not appear in time; settling udev",
+            extra={"missing": missing, "timeout": timeout, "elapsed": elapsed},
+        )
+        settle()
+        return
+
+    logger.info("device nodes ready", extra={"paths": paths, "elapsed": elapsed})
@@ -0,0 +1,201 @@
+"""
+Timing instrumentation for pipeline phases and subprocesses, and the
+machine-readable run report built from it.
+"""
+
+import contextlib
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+from ephemeral_storage_setup import lazy
+
+utils = lazy.module("ephemeral_storage_setup.utils")
+
+logger = logging.getLogger()
+
+DEFAULT_REPORT_PATH = "/run/ephemeral-storage-setup/report.json"
+
+METRIC_PREFIX = "ephemeral_storage_setup"
+
+
+class Report:
+    """
+    Collects phase and subprocess timings for a single run.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self.started_at = datetime.now(timezone.utc).isoformat()
+        self.status = "running"
+        self.elapsed = None
+        self.phases = []
+        self.commands = []
+        self.sections = {}
+
+    @contextlib.contextmanager
+    def phase(self, name, **fields):
+        """
+        Time the wrapped block as a named phase, and log the result.
+        """
+
+        start = time.monotonic()
+        status = "ok"
+        try:
+            yield
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            entry = dict(
+                fields,
+                phase=name,
+                status=status,
+                start=round(start - self._start, 6),
+                elapsed=round(time.monotonic() - start, 6),
+            )
+            with self._lock:
+                self.phases.append(entry)
+            logger.info("phase finished", extra=entry)
+
+    def record_command(self, argv, rc, elapsed):
+        entry = {"argv": list(argv), "rc": rc, "elapsed": round(elapsed, 6)}
+        with self._lock:
+            self.commands.append(entry)
+        return entry
+
+    def add_section(self, name, value):
+        """
+        Add an extra named section to the report.
+        """
+
+        with self._lock:
+            self.sections[name] = value
+
+    def add_to_section(self, name, key, value):
+        """
+        Add a keyed entry to a named report section, e.g. one per array.
+        """
+
+        with self._lock:
+            self.sections.setdefault(name, {})[key] = value
+
+    def finish(self, status):
+        self.status = status
+        self.elapsed = round(time.monotonic() - self._start, 6)
+
+    def to_dict(self):
+        with self._lock:
+            return dict(
+                self.sections,
+                started_at=self.started_at,
+                status=self.status,
+                elapsed=self.elapsed,
+                phases=list(self.phases),
+                commands=list(self.commands),
+            )
+
+    def write(self, path):
+        utils.write_atomically(path, json.dumps(self.to_dict(), indent=2) + "\n")
+        logger.info("wrote run report", extra={"path": path})
+
+    def prometheus_metrics(self):
+        """
+        Return the report as Prometheus text exposition format.
+        """
+
+        lines = [
+            f"# HELP {METRIC_PREFIX}_run_duration_seconds Duration of the last run.",
+            f"# TYPE {METRIC_PREFIX}_run_duration_seconds gauge",
+            f"{METRIC_PREFIX}_run_duration_seconds {self.elapsed or 0}",
+            f"# HELP {METRIC_PREFIX}_run_success Whether the last run succeeded.",
+            f"# TYPE {METRIC_PREFIX}_run_success gauge",
+            f"{METRIC_PREFIX}_run_success {int(self.status == 'ok')}",
+            f"# HELP {METRIC_PREFIX}_commands_total Subprocesses run by the last run.",
+            f"# TYPE {METRIC_PREFIX}_commands_total gauge",
+            f"{METRIC_PREFIX}_commands_total {len(self.commands)}",
+            f"# HELP {METRIC_PREFIX}_phase_duration_seconds Duration of each phase.",
+            f"# TYPE {METRIC_PREFIX}_phase_duration_seconds gauge",
+        ]
+        # One series per phase and pool: phases run once per pool, and
+        # duplicate series make the whole file invalid. Phases repeated within
+        # a pool are summed.
+        durations = {}
+        for entry in self.phases:
+            key = (entry["phase"], entry.get("pool"))
+            durations[key] = durations.get(key, 0) + entry["elapsed"]
+
+        for (name, pool), elapsed in durations.items():
+            labels = f'phase="{label_value(name)}"'
+            if pool is not None:
+                labels += f',pool="{label_value(pool)}"'
+            lines.append(
+                f"{METRIC_PREFIX}_phase_duration_seconds{{{labels}}} {round(elapsed, 6)}"
+            )
+
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        utils.write_atomically(path, self.prometheus_metrics())
+        logger.info("wrote prometheus metrics", extra={"path": path})
+
+
+def label_value(value):
+    """
+    Escape a Prometheus label value.
+    """
+
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def read(path=DEFAULT_REPORT_PATH):
+    """
+    Return a previously written report as a dict, or None if there is none.
+    """
+
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+# Report for the current run.
+current = Report()
+
+
+def reset():
+    """
+    Start a new report for a new run, and return it.
+    """
+
+    global current
+
+    current = Report()
+    return current
+
+
+def phase(name, **fields):
+    """
+    Time the wrapped block as a phase of the current run.
+    """
+
+    return current.phase(name, **fields)
+
+
+def write(config):
+    """
+    Write the current report, and optionally Prometheus metrics, according to
+    the `report` config section.
+    """
+
+    path = config.get("path", DEFAULT_REPORT_PATH)
+    if path:
+        current.write(path)
+
+    prometheus_path = config.get("prometheus_path")
+    if prometheus_path:
+        current.write_prometheus(prometheus_path)
@@ -0,0 +1,289 @@
+"""
+Fast path for reboots that preserve the ephemeral disks: reuse the array
+recorded by the last successful run, instead of scanning the disks, which are
+all initialized by then.
+"""
+
+import json
+import logging
+import os
+import os.path
+import uuid
+
+from ephemeral_storage_setup import (
+    devices,
+    execute,
+    geometry,
+    lazy,
+    readiness,
+    report,
+    sysfs,
+    tune,
+    utils,
+)
+
+cache = lazy.module("ephemeral_storage_setup.cache")
+
+logger = logging.getLogger()
+
+DEFAULT_STATE_PATH = "/var/lib/ephemeral-storage-setup/state.json"
+
+MDSTAT_PATH = "/proc/mdstat"
+
+MD_DEVICE_DIR = "/dev/md"
+
+SYSFS_BLOCK_DIR = "/sys/class/block"
+
+# ext4 superblock: at offset 1024, with the magic at 0x38 and the UUID at 0x68.
+EXT4_SUPERBLOCK_OFFSET = 1024
+EXT4_MAGIC = b"\x53\xef"
+
+# XFS superblock: at offset 0, with the UUID at 32.
+XFS_MAGIC = b"XFSB"
+
+
+class StateMismatch(RuntimeError):
+    pass
+
+
+def state_path(config):
+    return config.get("state", {}).get("path", DEFAULT_STATE_PATH)
+
+
+def save_state(config, md_name, fsuuid, member_partuuids):
+    """
+    Record an array and filesystem created by a successful run. The state file
+    holds one entry per array name.
+    """
+
+    path = state_path(config)
+    if not path:
+        return
+
+    state = load_state(path) or {"arrays": {}}
+    state["arrays"][md_name] = {
+        "fsuuid": fsuuid,
+        "members": list(member_partuuids),
+    }
+    utils.write_atomically(path, json.dumps(state, indent=2) + "\n")
+    logger.info(
+        "saved state",
+        extra=dict(state["arrays"][md_name], md_name=md_name, path=path),
+    )
+
+
+def load_state(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def read_mdstat(path=MDSTAT_PATH):
+    """
+    Return a dict of md kname to a dict with the array state ("active" or
+    "inactive"), RAID level, and member knames, parsed from /proc/mdstat.
+    """
+
+    arrays = {}
+    try:
+        with open(path, "r") as f:
+            lines = f.readlines()
+    except FileNotFoundError:
+        return arrays
+
+    for line in lines:
+        name, sep, rest = line.partition(" : ")
+        if not sep or not name.startswith("md"):
+            continue
+
+        fields = rest.split()
+        level = None
+        members = []
+        for field in fields[1:]:
+            if "[" in field:
+                members.append(field.split("[", 1)[0])
+            elif field.startswith("raid") or field == "linear":
+                level = field
+
+        arrays[name.strip()] = {
+            "state": fields[0] if fields else None,
+            "level": level,
+            "members": members,
+        }
+
+    return arrays
+
+
+def read_filesystem_uuid(device_path):
+    """
+    Return the UUID of the ext4 or XFS filesystem on the device, read from its
+    superblock, or None if neither is found.
+    """
+
+    with open(device_path, "rb") as f:
+        head = f.read(EXT4_SUPERBLOCK_OFFSET * 2)
+
+    ext4 = head[EXT4_SUPERBLOCK_OFFSET:]
+    if ext4[0x38:0x3A] == EXT4_MAGIC:
+        return str(uuid.UUID(bytes=ext4[0x68:0x78]))
+
+    if head[:4] == XFS_MAGIC:
+        return str(uuid.UUID(bytes=head[32:48]))
+
+    return None
+
+
+def mounted_device(mount_point):
+    """
+    Return the "major:minor" device number mounted at the mount point, or None.
+    """
+
+    for devno, path in sysfs.read_mountpoints("/").items():
+        if path == mount_point:
+            return devno
+
+    return None
+
+
+def assemble(md_path, member_paths):
+    execute.run_sync(
+        ["mdadm", "--assemble", md_path, *member_paths], retry=execute.Retry()
+    )
+    readiness.wait_for_nodes([md_path])
+    logger.info("assembled array", extra={"path": md_path, "members": member_paths})
+
+
+def reclaim(md_name, member_partuuids):
+    """
+    Release the disks of an array whose data can't be read anymore, so that a
+    full setup can use them again: stop the array if it was assembled, and
+    wipe the member partitions and the partition tables of their disks, all
+    members at once.
+    """
+
+    md_path = os.path.join(MD_DEVICE_DIR, md_name)
+    if os.path.exists(md_path):
+        execute.run_sync(["mdadm", "--stop", md_path], retry=execute.Retry())
+
+    members = []
+    for guid in member_partuuids:
+        node = devices.partuuid_node(guid)
+        if not os.path.exists(node):
+            continue
+
+        kname = os.path.basename(os.path.realpath(node))
+        disk_kname = os.path.basename(
+            os.path.dirname(os.path.realpath(os.path.join(SYSFS_BLOCK_DIR, kname)))
+        )
+        members.append((node, f"/dev/{disk_kname}"))
+
+    if members:
+        # Partition signatures first, while the partitions still exist.
+        execute.run_all_sync([["wipefs", "--all", node] for node, _ in members])
+        execute.run_all_sync([["sgdisk", "--zap-all", disk] for _, disk in members])
+        for node, disk in members:
+            logger.info("wiped array member", extra={"path": node, "disk": disk})
+
+    readiness.settle()
+    devices.topology.invalidate("reclaim")
+
+
+def resume(config):
+    """
+    Reuse the array from the last successful run, if its members are still
+    present: assemble it if needed, verify the filesystem UUID, and make sure
+    it's mounted and tuned. Return True if the array was reused, and False if a
+    full setup is needed.
+
+    Raise StateMismatch if the array exists, but doesn't hold the expected
+    filesystem, or if something else is mounted at the mount point.
+    """
+
+    state_config = config.get("state", {})
+    if not state_config.get("resume", True):
+        return False
+
+    path = state_path(config)
+    md_name = config.get("mdraid", {}).get("name", "ephemeral")
+    state = load_state(path) if path else None
+    if state is None or md_name not in state["arrays"]:
+        logger.info(
+            "no saved state; running full setup",
+            extra={"path": path, "md_name": md_name},
+        )
+        return False
+
+    state = state["arrays"][md_name]
+
+    if "crypt" in config:
+        # The key was only ever in memory, so the data is gone for good.
+        logger.info(
+            "saved array was encrypted with a key from a previous boot; "
+            "running full setup",
+            extra={"md_name": md_name},
+        )
+        reclaim(md_name, state["members"])
+        return False
+
+    md_path = os.path.join(MD_DEVICE_DIR, md_name)
+    if not os.path.exists(md_path):
+        member_paths = [devices.partuuid_node(guid) for guid in state["members"]]
+        missing = [p for p in member_paths if not os.path.exists(p)]
+        if missing:
+            # The disks were wiped or replaced, e.g. after a stop and start.
+            logger.info(
+                "saved array members missing; running full setup",
+                extra={"missing": missing},
+            )
+            return False
+
+        assemble(md_path, member_paths)
+
+    md_kname = os.path.basename(os.path.realpath(md_path))
+    array = read_mdstat(MDSTAT_PATH).get(md_kname)
+    if array is None or array["state"] != "active":
+        raise StateMismatch(f"array {md_path} ({md_kname}) is not active")
+
+    # With a cache, the filesystem lives on the origin device, seen through
+    # the cache device, which is created again on every boot.
+    device_path = md_path
+    if "cache" in config:
+        device_path = cache.attach(
+            md_path, cache.find_origin(state["fsuuid"]), config["cache"], False
+        )
+
+    fsuuid = read_filesystem_uuid(device_path)
+    if state["fsuuid"] and fsuuid != state["fsuuid"]:
+        raise StateMismatch(
+            f"filesystem UUID mismatch on {device_path}: "
+            f"expected {state['fsuuid']}, found {fsuuid}"
+        )
+
+    mount_point_path = config.get("mount", {}).get("mount_point", {}).get("path")
+    if mount_point_path:
+        st = os.stat(device_path)
+        device_devno = f"{os.major(st.st_rdev)}:{os.minor(st.st_rdev)}"
+        devno = mounted_device(mount_point_path)
+        if devno is None:
+            utils.mount_filesystem(device_path, config)
+        elif devno != device_devno:
+            raise StateMismatch(
+                f"{mount_point_path} is mounted from {devno}, not {device_path}"
+            )
+
+    if geometry.is_redundant(array["level"]):
+        tune.tune_md(
+            md_kname, array["level"], len(array["members"]), config.get("mdraid", {})
+        )
+        report.current.add_to_section("resync", md_name, tune.resync_status(md_kname))
+
+    if "tune" in config:
+        tune.apply(tune.member_disks(md_kname), md_kname, config["tune"])
+
+    logger.info(
+        "reused existing array",
+        extra={"path": md_path, "kname": md_kname, "fsuuid": fsuuid},
+    )
+    return True
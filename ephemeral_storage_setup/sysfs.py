@@ -0,0 +1,271 @@
+"""
+Block device scanner that reads sysfs and the udev database directly, instead of
+running lsblk. It builds the same raw device info dictionaries as `lsblk --json
+--bytes --output-all`, but only for the fields and device types we use.
+"""
+
+import logging
+import os
+import os.path
+
+logger = logging.getLogger()
+
+# Mapping of udev database properties to lsblk field names.
+UDEV_PROPERTIES = {
+    "ID_FS_TYPE": "fstype",
+    "ID_FS_LABEL": "label",
+    "ID_FS_UUID": "uuid",
+    "ID_PART_TABLE_TYPE": "pttype",
+    "ID_PART_TABLE_UUID": "ptuuid",
+    "ID_PART_ENTRY_UUID": "partuuid",
+    "ID_PART_ENTRY_TYPE": "parttype",
+    "ID_PART_ENTRY_NAME": "partlabel",
+}
+
+# Mapping of sysfs queue attributes to lsblk field names.
+QUEUE_ATTRIBUTES = {
+    "physical_block_size": "phy-sec",
+    "logical_block_size": "log-sec",
+    "minimum_io_size": "min-io",
+    "optimal_io_size": "opt-io",
+    "read_ahead_kb": "ra",
+    "nr_requests": "rq-size",
+}
+
+# Substrings of the resolved sysfs device path, mapped to lsblk's `tran` field.
+TRANSPORTS = (
+    ("/nvme/", "nvme"),
+    ("/virtio", "virtio"),
+    ("/usb", "usb"),
+    ("/ata", "sata"),
+)
+
+
+class ScanError(OSError):
+    pass
+
+
+def read_attribute(path, default=None):
+    """
+    Read a single sysfs attribute, returning the stripped string value.
+    """
+
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return default
+
+
+def read_udev_properties(root, dev):
+    """
+    Read the udev database entry for the given "major:minor" device number,
+    and return its properties (E: lines) as a dict.
+    """
+
+    path = os.path.join(root, "run", "udev", "data", f"b{dev}")
+    properties = {}
+    try:
+        with open(path, "r") as f:
+            for line in f:
+                if not line.startswith("E:"):
+                    continue
+                key, _, value = line[2:].rstrip("\n").partition("=")
+                properties[key] = value
+    except FileNotFoundError:
+        # Without the udev database we cannot tell whether the device holds
+        # any data, so refuse to guess. The caller falls back to lsblk.
+        raise ScanError(f"no udev database entry: {path}")
+
+    return properties
+
+
+def read_mountpoints(root):
+    """
+    Return a dict of "major:minor" device number to mount point.
+    """
+
+    mountpoints = {}
+    try:
+        with open(os.path.join(root, "proc", "self", "mountinfo"), "r") as f:
+            for line in f:
+                fields = line.split()
+                mountpoints.setdefault(fields[2], fields[4])
+    except FileNotFoundError:
+        pass
+
+    return mountpoints
+
+
+def device_type(sysfs_path, name):
+    """
+    Return the lsblk device type for the given whole-device sysfs directory.
+    """
+
+    if os.path.exists(os.path.join(sysfs_path, "partition")):
+        return "part"
+
+    if os.path.isdir(os.path.join(sysfs_path, "md")):
+        return read_attribute(os.path.join(sysfs_path, "md", "level"), "md")
+
+    if name.startswith("loop"):
+        return "loop"
+
+    if name.startswith("dm-"):
+        dm_uuid = read_attribute(os.path.join(sysfs_path, "dm", "uuid"), "")
+        return dm_uuid.split("-", 1)[0].lower() or "dm"
+
+    if name.startswith("sr"):
+        return "rom"
+
+    return "disk"
+
+
+def transport(sysfs_path):
+    """
+    Derive the lsblk `tran` field from the resolved sysfs device path.
+    """
+
+    real_path = os.path.realpath(sysfs_path)
+    for substring, tran in TRANSPORTS:
+        if substring in real_path:
+            return tran
+
+    return None
+
+
+class Scanner:
+    """
+    Scan block devices below the given root directory. The root is only
+    changed by tests, to point at a fixture tree.
+    """
+
+    def __init__(self, known_types, root="/"):
+        self.known_types = tuple(known_types)
+        self.root = root
+        self.class_block = os.path.join(root, "sys", "class", "block")
+        self.mountpoints = read_mountpoints(root)
+
+    def is_known(self, type_):
+        return type_.startswith(self.known_types)
+
+    def scan(self, device_path=None):
+        """
+        Return a list of raw device info dicts, like lsblk's "blockdevices".
+        """
+
+        if device_path is not None:
+            # Resolve symlinks like /dev/md/ephemeral to the kernel name.
+            if self.root == "/":
+                device_path = os.path.realpath(device_path)
+            name = os.path.basename(device_path)
+            sysfs_path = os.path.join(self.class_block, name)
+            if not os.path.exists(sysfs_path):
+                raise ScanError(f"device not found in sysfs: {device_path}")
+
+            parent = None
+            if os.path.exists(os.path.join(sysfs_path, "partition")):
+                parent = os.path.basename(os.path.dirname(os.path.realpath(sysfs_path)))
+
+            return [self.device_info(name, parent=parent)]
+
+        block = os.path.join(self.root, "sys", "block")
+        if not os.path.isdir(block):
+            raise ScanError(f"not a directory: {block}")
+
+        devices = []
+        for name in sorted(os.listdir(block)):
+            type_ = device_type(os.path.join(block, name), name)
+            if not self.is_known(type_):
+                continue
+            devices.append(self.device_info(name, type_=type_))
+
+        return devices
+
+    def device_info(self, name, type_=None, parent=None, depth=0):
+        """
+        Build the raw device info dict for the named device, including its
+        partitions and holders as children.
+        """
+
+        sysfs_path = os.path.join(self.class_block, name)
+        if type_ is None:
+            type_ = device_type(sysfs_path, name)
+
+        info = {
+            "name": name,
+            "kname": name,
+            "path": f"/dev/{name}",
+            "type": type_,
+        }
+
+        # Unknown holders (crypt, lvm, etc) are recorded with the bare minimum,
+        # so that they still count as children of their parent device.
+        if not self.is_known(type_):
+            return info
+
+        dev = read_attribute(os.path.join(sysfs_path, "dev"))
+        info["maj:min"] = dev
+        info["size"] = int(read_attribute(os.path.join(sysfs_path, "size"), 0)) * 512
+        info["ro"] = read_attribute(os.path.join(sysfs_path, "ro")) == "1"
+        info["pkname"] = parent
+        info["mountpoint"] = self.mountpoints.get(dev)
+
+        # Partitions share the queue and device attributes of their parent.
+        disk_path = sysfs_path
+        if type_ == "part":
+            disk_path = os.path.join(self.class_block, parent)
+
+        for attribute, field in QUEUE_ATTRIBUTES.items():
+            value = read_attribute(os.path.join(disk_path, "queue", attribute))
+            info[field] = int(value) if value is not None else None
+
+        info["rota"] = (
+            read_attribute(os.path.join(disk_path, "queue", "rotational")) == "1"
+        )
+
+        scheduler = read_attribute(os.path.join(disk_path, "queue", "scheduler"))
+        info["sched"] = None
+        if scheduler is not None and "[" in scheduler:
+            info["sched"] = scheduler.split("[", 1)[1].split("]", 1)[0]
+
+        if type_ == "disk":
+            info["model"] = read_attribute(os.path.join(disk_path, "device", "model"))
+            info["serial"] = read_attribute(os.path.join(disk_path, "device", "serial"))
+            info["rm"] = read_attribute(os.path.join(disk_path, "removable")) == "1"
+            info["tran"] = transport(disk_path)
+        else:
+            info["model"] = None
+            info["serial"] = None
+            info["rm"] = False
+            info["tran"] = None
+
+        udev_properties = read_udev_properties(self.root, dev)
+        for key, field in UDEV_PROPERTIES.items():
+            info[field] = udev_properties.get(key) or None
+
+        children = []
+        if type_ == "disk":
+            for entry in sorted(os.listdir(sysfs_path)):
+                if os.path.exists(os.path.join(sysfs_path, entry, "partition")):
+                    children.append(
+                        self.device_info(entry, parent=name, depth=depth + 1)
+                    )
+
+        holders_path = os.path.join(sysfs_path, "holders")
+        if depth < 4 and os.path.isdir(holders_path):
+            for holder in sorted(os.listdir(holders_path)):
+                children.append(self.device_info(holder, parent=name, depth=depth + 1))
+
+        if children:
+            info["children"] = children
+
+        return info
+
+
+def scan_devices_raw(known_types, device_path=None, root="/"):
+    """
+    Return raw device info dicts for block devices of the given known types.
+    """
+
+    return Scanner(known_types, root=root).scan(device_path)
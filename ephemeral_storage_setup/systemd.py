@@ -0,0 +1,219 @@
+"""
+Generate and install systemd units: a native mount unit for the filesystem, as
+an alternative to an /etc/fstab entry, and an fstrim service and timer scoped
+to the mount point, for periodic discard.
+"""
+
+import logging
+import os
+import os.path
+
+from ephemeral_storage_setup import execute, utils
+
+logger = logging.getLogger()
+
+DEFAULT_UNIT_DIR = "/etc/systemd/system"
+
+# The service running the setup at boot, as in the example service.
+DEFAULT_SETUP_SERVICE = "ephemeral-storage-setup.service"
+
+DEFAULT_DEVICE_TIMEOUT = 10
+
+DEFAULT_FSTRIM_PATH = "/sbin/fstrim"
+
+DEFAULT_FSTRIM_SCHEDULE = "daily"
+
+# Characters systemd-escape leaves as they are, besides "/".
+SAFE_CHARACTERS = frozenset(
+    "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789:_."
+)
+
+
+def escape_path(path):
+    """
+    Escape a path for use in a unit name, like `systemd-escape --path`.
+    """
+
+    path = path.strip("/")
+    if not path:
+        return "-"
+
+    escaped = []
+    for i, c in enumerate(path):
+        if c == "/":
+            escaped.append("-")
+        elif c in SAFE_CHARACTERS and not (i == 0 and c == "."):
+            escaped.append(c)
+        else:
+            escaped.extend(f"\\x{b:02x}" for b in c.encode())
+
+    return "".join(escaped)
+
+
+def mount_unit_name(where):
+    return f"{escape_path(where)}.mount"
+
+
+def device_unit_name(what):
+    return f"{escape_path(what)}.device"
+
+
+def fstrim_unit_name(where, suffix):
+    return f"fstrim-{escape_path(where)}.{suffix}"
+
+
+def mount_unit(what, where, fstype, options, after=()):
+    """
+    Return a mount unit for the filesystem, wanted by local-fs.target, and
+    ordered after the given units, like the setup service, so that the mount
+    waits for the setup to create the filesystem again. With nofail among the
+    options, systemd doesn't order the unit before local-fs.target, so that boot
+    doesn't wait for a filesystem that's gone, like after a stop and start.
+    """
+
+    return "\n".join(
+        [
+            "[Unit]",
+            f"Description=Ephemeral storage at {where}",
+            *(f"After={unit}" for unit in after),
+            "",
+            "[Mount]",
+            f"What={what}",
+            f"Where={where}",
+            f"Type={fstype}",
+            f"Options={','.join(options) or 'defaults'}",
+            "",
+            "[Install]",
+            "WantedBy=local-fs.target",
+            "",
+        ]
+    )
+
+
+def device_timeout_dropin(timeout):
+    """
+    Return a drop-in for the device unit, limiting how long to wait for the
+    device, like x-systemd.device-timeout does in fstab. Mount units ignore it
+    among their options.
+    """
+
+    return "\n".join(["[Unit]", f"JobRunningTimeoutSec={timeout}s", ""])
+
+
+def fstrim_units(where, config):
+    """
+    Return the (service, timer) units discarding unused blocks of the
+    filesystem mounted at `where`, on the schedule in the fstrim config.
+    """
+
+    service = "\n".join(
+        [
+            "[Unit]",
+            f"Description=Discard unused blocks on {where}",
+            f"RequiresMountsFor={where}",
+            "",
+            "[Service]",
+            "Type=oneshot",
+            f"ExecStart={config.get('path', DEFAULT_FSTRIM_PATH)} --verbose {where}",
+            "Nice=19",
+            "IOSchedulingClass=idle",
+            "",
+        ]
+    )
+    timer = "\n".join(
+        [
+            "[Unit]",
+            f"Description=Discard unused blocks on {where} periodically",
+            "",
+            "[Timer]",
+            f"OnCalendar={config.get('schedule', DEFAULT_FSTRIM_SCHEDULE)}",
+            "AccuracySec=1h",
+            "RandomizedDelaySec=1h",
+            "Persistent=true",
+            "",
+            "[Install]",
+            "WantedBy=timers.target",
+            "",
+        ]
+    )
+
+    return service, timer
+
+
+def write_unit(unit_dir, name, content):
+    """
+    Write the unit file, unless it already has the given content. Return True
+    if the file was written.
+    """
+
+    path = os.path.join(unit_dir, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        with open(path, "r") as f:
+            if f.read() == content:
+                return False
+    except FileNotFoundError:
+        pass
+
+    utils.write_atomically(path, content)
+    logger.info("wrote systemd unit", extra={"path": path})
+    return True
+
+
+def install_units(units, enable, unit_dir=DEFAULT_UNIT_DIR, start=False):
+    """
+    Write the units (a dict of unit name, or drop-in path within the unit
+    directory, to content), and if any changed,
+    reload systemd and enable the given units, optionally starting them too.
+    Return True if any unit changed.
+    """
+
+    changed = [
+        name for name, content in units.items() if write_unit(unit_dir, name, content)
+    ]
+    if not changed:
+        logger.info("systemd units unchanged", extra={"units": list(units)})
+        return False
+
+    execute.simple(["systemctl", "daemon-reload"])
+
+    argv = ["systemctl", "enable"]
+    if start:
+        # Don't wait for the start job, which may be queued behind this very
+        # run early in boot.
+        argv.extend(["--now", "--no-block"])
+    execute.simple(argv + list(enable))
+
+    return True
+
+
+def install_mount_unit(
+    what,
+    where,
+    fstype,
+    options,
+    after=(),
+    device_timeout=DEFAULT_DEVICE_TIMEOUT,
+    unit_dir=DEFAULT_UNIT_DIR,
+):
+    name = mount_unit_name(where)
+    dropin = os.path.join(f"{device_unit_name(what)}.d", "device-timeout.conf")
+    return install_units(
+        {
+            name: mount_unit(what, where, fstype, options, after),
+            dropin: device_timeout_dropin(device_timeout),
+        },
+        [name],
+        unit_dir,
+    )
+
+
+def install_fstrim_timer(where, config, unit_dir=DEFAULT_UNIT_DIR):
+    service, timer = fstrim_units(where, config)
+    timer_name = fstrim_unit_name(where, "timer")
+    return install_units(
+        {fstrim_unit_name(where, "service"): service, timer_name: timer},
+        [timer_name],
+        unit_dir,
+        start=True,
+    )
@@ -0,0 +1,229 @@
+"""
+Block layer queue tuning for the md device and its member disks, applied via
+sysfs, and persisted across reboots with a udev rule. Also md tuning for
+redundant RAID levels: resync throttling and the stripe cache.
+"""
+
+import logging
+import os
+import os.path
+
+from ephemeral_storage_setup import geometry, sysfs
+
+logger = logging.getLogger()
+
+SYS_BLOCK_PATH = "/sys/block"
+
+UDEV_RULE_PATH = "/etc/udev/rules.d/90-ephemeral-storage-setup-{md_name}.rules"
+
+# Queue settings presets. Explicitly configured settings take precedence.
+PRESETS = {
+    "none": {
+        "members": {},
+        "array": {},
+    },
+    # Local NVMe: the devices do their own scheduling, so skip the I/O
+    # scheduler, and complete requests on the submitting CPU. Read ahead is
+    # done on the array, in whole stripes.
+    "nvme": {
+        "members": {
+            "scheduler": "none",
+            "rq_affinity": 2,
+            "nomerges": 0,
+        },
+        "array": {
+            "read_ahead_kb": 4096,
+        },
+    },
+}
+
+
+def settings(config):
+    """
+    Return the (member, array) queue settings for the given tune config.
+    """
+
+    preset_name = config.get("preset", "none")
+    if preset_name not in PRESETS:
+        raise ValueError(f"unknown tune preset: {preset_name}")
+
+    preset = PRESETS[preset_name]
+    member_settings = dict(preset["members"], **config.get("members", {}))
+    array_settings = dict(preset["array"], **config.get("array", {}))
+
+    return member_settings, array_settings
+
+
+def apply_sysfs_settings(kname, directory, sysfs_settings):
+    """
+    Write the given settings to /sys/block/<kname>/<directory>. Failures are
+    logged, but not raised, as tuning is best effort.
+    """
+
+    for attribute, value in sysfs_settings.items():
+        path = os.path.join(SYS_BLOCK_PATH, kname, directory, attribute)
+        try:
+            with open(path, "w") as f:
+                f.write(str(value))
+        except OSError as e:
+            logger.warning(
+                "error applying sysfs setting",
+                extra={"path": path, "value": value, "exception": e},
+            )
+            continue
+
+        logger.info(
+            "applied sysfs setting",
+            extra={"device": kname, "attribute": attribute, "value": value},
+        )
+
+
+def apply_queue_settings(kname, queue_settings):
+    apply_sysfs_settings(kname, "queue", queue_settings)
+
+
+def md_settings(level, member_count, config):
+    """
+    Return the md sysfs settings for an array with the given RAID level and
+    member count, from the mdraid config.
+    """
+
+    if not geometry.is_redundant(level):
+        return {}
+
+    settings = {}
+    if config.get("resync", "default") == "throttled":
+        # In KiB/s per device. The minimum is guaranteed even under load; the
+        # maximum leaves headroom for the rest of the boot.
+        settings["sync_speed_min"] = config.get("sync_speed_min", 1000)
+        settings["sync_speed_max"] = config.get("sync_speed_max", 100000)
+
+    if geometry.has_parity(level):
+        stripe_cache_size = config.get("stripe_cache_size", "auto")
+        if stripe_cache_size == "auto":
+            memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+            stripe_cache_size = geometry.stripe_cache_size(member_count, memory)
+        settings["stripe_cache_size"] = stripe_cache_size
+
+    return settings
+
+
+def tune_md(md_kname, level, member_count, config):
+    """
+    Apply md settings for redundant RAID levels. They aren't persistent, so
+    this is also done when reusing an array after a reboot.
+    """
+
+    apply_sysfs_settings(md_kname, "md", md_settings(level, member_count, config))
+
+
+def resync_status(md_kname):
+    """
+    Return the current sync action and progress of the md device, from
+    /sys/block/<kname>/md/sync_action and sync_completed.
+    """
+
+    md_path = os.path.join(SYS_BLOCK_PATH, md_kname, "md")
+    status = {
+        "device": md_kname,
+        "action": sysfs.read_attribute(os.path.join(md_path, "sync_action")),
+    }
+
+    completed = sysfs.read_attribute(os.path.join(md_path, "sync_completed"))
+    if completed and completed != "none":
+        done, total = (int(value) for value in completed.split("/"))
+        status.update(
+            completed_sectors=done,
+            total_sectors=total,
+            progress=round(done / total, 4) if total else None,
+        )
+
+    return status
+
+
+def udev_assignments(queue_settings):
+    return ", ".join(
+        f'ATTR{{queue/{attribute}}}="{value}"'
+        for attribute, value in queue_settings.items()
+    )
+
+
+def udev_rules(disks, md_name, member_settings, array_settings):
+    """
+    Return udev rules that re-apply the queue settings when the devices
+    appear, e.g. when the array is auto-assembled after a reboot.
+    """
+
+    rules = ["# Generated by ephemeral-storage-setup. Do not edit."]
+
+    if member_settings:
+        for disk in disks:
+            serial = disk.raw_info.get("serial")
+            if serial:
+                match = f'ENV{{ID_SERIAL_SHORT}}=="{serial}"'
+            else:
+                match = f'KERNEL=="{disk.raw_info["kname"]}"'
+
+            rules.append(
+                'ACTION=="add|change", SUBSYSTEM=="block", '
+                f'ENV{{DEVTYPE}}=="disk", {match}, ' + udev_assignments(member_settings)
+            )
+
+    if array_settings:
+        rules.append(
+            'ACTION=="add|change", SUBSYSTEM=="block", KERNEL=="md*", '
+            f'ENV{{MD_DEVNAME}}=="{md_name}", ' + udev_assignments(array_settings)
+        )
+
+    return "\n".join(rules) + "\n"
+
+
+def member_disks(md_kname):
+    """
+    Return the knames of the disks holding the members of the given md device,
+    read from its sysfs slaves directory.
+    """
+
+    slaves_path = os.path.join(SYS_BLOCK_PATH, md_kname, "slaves")
+    knames = []
+    for slave in sorted(os.listdir(slaves_path)):
+        slave_path = os.path.realpath(os.path.join(slaves_path, slave))
+        if os.path.exists(os.path.join(slave_path, "partition")):
+            # Partition directories live inside their disk's directory.
+            slave_path = os.path.dirname(slave_path)
+        knames.append(os.path.basename(slave_path))
+
+    return knames
+
+
+def apply(member_knames, md_kname, config):
+    """
+    Apply queue settings to the member disks and the md device.
+    """
+
+    member_settings, array_settings = settings(config)
+
+    for kname in member_knames:
+        apply_queue_settings(kname, member_settings)
+
+    apply_queue_settings(md_kname, array_settings)
+
+    return member_settings, array_settings
+
+
+def tune(disks, mdraid, md_name, config):
+    """
+    Apply queue settings to the member disks and the md device, and install a
+    udev rule to persist them.
+    """
+
+    member_settings, array_settings = apply(
+        [disk.raw_info["kname"] for disk in disks], mdraid.raw_info["kname"], config
+    )
+
+    if config.get("udev_rule", True) and (member_settings or array_settings):
+        rule_path = config.get("udev_rule_path", UDEV_RULE_PATH.format(md_name=md_name))
+        with open(rule_path, "w") as f:
+            f.write(udev_rules(disks, md_name, member_settings, array_settings))
+
+        logger.info("installed udev rule", extra={"path": rule_path})
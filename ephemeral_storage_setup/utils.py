@@ -1,30 +1,237 @@
-import io
+import logging
 import os
 import os.path
+import re
 import shutil
-import tarfile
+import stat
+import time
+import uuid
 
-from ephemeral_storage_setup import execute
+from ephemeral_storage_setup import (
+    execute,
+    geometry,
+    lazy,
+    readiness,
+    systemd,
+)
 
+populate = lazy.module("ephemeral_storage_setup.populate")
+
+logger = logging.getLogger()
 
 DEFAULT_FSTYPE = "ext4"
 
+# mkfs takes longer than other commands, especially with discard on large
+# arrays, in seconds.
+DEFAULT_MKFS_TIMEOUT = 600.0
+
+EXT4_FEATURES_PATH = "/sys/fs/ext4/features"
+
+# e2fsprogs versions that first support ext4 features; older mke2fs rejects
+# them, even if the kernel supports them.
+MKE2FS_FEATURE_VERSIONS = {"fast_commit": (1, 46)}
+
+DEFAULT_FSTAB_PATH = "/etc/fstab"
+
+# mkfs.xfs allocation group size bounds.
+XFS_MIN_AG_SIZE = 16 * 1024**2
+XFS_MAX_AG_SIZE = 1024**4
 
-def udev_settle(func):
+DISCARD_STRATEGIES = ("online", "periodic", "none")
+
+PERSIST_METHODS = ("fstab", "systemd", "none")
+
+
+class Filesystem:
     """
-    Run `udevadm settle` before and after the function is called.
+    Filesystem backend, building the mkfs command line and the mount options
+    for one filesystem type. Instantiating Filesystem with an mkfs config
+    returns an instance of the subclass registered for the configured type.
+
+    Types without a registered backend get this generic base class, which can
+    still be mounted and added to fstab, but requires a custom mkfs command.
     """
 
-    def wrapper(*args, **kwargs):
-        execute.simple(["udevadm", "settle"])
-        retval = func(*args, **kwargs)
-        execute.simple(["udevadm", "settle"])
-        return retval
+    class Unknown(Exception):
+        pass
+
+    _registry = {}  # Registered subclasses.
+
+    # Named mkfs profiles, mapped to extra mkfs arguments for the backend, and
+    # optionally a mkfs timeout other than DEFAULT_MKFS_TIMEOUT.
+    profiles = {"default": {}}
+
+    def __init_subclass__(cls) -> None:
+        """Register subclasses for later instantiation."""
+        super().__init_subclass__()
+        cls._registry[cls.fstype] = cls  # Add class to registry.
+
+    def __new__(cls, config):
+        """Create instance of appropriate subclass."""
+        subclass = cls._registry.get(config.get("type", DEFAULT_FSTYPE), cls)
+        return object.__new__(subclass)
+
+    def __init__(self, config):
+        self.config = config
+        self.profile = config.get("profile", "default")
+        if self.profile not in self.profiles:
+            raise ValueError(f"unknown mkfs profile for {self.type}: {self.profile}")
+
+    @property
+    def type(self):
+        return self.config.get("type", DEFAULT_FSTYPE)
+
+    @property
+    def timeout(self):
+        """
+        The mkfs timeout in seconds, or None for no timeout.
+        """
+
+        default = self.profiles[self.profile].get("timeout", DEFAULT_MKFS_TIMEOUT)
+        return self.config.get("timeout", default)
+
+    @property
+    def fstab_type(self):
+        return self.type
+
+    @property
+    def label(self):
+        return self.config.get("label", "ephemeral")
+
+    def mkfs_argv(self, fsuuid, stripe=None, device_size=None):
+        """
+        Return the mkfs argv, without the device path. The device size in
+        bytes is None if unknown.
+        """
 
-    return wrapper
+        raise self.Unknown(
+            f"no mkfs support for filesystem type {self.type}; set mkfs.command"
+        )
+
+    def mount_options(self):
+        """
+        Return the default mount options, used if none are configured.
+        """
+
+        return []
+
+
+class Ext4(Filesystem):
+    fstype = "ext4"
+
+    # Named mkfs profiles, trading time-to-mount against background work after
+    # mount. Features are only enabled if supported by the running kernel.
+    profiles = {
+        # mke2fs defaults.
+        "default": {
+            "extended_options": [],
+            "features": [],
+        },
+        # Fastest time-to-mount: skip discard, and leave inode table and
+        # journal initialization to the kernel (ext4lazyinit) after mount.
+        "fast-boot": {
+            "extended_options": [
+                "nodiscard",
+                "lazy_itable_init=1",
+                "lazy_journal_init=1",
+            ],
+            "features": ["fast_commit"],
+        },
+        # No background initialization competing with the application:
+        # initialize everything before the filesystem is mounted. This writes
+        # every inode table, which takes minutes on multi-TB arrays, so mkfs
+        # isn't timed out.
+        "full-init": {
+            "extended_options": ["lazy_itable_init=0", "lazy_journal_init=0"],
+            "features": ["fast_commit"],
+            "timeout": None,
+        },
+    }
+
+    def mkfs_argv(self, fsuuid, stripe=None, device_size=None):
+        argv = [
+            "mkfs.ext4",
+            "-L",
+            self.label,
+            "-m",
+            str(self.config.get("reserved_blocks_percentage", 0)),
+            "-U",
+            fsuuid,
+        ]
+
+        profile = self.profiles[self.profile]
+        features = [
+            feature
+            for feature in profile["features"]
+            if ext4_feature_supported(feature)
+        ]
+        if features:
+            argv.extend(["-O", ",".join(features)])
+
+        extended_options = profile["extended_options"]
+        extended_options = extended_options + ext4_stripe_options(self.config, stripe)
+        if extended_options:
+            argv.extend(["-E", ",".join(extended_options)])
+
+        return argv
+
+
+class XFS(Filesystem):
+    fstype = "xfs"
+
+    profiles = {
+        "default": {"options": []},
+        # Skip discard at mkfs time. XFS has no lazy initialization to tune.
+        "fast-boot": {"options": ["-K"]},
+        "full-init": {"options": []},
+    }
+
+    def allocation_groups(self, device_size=None):
+        """
+        Return the number of allocation groups: one per CPU (at least 4, the
+        mkfs.xfs default), so that concurrent writers don't contend, within
+        the number that fit the device, as groups must be between 16 MiB and
+        1 TiB. Return None to leave the choice to mkfs.xfs, if the device size
+        is unknown, or too small for 4 groups.
+        """
+
+        if "agcount" in self.config:
+            return self.config["agcount"]
+        if device_size is None:
+            return None
+
+        agcount = min(max(4, os.cpu_count() or 1), device_size // XFS_MIN_AG_SIZE)
+        if agcount < 4:
+            return None
+
+        return max(agcount, -(-device_size // XFS_MAX_AG_SIZE))
+
+    def mkfs_argv(self, fsuuid, stripe=None, device_size=None):
+        argv = [
+            "mkfs.xfs",
+            "-f",
+            "-L",
+            self.label,
+            "-m",
+            f"uuid={fsuuid}",
+        ]
+        argv.extend(self.profiles[self.profile]["options"])
+
+        data_options = []
+        agcount = self.allocation_groups(device_size)
+        if agcount is not None:
+            data_options.append(f"agcount={agcount}")
+        data_options.extend(xfs_stripe_options(self.config, stripe))
+        if data_options:
+            argv.extend(["-d", ",".join(data_options)])
+
+        return argv
+
+    def mount_options(self):
+        # Larger log buffers help metadata-heavy concurrent writers.
+        return ["logbsize=256k"]
 
 
-@udev_settle
 def create_single_partition(
     dev_path,
     sector_start,
@@ -43,35 +250,208 @@ def create_single_partition(
     )
 
 
-@udev_settle
-def mkfs(device_path, config):
+def mkfs(device_path, config, stripe=None):
     """
     Create a filesystem on the given device, based on the supplied config.
+    The optional stripe is the (chunk size, full stripe size) of the device in
+    bytes, used to align the filesystem unless overridden by config.
+
+    Return the filesystem UUID, or None if a custom command was used, in which
+    case the UUID is not known in advance.
     """
 
-    argv = config.get(
-        "command",
-        [
-            f"mkfs.{DEFAULT_FSTYPE}",
-            "-L",
-            config.get("label", "ephemeral"),
-            "-m",
-            str(config.get("reserved_blocks_percentage", 0)),
-        ],
-    )
+    fsuuid = None
+    profile = None
+    timeout = config.get("timeout", DEFAULT_MKFS_TIMEOUT)
+    if "command" in config:
+        argv = list(config["command"])
+    else:
+        filesystem = Filesystem(config)
+        profile = filesystem.profile
+        timeout = filesystem.timeout
+
+        # Set the filesystem UUID up front, to be able to wait for its udev
+        # symlink specifically.
+        fsuuid = str(uuid.uuid4())
+        try:
+            size = device_size(device_path)
+        except OSError as e:
+            logger.warning(
+                "could not read device size",
+                extra={"path": device_path, "exception": e},
+            )
+            size = None
+        argv = filesystem.mkfs_argv(fsuuid, stripe, size)
+
     argv.append(device_path)
-    execute.simple(argv)
 
+    start = time.monotonic()
+    execute.simple(argv, timeout=timeout)
+    logger.info(
+        "filesystem created",
+        extra={
+            "path": device_path,
+            "profile": profile,
+            "elapsed": round(time.monotonic() - start, 6),
+        },
+    )
+
+    readiness.wait_for_nodes([f"/dev/disk/by-uuid/{fsuuid}"] if fsuuid else [])
+
+    return fsuuid
+
+
+def mke2fs_version():
+    """
+    Return the e2fsprogs version of mke2fs as a tuple, like (1, 46, 5), or
+    None if it can't be determined.
+    """
+
+    try:
+        stdout, stderr = execute.simple(["mke2fs", "-V"])
+    except (OSError, execute.NonZeroExitException) as e:
+        logger.warning("could not get the mke2fs version", extra={"exception": e})
+        return None
+
+    # Like "mke2fs 1.46.5 (30-Dec-2021)", on stderr.
+    match = re.search(r"mke2fs (\d+(?:\.\d+)+)", f"{stdout}\n{stderr}")
+    if match is None:
+        return None
+
+    return tuple(int(part) for part in match.group(1).split("."))
+
+
+def ext4_feature_supported(feature):
+    """
+    Return True if both the running kernel and mke2fs support the given ext4
+    feature.
+    """
+
+    if not os.path.exists(os.path.join(EXT4_FEATURES_PATH, feature)):
+        return False
+
+    required = MKE2FS_FEATURE_VERSIONS.get(feature)
+    if required is None:
+        return True
+
+    version = mke2fs_version()
+    supported = version is not None and version >= required
+    if not supported:
+        logger.info(
+            "ext4 feature not supported by mke2fs",
+            extra={"feature": feature, "mke2fs_version": version},
+        )
+
+    return supported
+
+
+def ext4_stripe_options(config, stripe):
+    """
+    Return ext4 extended options for stripe alignment. The stride and
+    stripe_width config values take precedence over the device stripe.
+    """
+
+    stride = config.get("stride")
+    stripe_width = config.get("stripe_width")
+    if stripe is not None:
+        auto_stride, auto_stripe_width = geometry.ext4_stripe(stripe)
+        if stride is None:
+            stride = auto_stride
+        if stripe_width is None:
+            stripe_width = auto_stripe_width
+
+    options = []
+    if stride:
+        options.append(f"stride={stride}")
+    if stripe_width:
+        options.append(f"stripe_width={stripe_width}")
+
+    if options:
+        logger.info(
+            "filesystem stripe geometry",
+            extra={"stride": stride, "stripe_width": stripe_width, "stripe": stripe},
+        )
+
+    return options
+
+
+def xfs_stripe_options(config, stripe):
+    """
+    Return XFS data section options for stripe alignment. The su (bytes) and
+    sw (data disks) config values take precedence over the device stripe.
+    """
+
+    su = config.get("su")
+    sw = config.get("sw")
+    if stripe is not None:
+        auto_su, auto_sw = geometry.xfs_stripe(stripe)
+        if su is None:
+            su = auto_su
+        if sw is None:
+            sw = auto_sw
+
+    if not su or not sw:
+        return []
+
+    logger.info(
+        "filesystem stripe geometry",
+        extra={"su": su, "sw": sw, "stripe": stripe},
+    )
+
+    return [f"su={to_bytes(su)}", f"sw={sw}"]
+
+
+def discard_strategy(config):
+    """
+    Return the discard strategy from the mount config: "online" (the discard
+    mount option), "periodic" (an fstrim timer) or "none".
+    """
+
+    strategy = config.get("discard", "online")
+    if strategy not in DISCARD_STRATEGIES:
+        raise ValueError(f"unknown discard strategy: {strategy}")
 
-def mount(device_path, config):
+    return strategy
+
+
+def mount_options(config, default_options=()):
+    """
+    Return the mount options from the mount config, or the default options if
+    none are configured, with the discard option for online discard.
+    """
+
+    options = list(config.get("mount_options", default_options))
+    if discard_strategy(config) == "online" and "discard" not in options:
+        options.append("discard")
+
+    return options
+
+
+def persist_method(config):
+    """
+    Return how the mount is persisted across reboots, from the mount config:
+    "fstab", "systemd" (a mount unit) or "none".
+    """
+
+    default = "fstab" if config.get("add_to_fstab", True) else "none"
+    method = config.get("persist", default)
+    if method not in PERSIST_METHODS:
+        raise ValueError(f"unknown mount persist method: {method}")
+
+    return method
+
+
+def mount(device_path, config, default_options=()):
     """
-    Mount the given device, based on the supplied config.
+    Mount the given device, based on the supplied config. The default options
+    are used if the config has no mount options.
     """
 
     argv = ["mount"]
-    if "mount_options" in config:
+    options = mount_options(config, default_options)
+    if options:
         argv.append("-o")
-        argv.append(",".join(config["mount_options"]))
+        argv.append(",".join(options))
 
     mount_point_path = config["mount_point"]["path"]
     argv.extend([device_path, mount_point_path])
@@ -86,63 +466,197 @@ def mount(device_path, config):
         )
 
 
-def activate_mount(mdraid, config):
+def mount_filesystem(device_path, config):
+    """
+    Mount the new filesystem on the device, with the default mount options for
+    the configured filesystem type.
+    """
+
+    filesystem = Filesystem(config.get("mkfs", {}))
+    mount(
+        device_path,
+        config.get("mount", {}),
+        default_options=filesystem.mount_options(),
+    )
+
+
+def persistent_mount_options(config):
+    """
+    Return the mount options for mounts on boot, by fstab or mount unit.
+    """
+
     mount_config = config.get("mount", {})
+    filesystem = Filesystem(config.get("mkfs", {}))
+    options = mount_options(mount_config, filesystem.mount_options()) or ["defaults"]
+
+    # Don't hold up boot for a filesystem that's gone, like after a stop and
+    # start, when the setup creates it again: with nofail, systemd doesn't
+    # order the mount before local-fs.target.
+    options.append("nofail")
+
+    return options
+
+
+def device_timeout(mount_config):
+    """
+    Return how long to wait for the device on boot, in seconds, so that boot
+    soon gives up on a device that's gone.
+    """
+
+    return mount_config.get("device_timeout", systemd.DEFAULT_DEVICE_TIMEOUT)
 
-    mount(mdraid.path, mount_config)
-    mount_point_path = mount_config.get("mount_point", {}).get("path")
 
-    mkfs_config = config.get("mkfs", {})
+def add_filesystem_to_fstab(fsuuid, config):
+    mount_config = config.get("mount", {})
+    filesystem = Filesystem(config.get("mkfs", {}))
     add_to_fstab(
-        mdraid.uuid, mount_point_path, mkfs_config.get("type", "ext4")
+        fsuuid,
+        mount_config.get("mount_point", {}).get("path"),
+        filesystem.fstab_type,
+        mount_config.get("fstab_path", DEFAULT_FSTAB_PATH),
+        persistent_mount_options(config)
+        + [f"x-systemd.device-timeout={device_timeout(mount_config)}s"],
     )
 
-    populate_config = config.get("populate", {})
-    populate_directory(mount_point_path, populate_config)
 
+def add_mount_unit(fsuuid, config):
+    mount_config = config.get("mount", {})
+    filesystem = Filesystem(config.get("mkfs", {}))
+    systemd.install_mount_unit(
+        f"/dev/disk/by-uuid/{fsuuid}",
+        mount_config.get("mount_point", {}).get("path"),
+        filesystem.fstab_type,
+        persistent_mount_options(config),
+        after=[mount_config.get("setup_service", systemd.DEFAULT_SETUP_SERVICE)],
+        device_timeout=device_timeout(mount_config),
+        unit_dir=mount_config.get("unit_dir", systemd.DEFAULT_UNIT_DIR),
+    )
 
-def add_to_fstab(fsuuid, mount_point, fstype, fstab_path="/etc/fstab"):
+
+def persist_mount(fsuuid, config):
     """
-    Add the given device (by UUID) to /etc/fstab.
+    Persist the mount across reboots, according to the mount config.
     """
 
-    with open(fstab_path, "a") as f:
-        f.write(
-            " ".join(
-                (
-                    f"UUID={fsuuid}",
-                    mount_point,
-                    fstype,
-                    "defaults,discard",
-                    "0",
-                    "0",
-                )
-            )
-            + "\n"
+    method = persist_method(config.get("mount", {}))
+    if method == "fstab":
+        add_filesystem_to_fstab(fsuuid, config)
+    elif method == "systemd":
+        add_mount_unit(fsuuid, config)
+
+
+def add_fstrim_timer(config):
+    mount_config = config.get("mount", {})
+    systemd.install_fstrim_timer(
+        mount_config["mount_point"]["path"],
+        mount_config.get("fstrim", {}),
+        unit_dir=mount_config.get("unit_dir", systemd.DEFAULT_UNIT_DIR),
+    )
+
+
+def write_atomically(path, content):
+    """
+    Write the file via a temporary file and a rename, so that readers (like
+    mount on boot, or the node exporter's textfile collector) never see a
+    partial file. Symlinks are resolved first, so that the target is written
+    rather than the link replaced, and an existing file keeps its mode, owner
+    and SELinux label.
+    """
+
+    path = os.path.realpath(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    try:
+        current = os.stat(path)
+    except FileNotFoundError:
+        current = None
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        if current is not None:
+            copy_file_attributes(path, current, f.fileno())
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def copy_file_attributes(path, current, fd):
+    """
+    Copy the mode, owner and SELinux label of the file at `path`, with the
+    given stat result, onto the open file `fd`.
+    """
+
+    os.fchmod(fd, stat.S_IMODE(current.st_mode))
+    new = os.fstat(fd)
+    if (new.st_uid, new.st_gid) != (current.st_uid, current.st_gid):
+        os.fchown(fd, current.st_uid, current.st_gid)
+
+    try:
+        label = os.getxattr(path, "security.selinux")
+    except OSError:
+        # No SELinux, or no label.
+        return
+
+    try:
+        os.setxattr(fd, "security.selinux", label)
+    except OSError as e:
+        logger.warning(
+            "could not copy SELinux label", extra={"path": path, "exception": e}
         )
 
 
-def extract_archive(directory, skeleton_archive_path):
+def add_to_fstab(
+    fsuuid, mount_point, fstype, fstab_path=DEFAULT_FSTAB_PATH, options=("defaults",)
+):
     """
-    Extract the given archive to the given directory.
+    Add the given device (by UUID) to /etc/fstab, replacing any existing entry
+    for the same mount point. The file is only rewritten if this changes it.
+    Return True if the file was changed.
     """
 
-    with tarfile.open(skeleton_archive_path) as tar:
-        tar.extractall(directory)
+    entry = " ".join(
+        (f"UUID={fsuuid}", mount_point, fstype, ",".join(options), "0", "0")
+    )
+
+    try:
+        with open(fstab_path, "r") as f:
+            current = f.read()
+    except FileNotFoundError:
+        current = ""
+
+    lines = []
+    for line in current.splitlines():
+        fields = line.split()
+        if len(fields) > 1 and not fields[0].startswith("#"):
+            if fields[1] == mount_point:
+                continue
+        lines.append(line)
+    lines.append(entry)
 
+    content = "\n".join(lines) + "\n"
+    if content == current:
+        logger.info("fstab entry unchanged", extra={"path": fstab_path, "entry": entry})
+        return False
 
-def sync_directories(target, source):
+    write_atomically(fstab_path, content)
+    logger.info("wrote fstab entry", extra={"path": fstab_path, "entry": entry})
+    return True
+
+
+def extract_archive(directory, skeleton_archive_path, **kwargs):
     """
-    Synchronize the contents of the source directory to the target directory.
+    Extract the given archive to the given directory. See
+    populate.extract_archive for the keyword arguments.
     """
 
-    with io.BytesIO() as myio:
-        with tarfile.open(fileobj=myio, mode="w") as tar:
-            tar.add(source, arcname=".")
+    populate.extract_archive(skeleton_archive_path, directory, **kwargs)
 
-        myio.seek(0)
-        with tarfile.open(fileobj=myio) as tar:
-            tar.extractall(target)
+
+def sync_directories(target, source, max_workers=8):
+    """
+    Synchronize the contents of the source directory to the target directory.
+    """
+
+    populate.copy_tree(source, target, max_workers=max_workers)
 
 
 def create_files(target, entries):
@@ -174,15 +688,49 @@ def populate_directory(directory, config):
     method = config.get("method")
 
     if method == "directory":
-        sync_directories(directory, config["source_path"])
+        sync_directories(
+            directory, config["source_path"], max_workers=config.get("max_workers", 8)
+        )
 
     elif method == "archive":
-        extract_archive(directory, config["archive_path"])
+        extract_archive(
+            directory,
+            config["archive_path"],
+            max_workers=config.get("max_workers", 8),
+            method=config.get("extract_method", "python"),
+            timeout=config.get("timeout", 600.0),
+        )
 
     elif method == "config":
         create_files(directory, config["entries"])
 
 
+def populate_source(config):
+    """
+    Return the path the populate method reads from, if any.
+    """
+
+    method = config.get("method")
+    if method == "directory":
+        return config["source_path"]
+    elif method == "archive":
+        return config["archive_path"]
+
+    return None
+
+
+def device_size(device_path):
+    """
+    Return the size of the block device, in bytes.
+    """
+
+    fd = os.open(device_path, os.O_RDONLY)
+    try:
+        return os.lseek(fd, 0, os.SEEK_END)
+    finally:
+        os.close(fd)
+
+
 def to_bytes(value: str):
     """
     Parse a string into bytes.
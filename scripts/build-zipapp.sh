@@ -0,0 +1,33 @@
+#!/bin/sh
+# Build a single-file, self-contained zipapp of the tool and its dependencies:
+#
+#   scripts/build-zipapp.sh [output path]
+#
+# Run the result with any Python 3.8+ interpreter, or directly:
+#
+#   ./dist/ephemeral-storage-setup.pyz config.yml
+#
+# Sources are precompiled into the archive, next to the sources, so the
+# interpreter that built it doesn't compile them on every boot. Other
+# interpreters fall back to the sources.
+
+set -eu
+
+python="${PYTHON:-python3}"
+output="${1:-dist/ephemeral-storage-setup.pyz}"
+root="$(cd "$(dirname "$0")/.." && pwd)"
+
+staging="$(mktemp -d)"
+trap 'rm -rf "$staging"' EXIT
+
+"$python" -m pip install --quiet --no-compile --target "$staging" "$root"
+rm -rf "$staging"/bin
+"$python" -m compileall -q -b "$staging"
+
+mkdir -p "$(dirname "$output")"
+"$python" -m zipapp "$staging" \
+    --main "ephemeral_storage_setup.cli:cli" \
+    --python "/usr/bin/env python3" \
+    --output "$output"
+
+echo "$output"
@@ -14,3 +14,14 @@ def pytest_collection_modifyitems(config, items):
     for item in items:
         if "slow" in item.keywords:
             item.add_marker(skip_vagrant)
+
+
+@pytest.fixture(autouse=True)
+def reset_topology():
+    """
+    Start each test with an empty device topology snapshot.
+    """
+
+    from ephemeral_storage_setup import devices
+
+    devices.topology.reset()
@@ -0,0 +1,450 @@
+"""
+End-to-end harness running the whole setup (cli.main) against simulated disks,
+without a VM, recording the wall time of each phase and the subprocesses run.
+
+Two backends:
+
+- fake: A pure-Python stand-in for lsblk, sgdisk, mdadm, mkfs, mount and
+  udevadm, plugged in where the execute module starts subprocesses. Runs
+  anywhere, without root, for any number of disks.
+
+- loop: Sparse files attached as loop devices, and the real commands. Needs
+  root, and the commands installed. The loop devices are presented to the
+  setup as disks, by filtering the lsblk output.
+
+Run from the repository root, e.g. to compare scaling across disk counts:
+
+    python -m tests.harness --backend fake --disks 1 2 4 8 16 32 64
+"""
+
+import argparse
+import asyncio
+import collections
+import contextlib
+import json
+import os
+import re
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from unittest import mock
+
+import yaml
+from ephemeral_storage_setup import cli, devices, execute
+
+MODEL = "Ephemeral Storage Harness Disk"
+
+DEFAULT_DISK_SIZE = 1024**3
+
+UUID_PATTERN = re.compile(r"[0-9a-f]{8}(-[0-9a-f]{4}){3}-[0-9a-f]{12}")
+
+
+def harness_config(workdir, **overrides):
+    """
+    Return a setup config that keeps all state within the work directory.
+    """
+
+    config = {
+        "detect": {"models": [MODEL]},
+        "state": {"path": os.path.join(workdir, "state.json")},
+        "report": {"path": os.path.join(workdir, "report.json")},
+        "mdraid": {"name": "harness"},
+        "mount": {
+            "mount_point": {"path": os.path.join(workdir, "mnt")},
+            "fstab_path": os.path.join(workdir, "fstab"),
+        },
+        "populate": {
+            "method": "config",
+            "entries": [{"path": "some/deep/path", "mode": "0750"}],
+        },
+    }
+    config.update(overrides)
+    return config
+
+
+class FakePopen:
+    """
+    Finished process, as returned by execute.popen.
+    """
+
+    def __init__(self, rc, stdout, stderr):
+        self.returncode = rc
+        self._output = (stdout.encode(), stderr.encode())
+
+    def communicate(self, input=None, timeout=None):
+        return self._output
+
+    def kill(self):
+        pass
+
+
+class FakeProcess:
+    """
+    Finished process, as returned by execute.create_process.
+    """
+
+    def __init__(self, rc, stdout, stderr):
+        self.returncode = rc
+        self.stdout = asyncio.StreamReader()
+        self.stdout.feed_data(stdout.encode())
+        self.stdout.feed_eof()
+        self.stderr = asyncio.StreamReader()
+        self.stderr.feed_data(stderr.encode())
+        self.stderr.feed_eof()
+
+    async def wait(self):
+        return self.returncode
+
+    def kill(self):
+        pass
+
+
+class FakeSystem:
+    """
+    Simulated block devices, changed by simulated commands. Each command
+    takes the given latency, in seconds, to expose serialization.
+    """
+
+    def __init__(self, disk_count, disk_size=DEFAULT_DISK_SIZE, latency=0.0):
+        self.latency = latency
+        self._lock = threading.Lock()
+        self.disks = []
+        for i in range(disk_count):
+            self.disks.append(
+                self.device(
+                    f"nvme{i}n1",
+                    "disk",
+                    disk_size,
+                    model=MODEL,
+                    serial=f"HARNESS{i:04d}",
+                    tran="nvme",
+                )
+            )
+        self.arrays = {}
+        self.mounts = {}
+
+    @staticmethod
+    def device(name, type, size, **fields):
+        return dict(
+            {
+                "name": name,
+                "kname": name,
+                "path": f"/dev/{name}",
+                "type": type,
+                "size": size,
+                "model": None,
+                "serial": None,
+                "tran": None,
+                "rota": False,
+                "phy-sec": 512,
+                "log-sec": 512,
+                "min-io": 512,
+                "opt-io": 0,
+                "pttype": None,
+                "fstype": None,
+                "label": None,
+                "uuid": None,
+                "partuuid": None,
+                "mountpoint": None,
+                "children": [],
+            },
+            **fields,
+        )
+
+    def devices_by_path(self):
+        paths = {}
+        for disk in self.disks:
+            paths[disk["path"]] = disk
+            for partition in disk["children"]:
+                paths[partition["path"]] = partition
+        for name, array in self.arrays.items():
+            paths[array["path"]] = array
+            paths[f"/dev/md/{name}"] = array
+        return paths
+
+    def run(self, argv):
+        """
+        Run the simulated command, and return (rc, stdout, stderr).
+        """
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        command = os.path.basename(argv[0])
+        handler = getattr(self, "run_" + command.replace(".", "_"), None)
+        if handler is None:
+            return 127, "", f"{command}: command not found"
+
+        with self._lock:
+            return handler(argv[1:])
+
+    def run_lsblk(self, args):
+        if args and not args[-1].startswith("-"):
+            device = self.devices_by_path().get(args[-1])
+            if device is None:
+                return 32, "", f"lsblk: {args[-1]}: not a block device"
+            return 0, json.dumps({"blockdevices": [device]}), ""
+
+        return 0, json.dumps({"blockdevices": self.disks}), ""
+
+    def run_udevadm(self, args):
+        return 0, "", ""
+
+    def run_sgdisk(self, args):
+        disk = self.devices_by_path()[args[-1]]
+        options = dict(arg.split("=", 1) for arg in args[:-1] if "=" in arg)
+        start = int(options["--set-alignment"]) * disk["phy-sec"]
+        partition = self.device(
+            f"{disk['name']}p1",
+            "part",
+            disk["size"] - start - 1024**2,
+            partuuid=options["--partition-guid"].split(":", 1)[1],
+        )
+        disk["pttype"] = "gpt"
+        disk["children"] = [partition]
+        return 0, "", ""
+
+    def run_mdadm(self, args):
+        if args[0] != "--create":
+            return 1, "", f"mdadm: unsupported: {args[0]}"
+
+        name = args[1]
+        options = dict(arg.split("=", 1) for arg in args if "=" in arg)
+        members = [self.devices_by_path()[arg] for arg in args if arg.startswith("/")]
+        level = options["--level"]
+        chunk = int(options.get("--chunk", "512K").rstrip("K")) * 1024
+        array = self.device(
+            f"md{127 - len(self.arrays)}",
+            f"raid{level}",
+            sum(member["size"] for member in members),
+            **{"min-io": chunk, "opt-io": chunk * len(members)},
+        )
+        self.arrays[name] = array
+        for member in members:
+            member["children"].append(array)
+        return 0, f"mdadm: array /dev/md/{name} started.", ""
+
+    def mkfs(self, fstype, args):
+        device = self.devices_by_path()[args[-1]]
+        match = UUID_PATTERN.search(" ".join(args))
+        device["fstype"] = fstype
+        device["uuid"] = match.group(0) if match else str(uuid.uuid4())
+        return 0, "", ""
+
+    def run_mkfs_ext4(self, args):
+        return self.mkfs("ext4", args)
+
+    def run_mkfs_xfs(self, args):
+        return self.mkfs("xfs", args)
+
+    def run_mount(self, args):
+        device_path, mount_point = args[-2:]
+        self.mounts[mount_point] = device_path
+        return 0, "", ""
+
+    def popen(self, argv, stdin=None):
+        return FakePopen(*self.run(argv))
+
+    async def create_process(self, argv):
+        return FakeProcess(*self.run(argv))
+
+    def stat(self, path, *args, **kwargs):
+        if path in self.devices_by_path():
+            return os.stat_result((stat.S_IFBLK | 0o660,) + (0,) * 9)
+        return real_stat(path, *args, **kwargs)
+
+    @contextlib.contextmanager
+    def attached(self, workdir):
+        """
+        Plug the simulated commands into the execute module.
+        """
+
+        with mock.patch.object(execute, "popen", self.popen), mock.patch.object(
+            execute, "create_process", self.create_process
+        ), mock.patch.object(devices.os, "stat", self.stat):
+            yield
+
+    def config(self, workdir, **overrides):
+        # Device nodes are never created, so always settle instead.
+        return harness_config(workdir, udev={"wait": "settle"}, **overrides)
+
+    def verify(self, disk_count):
+        (array,) = self.arrays.values()
+        assert array["type"] == "raid0"
+        assert array["fstype"] == "ext4"
+        assert len(self.disks) == disk_count
+        assert all(array in disk["children"][0]["children"] for disk in self.disks)
+        assert list(self.mounts.values()) == [array["path"]]
+
+
+real_stat = os.stat
+
+
+class LoopSystem:
+    """
+    Sparse files attached as loop devices, set up with the real commands.
+    """
+
+    REQUIRED_COMMANDS = ("losetup", "lsblk", "sgdisk", "mdadm", "mkfs.ext4", "mount")
+
+    def __init__(self, disk_count, disk_size=DEFAULT_DISK_SIZE):
+        self.disk_count = disk_count
+        self.disk_size = disk_size
+        self.loop_paths = []
+        self.md_name = None
+
+    @classmethod
+    def available(cls):
+        return os.geteuid() == 0 and all(map(shutil.which, cls.REQUIRED_COMMANDS))
+
+    def attach(self, workdir):
+        for i in range(self.disk_count):
+            path = os.path.join(workdir, f"disk{i}.img")
+            with open(path, "wb") as f:
+                f.truncate(self.disk_size)
+            loop_path = subprocess.check_output(
+                ["losetup", "--find", "--show", "--partscan", path], text=True
+            ).strip()
+            self.loop_paths.append(loop_path)
+
+    def detach(self, workdir):
+        mount_point = os.path.join(workdir, "mnt")
+        subprocess.run(["umount", mount_point], capture_output=True)
+        if self.md_name:
+            subprocess.run(
+                ["mdadm", "--stop", f"/dev/md/{self.md_name}"], capture_output=True
+            )
+        for loop_path in self.loop_paths:
+            subprocess.run(["losetup", "--detach", loop_path], capture_output=True)
+
+    def present(self, devices_raw):
+        """
+        Keep only the harness loop devices in lsblk output, presented as disks.
+        """
+
+        presented = []
+        for raw_info in devices_raw:
+            if raw_info["type"] == "loop":
+                if raw_info["path"] not in self.loop_paths:
+                    continue
+                raw_info = dict(raw_info, type="disk", model=MODEL)
+            presented.append(raw_info)
+        return presented
+
+    def popen(self, argv, stdin=None):
+        p = real_popen(argv, stdin)
+        if os.path.basename(argv[0]) != "lsblk":
+            return p
+
+        stdout, stderr = p.communicate()
+        if p.returncode == 0:
+            output = json.loads(stdout)
+            output["blockdevices"] = self.present(output["blockdevices"])
+            stdout = json.dumps(output).encode()
+        return FakePopen(p.returncode, stdout.decode(), stderr.decode())
+
+    @contextlib.contextmanager
+    def attached(self, workdir):
+        self.attach(workdir)
+        try:
+            with mock.patch.object(execute, "popen", self.popen):
+                yield
+        finally:
+            self.detach(workdir)
+
+    def config(self, workdir, **overrides):
+        config = harness_config(workdir, **overrides)
+        self.md_name = config["mdraid"]["name"]
+        return config
+
+    def verify(self, disk_count):
+        output = subprocess.check_output(
+            ["lsblk", "--json", "--bytes", "--output-all", f"/dev/md/{self.md_name}"]
+        )
+        (array,) = json.loads(output)["blockdevices"]
+        assert array["type"] == "raid0"
+
+
+real_popen = execute.popen
+
+BACKENDS = {"fake": FakeSystem, "loop": LoopSystem}
+
+
+def summarize(run_report):
+    """
+    Return the wall time of each phase, with the per-disk partition steps
+    combined, and the number of subprocesses by command.
+    """
+
+    phases = collections.defaultdict(float)
+    for entry in run_report["phases"]:
+        name = entry["phase"].split(":", 1)[0]
+        phases[name] = max(phases[name], entry["elapsed"])
+
+    commands = collections.Counter(
+        os.path.basename(entry["argv"][0]) for entry in run_report["commands"]
+    )
+
+    return {
+        "status": run_report["status"],
+        "elapsed": run_report["elapsed"],
+        "phases": dict(phases),
+        "commands": dict(commands),
+    }
+
+
+def run(system, workdir, **overrides):
+    """
+    Run the whole setup against the given system, and return a summary of the
+    run report. See summarize.
+    """
+
+    config = system.config(workdir, **overrides)
+    os.makedirs(config["mount"]["mount_point"]["path"], exist_ok=True)
+    config_path = os.path.join(workdir, "config.yml")
+    with open(config_path, "w") as f:
+        yaml.safe_dump(config, f)
+
+    devices.topology.reset()
+    with system.attached(workdir), mock.patch.object(
+        sys, "argv", ["ephemeral-storage-setup", config_path]
+    ):
+        cli.main()
+
+    with open(config["report"]["path"]) as f:
+        return summarize(json.load(f))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="fake")
+    parser.add_argument("--disks", type=int, nargs="+", default=[1, 2, 4, 8, 16, 64])
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="simulated latency of each command, in seconds (fake backend)",
+    )
+    args = parser.parse_args()
+
+    results = []
+    for disk_count in args.disks:
+        if args.backend == "fake":
+            system = FakeSystem(disk_count, latency=args.latency)
+        else:
+            system = LoopSystem(disk_count)
+
+        with tempfile.TemporaryDirectory() as workdir:
+            result = run(system, workdir)
+        result["disks"] = disk_count
+        results.append(result)
+        print(json.dumps(result), flush=True)
+
+
+if __name__ == "__main__":
+    main()
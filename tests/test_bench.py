@@ -0,0 +1,55 @@
+import pytest
+from ephemeral_storage_setup import bench
+
+
+@pytest.fixture
+def config(tmp_path):
+    return {
+        "mount": {"mount_point": {"path": str(tmp_path)}},
+        "bench": {
+            # tmpfs doesn't support O_DIRECT.
+            "direct": False,
+            "size": "4M",
+            "runtime": 0.01,
+            "threads": 2,
+            "queue_depths": [1, 4],
+        },
+    }
+
+
+def test_run(config, tmp_path):
+    results = bench.run(config)
+
+    assert [result["job"] for result in results] == [
+        "seq-write",
+        "seq-read",
+        "rand-write",
+        "rand-read",
+        "rand-read-qd1",
+        "rand-read-qd4",
+    ]
+    for result in results:
+        assert result["ops"] > 0
+        assert result["iops"] > 0
+        assert result["lat_p99_us"] >= result["lat_p50_us"]
+        assert result["target"] == str(tmp_path / bench.BENCH_FILE_NAME)
+
+    # The benchmark file is removed afterwards.
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_jobs_device_read_only():
+    names = [job[0] for job in bench.jobs({"queue_depths": []}, is_device=True)]
+    assert names == ["seq-read", "rand-read"]
+
+
+def test_check_thresholds():
+    results = [{"job": "rand-read", "iops": 1000.0, "mbps": 3.9}]
+
+    bench.check_thresholds(results, {"rand-read": {"iops": 500}})
+
+    with pytest.raises(bench.BelowThreshold):
+        bench.check_thresholds(results, {"rand-read": {"iops": 5000}})
+
+    with pytest.raises(bench.BelowThreshold):
+        bench.check_thresholds(results, {"seq-read": {"mbps": 100}})
@@ -0,0 +1,115 @@
+import pytest
+from ephemeral_storage_setup import cache, cli, devices
+
+
+def disk(raw_info):
+    return devices.BlockDevice(
+        dict(
+            {
+                "type": "disk",
+                "model": "Amazon Elastic Block Store",
+                "size": 100 * 1024**3,
+                "pttype": None,
+                "children": [],
+            },
+            **raw_info,
+        )
+    )
+
+
+def test_metadata_size():
+    # 4M, plus 16 bytes per 256K block of a 1T cache, rounded up to 1M.
+    assert cache.metadata_size(1024**4, 256 * 1024) == 68 * 1024**2
+    assert cache.metadata_size(1024**3, 256 * 1024) == 5 * 1024**2
+
+
+def test_tables():
+    metadata_table, data_table, cache_table = cache.tables(
+        "/dev/md/ephemeral", 1024**3, "/dev/nvme1n1", 100 * 1024**3, {}
+    )
+
+    assert metadata_table == "0 10240 linear /dev/md/ephemeral 0"
+    assert data_table == "0 2086912 linear /dev/md/ephemeral 10240"
+    assert cache_table == (
+        "0 209715200 cache /dev/mapper/ephemeral-cache-cmeta "
+        "/dev/mapper/ephemeral-cache-cdata /dev/nvme1n1 512 1 writethrough default 0"
+    )
+
+    _, _, cache_table = cache.tables(
+        "/dev/md/ephemeral",
+        1024**3,
+        "/dev/nvme1n1",
+        100 * 1024**3,
+        {"mode": "writeback", "block_size": "1M"},
+    )
+    assert cache_table.endswith(" 2048 1 writeback default 0")
+
+    with pytest.raises(ValueError):
+        cache.tables("/dev/md0", 1024**3, "/dev/sdb", 1024**3, {"mode": "bogus"})
+
+    with pytest.raises(ValueError):
+        cache.tables("/dev/md0", 1024**3, "/dev/sdb", 1024**3, {"block_size": "48K"})
+
+
+def test_select_origin():
+    root = disk({"path": "/dev/nvme0n1", "pttype": "gpt"})
+    volume = disk({"path": "/dev/nvme1n1", "size": 500 * 1024**3})
+    small = disk({"path": "/dev/nvme2n1"})
+
+    detect_config = {"models": ["Amazon Elastic Block Store"], "min_size": "200G"}
+    assert cache.select_origin([root, volume, small], detect_config) is volume
+
+    with pytest.raises(RuntimeError):
+        cache.select_origin([root, volume, small], {})
+
+
+def test_attach(mocker, tmp_path):
+    mocker.patch("ephemeral_storage_setup.cache.MAPPER_DIR", str(tmp_path))
+    mocker.patch("ephemeral_storage_setup.utils.device_size", return_value=1024**3)
+    mocker.patch("ephemeral_storage_setup.readiness.wait_for_nodes")
+
+    def dmsetup_create(name, table):
+        (tmp_path / name).write_bytes(b"\xff" * 8192)
+
+    mock_create = mocker.patch(
+        "ephemeral_storage_setup.cache.dmsetup_create", side_effect=dmsetup_create
+    )
+
+    path = cache.attach("/dev/md/ephemeral", "/dev/nvme1n1", {}, True)
+
+    assert path == str(tmp_path / "ephemeral-cache")
+    assert [c.args[0] for c in mock_create.call_args_list] == [
+        "ephemeral-cache-cmeta",
+        "ephemeral-cache-cdata",
+        "ephemeral-cache",
+    ]
+    metadata = (tmp_path / "ephemeral-cache-cmeta").read_bytes()
+    assert metadata[:4096] == bytes(4096)
+    assert metadata[4096:] == b"\xff" * 4096
+
+    # Already active: nothing to do.
+    mock_create.reset_mock()
+    assert cache.attach("/dev/md/ephemeral", "/dev/nvme1n1", {}, False) == path
+    mock_create.assert_not_called()
+
+
+@pytest.mark.parametrize("fstype", [None, "xfs"])
+def test_build_pipeline(mocker, fstype):
+    disks = [mocker.Mock(path="/dev/nvme2n1")]
+    origin = disk({"path": "/dev/nvme1n1", "fstype": fstype})
+    config = {"cache": {"mode": "writeback"}, "populate": {}}
+
+    steps = cli.build_pipeline(config, disks, origin=origin)
+
+    requires = {name: step.requires for name, step in steps.steps.items()}
+    assert requires["cache"] == ("assemble",)
+    assert "fstab" not in requires
+    if fstype is None:
+        assert requires["mkfs"] == ("cache",)
+        assert requires["mount"] == ("mkfs",)
+        assert "populate" in requires
+    else:
+        # Existing data on the origin is never formatted or populated.
+        assert "mkfs" not in requires
+        assert "populate" not in requires
+        assert requires["mount"] == ("cache",)
@@ -0,0 +1,233 @@
+import pytest
+from ephemeral_storage_setup import cli, devices, report
+
+NVME = "Amazon EC2 NVMe Instance Storage"
+EBS = "Amazon Elastic Block Store"
+
+
+def disk(mocker, path, model):
+    dev = mocker.Mock(spec=devices.Disk, path=path)
+    dev.is_initialized.return_value = False
+    dev.matches_config.side_effect = lambda config: model in config.get(
+        "models", [NVME, EBS]
+    )
+    return dev
+
+
+@pytest.fixture
+def pools_config():
+    return {
+        "mkfs": {"type": "xfs"},
+        "pools": [
+            {
+                "detect": {"models": [NVME]},
+                "mdraid": {"name": "ephemeral"},
+            },
+            {
+                "detect": {"models": [EBS]},
+                "mdraid": {"name": "ebs"},
+                "mkfs": {"type": "ext4"},
+                "optional": True,
+            },
+        ],
+    }
+
+
+def test_pool_configs(pools_config):
+    assert cli.pool_configs({"mdraid": {"name": "md"}}) == [{"mdraid": {"name": "md"}}]
+
+    nvme, ebs = cli.pool_configs(pools_config)
+    assert nvme["mkfs"] == {"type": "xfs"}
+    assert ebs["mkfs"] == {"type": "ext4"}
+    assert "pools" not in nvme
+
+    pools_config["pools"][1]["mdraid"]["name"] = "ephemeral"
+    with pytest.raises(ValueError):
+        cli.pool_configs(pools_config)
+
+
+def test_find_disks(mocker, pools_config):
+    devs = [
+        disk(mocker, "/dev/nvme0n1", EBS),
+        disk(mocker, "/dev/nvme1n1", NVME),
+        disk(mocker, "/dev/nvme2n1", NVME),
+    ]
+    mocker.patch("ephemeral_storage_setup.devices.scan_devices", return_value=devs)
+
+    # A catch-all pool after a specific one only gets the remaining disks.
+    pools = cli.pool_configs(pools_config) + [{"mdraid": {"name": "rest"}}]
+    (nvme, ebs, rest), origins = cli.find_disks(pools)
+
+    assert [d.path for d in nvme] == ["/dev/nvme1n1", "/dev/nvme2n1"]
+    assert [d.path for d in ebs] == ["/dev/nvme0n1"]
+    assert rest == []
+    assert origins == [None, None, None]
+
+
+def test_build_pools(mocker, pools_config):
+    pools = cli.pool_configs(pools_config)
+    nvme_disks = [disk(mocker, "/dev/nvme1n1", NVME)]
+
+    steps = cli.build_pools(pools_config, pools, [nvme_disks, []], [None, None])
+    assert "ephemeral:partition:/dev/nvme1n1" in steps.steps
+    assert not any(name.startswith("ebs:") for name in steps.steps)
+    assert steps.steps["ephemeral:mkfs"].requires == ("ephemeral:assemble",)
+
+    # Only optional pools may be empty.
+    pools[1]["optional"] = False
+    with pytest.raises(RuntimeError):
+        cli.build_pools(pools_config, pools, [nvme_disks, []], [None, None])
+
+    steps = cli.build_pools(
+        pools_config, pools, [nvme_disks, []], [None, None], allow_empty=True
+    )
+    assert "ebs:assemble" in steps.steps
+
+
+def test_find_disks_wait(mocker):
+    late = disk(mocker, "/dev/nvme2n1", NVME)
+    late.raw_info = {"size": 1024**3}
+    early = disk(mocker, "/dev/nvme1n1", NVME)
+    early.raw_info = {"size": 1024**3}
+    mocker.patch(
+        "ephemeral_storage_setup.devices.scan_devices",
+        side_effect=[[early], [early, late]],
+    )
+    wait_for = mocker.spy(cli.hotplug, "wait_for")
+    mocker.patch("ephemeral_storage_setup.hotplug.open_events", return_value=None)
+    mocker.patch("ephemeral_storage_setup.hotplug.POLL_INTERVAL", 0.01)
+
+    config = {"wait": {"disks": 2, "size": "2G", "timeout": 5}}
+    (disks,), origins = cli.find_disks([config])
+
+    assert disks == [early, late]
+    assert wait_for.call_args.args[1:] == (5.0, 0.0)
+
+
+def test_find_disks_wait_timeout(mocker):
+    mocker.patch("ephemeral_storage_setup.devices.scan_devices", return_value=[])
+    mocker.patch("ephemeral_storage_setup.hotplug.open_events", return_value=None)
+
+    config = {"wait": {"disks": 1, "timeout": 0}}
+    assert cli.find_disks([config]) == ([[]], [None])
+
+    config["wait"]["on_timeout"] = "fail"
+    with pytest.raises(RuntimeError):
+        cli.find_disks([config])
+
+
+@pytest.fixture
+def numa_config():
+    return {
+        "mdraid": {"name": "ephemeral"},
+        "mount": {"mount_point": {"path": "/mnt/ephemeral"}},
+        "numa": {},
+    }
+
+
+def test_split_numa(mocker, numa_config):
+    disks = [disk(mocker, f"/dev/nvme{i}n1", NVME) for i in range(3)]
+    for i, dev in enumerate(disks):
+        dev.raw_info = {"kname": f"nvme{i}n1"}
+    nodes = {"nvme0n1": 1, "nvme1n1": 0, "nvme2n1": 1}
+    mocker.patch(
+        "ephemeral_storage_setup.numa.device_node", side_effect=nodes.__getitem__
+    )
+
+    pools, pool_disks, origins = cli.split_numa([numa_config], [disks], [None])
+
+    assert [cli.pool_name(pool) for pool in pools] == [
+        "ephemeral-node0",
+        "ephemeral-node1",
+    ]
+    assert [pool["mount"]["mount_point"]["path"] for pool in pools] == [
+        "/mnt/ephemeral-node0",
+        "/mnt/ephemeral-node1",
+    ]
+    assert [pool["numa_node"] for pool in pools] == [0, 1]
+    assert pool_disks == [[disks[1]], [disks[0], disks[2]]]
+    assert origins == [None, None]
+
+    steps = cli.build_pools(numa_config, pools, pool_disks, origins)
+    assert "ephemeral-node1:partition:/dev/nvme2n1" in steps.steps
+
+    # Empty pools are left as they are, for build_pools to report.
+    assert cli.split_numa([numa_config], [[]], [None]) == (
+        [numa_config],
+        [[]],
+        [None],
+    )
+
+
+def test_numa_pool_templates(numa_config):
+    numa_config["numa"] = {"name": "scratch{node}", "mount_point": "/scratch/{node}"}
+
+    pool = cli.numa_pool(numa_config, 1)
+    assert cli.pool_name(pool) == "scratch1"
+    assert pool["mount"]["mount_point"]["path"] == "/scratch/1"
+    assert "numa" not in pool
+
+    numa_config["cache"] = {}
+    with pytest.raises(ValueError):
+        cli.numa_pool(numa_config, 1)
+
+
+def test_resume_numa_pool(mocker, numa_config):
+    mocker.patch("ephemeral_storage_setup.numa.online_nodes", return_value=[0, 1])
+    mocker.patch("ephemeral_storage_setup.numa.cpulist", return_value="0-15")
+    load_state = mocker.patch(
+        "ephemeral_storage_setup.resume.load_state",
+        return_value={"arrays": {"ephemeral-node0": {}}},
+    )
+    resume = mocker.patch("ephemeral_storage_setup.resume.resume", return_value=True)
+    run_report = report.reset()
+
+    # Only the node with saved state is resumed.
+    assert cli.resume_pool(numa_config)
+    assert [cli.pool_name(c.args[0]) for c in resume.call_args_list] == [
+        "ephemeral-node0"
+    ]
+    assert run_report.sections["numa"] == {
+        "ephemeral-node0": {
+            "node": 0,
+            "cpulist": "0-15",
+            "mount_point": "/mnt/ephemeral-node0",
+        }
+    }
+
+    resume.return_value = False
+    assert not cli.resume_pool(numa_config)
+
+    load_state.return_value = None
+    assert not cli.resume_pool(numa_config)
+
+
+@pytest.mark.parametrize("iops,exit_code", [(1000, None), (10, 2)])
+def test_bench_check(mocker, iops, exit_code):
+    mocker.patch(
+        "sys.argv", ["ephemeral-storage-setup", "bench", "--check", "config.yml"]
+    )
+    mocker.patch(
+        "ephemeral_storage_setup.cli.load_config",
+        return_value={"bench": {"thresholds": {"randread": {"iops": 100}}}},
+    )
+    mocker.patch(
+        "ephemeral_storage_setup.bench.run",
+        return_value=[{"job": "randread", "iops": iops}],
+    )
+    mocker.patch.object(cli.logger, "addHandler")
+    mocker.patch.object(cli.logger, "setLevel")
+    mock_error = mocker.patch.object(cli.logger, "error")
+
+    if exit_code is None:
+        cli.cli()
+    else:
+        with pytest.raises(SystemExit) as excinfo:
+            cli.cli()
+        assert excinfo.value.code == exit_code
+
+    # A failed check is a result, not an unhandled exception.
+    assert all(
+        call.args[0] != "unhandled exception; exiting"
+        for call in mock_error.call_args_list
+    )
@@ -0,0 +1,149 @@
+import os.path
+
+import pytest
+from ephemeral_storage_setup import bench, cli, crypt, devices, sysfs
+
+KEY = bytes(range(64))
+
+
+def test_table():
+    assert crypt.table("/dev/md127", 10 * 4096 + 512, KEY, {}) == (
+        f"0 80 crypt aes-xts-plain64 {KEY.hex()} 0 /dev/md127 0 "
+        "3 sector_size:4096 no_read_workqueue no_write_workqueue"
+    )
+
+    config = {
+        "cipher": "aes-cbc-essiv:sha256",
+        "sector_size": 512,
+        "no_read_workqueue": False,
+        "no_write_workqueue": False,
+    }
+    assert crypt.table("/dev/md127", 4096, KEY, config) == (
+        f"0 8 crypt aes-cbc-essiv:sha256 {KEY.hex()} 0 /dev/md127 0"
+    )
+
+    with pytest.raises(ValueError):
+        crypt.options({"sector_size": 8192})
+
+
+def test_generate_key():
+    assert len(crypt.generate_key({})) == 64
+    assert crypt.generate_key({}) != crypt.generate_key({})
+    with pytest.raises(ValueError):
+        crypt.generate_key({"key_size": 255})
+
+
+def test_device_name():
+    assert crypt.device_name({}, "ephemeral") == "ephemeral-crypt"
+    assert crypt.device_name({"name": "secret"}, "ephemeral", 2) == "secret-2"
+
+
+def test_create(mocker):
+    mock_execute_simple = mocker.patch("ephemeral_storage_setup.execute.simple")
+    mocker.patch("ephemeral_storage_setup.utils.device_size", return_value=1024**3)
+    mocker.patch("ephemeral_storage_setup.crypt.generate_key", return_value=KEY)
+    mocker.patch("ephemeral_storage_setup.readiness.wait_for_nodes")
+    scan_devices = mocker.patch("ephemeral_storage_setup.devices.scan_devices")
+
+    device = crypt.create("ephemeral-crypt", "/dev/md127", {})
+
+    # The key is only passed on stdin.
+    mock_execute_simple.assert_called_once_with(
+        [
+            "dmsetup",
+            "create",
+            "ephemeral-crypt",
+            "--uuid",
+            "CRYPT-PLAIN-ephemeral-crypt",
+        ],
+        input=crypt.table("/dev/md127", 1024**3, KEY, {}),
+    )
+    scan_devices.assert_called_once_with("/dev/mapper/ephemeral-crypt")
+    assert device is scan_devices.return_value[0]
+
+
+def test_create_scans_crypt_device(mocker, tmp_path):
+    """
+    The created device is classified as a crypt device by the scanner, from
+    the device-mapper UUID dmsetup is given.
+    """
+
+    dm_path = tmp_path / "sys" / "devices" / "virtual" / "block" / "dm-0"
+    dm_path.mkdir(parents=True)
+    for block_dir in ["block", "class/block"]:
+        (tmp_path / "sys" / block_dir).mkdir(parents=True)
+        (tmp_path / "sys" / block_dir / "dm-0").symlink_to(dm_path)
+    udev_dir = tmp_path / "run" / "udev" / "data"
+    udev_dir.mkdir(parents=True)
+    mapper_dir = tmp_path / "dev" / "mapper"
+    mapper_dir.mkdir(parents=True)
+    (mapper_dir / "ephemeral-crypt").symlink_to(tmp_path / "dev" / "dm-0")
+
+    def dmsetup(argv, input=None):
+        (dm_path / "dm").mkdir()
+        dm_uuid = argv[argv.index("--uuid") + 1] if "--uuid" in argv else ""
+        (dm_path / "dm" / "uuid").write_text(f"{dm_uuid}\n")
+        (dm_path / "dev").write_text("253:0\n")
+        (dm_path / "size").write_text("2097152\n")
+        (udev_dir / "b253:0").write_text("E:DM_NAME=ephemeral-crypt\n")
+
+    mocker.patch("ephemeral_storage_setup.execute.simple", side_effect=dmsetup)
+    mocker.patch("ephemeral_storage_setup.utils.device_size", return_value=1024**3)
+    mocker.patch("ephemeral_storage_setup.readiness.wait_for_nodes")
+    mocker.patch("ephemeral_storage_setup.crypt.MAPPER_DIR", str(mapper_dir))
+    mocker.patch("ephemeral_storage_setup.devices.scanner", "sysfs")
+    mocker.patch(
+        "ephemeral_storage_setup.sysfs.scan_devices_raw",
+        side_effect=lambda known_types, device_path=None: sysfs.Scanner(
+            known_types, root=str(tmp_path)
+        ).scan(device_path and os.path.realpath(device_path)),
+    )
+    device = crypt.create("ephemeral-crypt", "/dev/md127", {})
+
+    assert isinstance(device, devices.Crypt)
+    assert device.raw_info["size"] == 1024**3
+
+
+@pytest.mark.parametrize("layout", ["array", "members"])
+def test_build_pipeline(mocker, layout):
+    disks = [mocker.Mock(path="/dev/nvme1n1"), mocker.Mock(path="/dev/nvme2n1")]
+    config = {
+        "mount": {"mount_point": {"path": "/mnt"}},
+        "crypt": {"layout": layout},
+    }
+
+    steps = cli.build_pipeline(config, disks)
+    requires = {name: step.requires for name, step in steps.steps.items()}
+
+    # Encrypted filesystems can't be mounted on boot.
+    assert "fstab" not in requires
+    if layout == "array":
+        assert requires["crypt"] == ("assemble",)
+        assert requires["mkfs"] == ("crypt",)
+    else:
+        assert requires["crypt:/dev/nvme1n1"] == ("partitions",)
+        assert requires["assemble"] == ("crypt:/dev/nvme1n1", "crypt:/dev/nvme2n1")
+        assert requires["mkfs"] == ("assemble",)
+
+    with pytest.raises(ValueError):
+        cli.build_pipeline(dict(config, cache={}), disks, origin=disks[0])
+
+
+def test_compare_encryption(mocker):
+    mocker.patch(
+        "ephemeral_storage_setup.crypt.backing_device", return_value="/dev/md127"
+    )
+
+    def run(config, target):
+        assert config["bench"]["allow_device_write"] is False
+        iops = 1000.0 if target == "/dev/md127" else 800.0
+        return [{"job": "rand-read", "iops": iops, "lat_p99_us": 100.0}]
+
+    mocker.patch("ephemeral_storage_setup.bench.run", side_effect=run)
+
+    config = {"crypt": {}, "bench": {"allow_device_write": True}}
+    (result,) = bench.compare_encryption(config)
+
+    assert result["iops"] == 800.0
+    assert result["plaintext"]["iops"] == 1000.0
+    assert result["overhead_pct"] == 20.0
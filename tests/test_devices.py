@@ -1,3 +1,5 @@
+import json
+
 import pytest
 from ephemeral_storage_setup import devices
 
@@ -19,3 +21,221 @@ def test_scan_devices(mocker, fake_lsblk_output):
 
     assert len(devs) > 0
     assert "/dev/nvme0n1" in [dev.path for dev in devs]
+
+
+def fake_partitioned_lsblk_output(partition_guids):
+    """
+    Build lsblk output for disks that each have a single partition with the
+    given partition GUID.
+    """
+
+    blockdevices = []
+    for disk_path, partition_guid in partition_guids.items():
+        blockdevices.append(
+            {
+                "path": disk_path,
+                "type": "disk",
+                "children": [
+                    {
+                        "path": f"{disk_path}p1",
+                        "type": "part",
+                        "partuuid": partition_guid.upper(),
+                    },
+                ],
+            }
+        )
+
+    return json.dumps({"blockdevices": blockdevices})
+
+
+def test_partition_disks(mocker, fake_lsblk_output):
+    mock_wait_for_nodes = mocker.patch(
+        "ephemeral_storage_setup.readiness.wait_for_nodes"
+    )
+    mocker.patch(
+        "ephemeral_storage_setup.devices.get_lsblk_output",
+        return_value=fake_lsblk_output,
+    )
+    disks = [
+        dev
+        for dev in devices.scan_devices()
+        if isinstance(dev, devices.Disk) and not dev.is_initialized()
+    ]
+    assert len(disks) == 2
+
+    partition_guids = {}
+
+    def fake_create_single_partition(dev_path, partition_guid, **kwargs):
+        partition_guids[dev_path] = partition_guid
+
+    mocker.patch(
+        "ephemeral_storage_setup.utils.create_single_partition",
+        side_effect=fake_create_single_partition,
+    )
+    mock_get_lsblk_output = mocker.patch(
+        "ephemeral_storage_setup.devices.get_lsblk_output",
+        side_effect=lambda *args: fake_partitioned_lsblk_output(partition_guids),
+    )
+
+    # Like the pipeline: one partition step per disk, then a single resolution.
+    written = {disk.path: disk.write_single_partition() for disk in disks}
+    assert written == partition_guids
+    partitions = devices.resolve_partitions(disks, written)
+
+    assert [p.path for p in partitions] == [f"{d.path}p1" for d in disks]
+    assert all(isinstance(p, devices.Partition) for p in partitions)
+    mock_get_lsblk_output.assert_called_once_with(None)
+    assert devices.topology.scan_count == 2  # Initial scan, and resolution.
+
+    # A single wait for all the new partition nodes.
+    mock_wait_for_nodes.assert_called_once()
+    (nodes,) = mock_wait_for_nodes.call_args.args
+    assert sorted(nodes) == sorted(
+        f"/dev/disk/by-partuuid/{guid}" for guid in partition_guids.values()
+    )
+
+
+def test_resolve_partitions_missing(mocker):
+    mocker.patch("ephemeral_storage_setup.readiness.wait_for_nodes")
+    partition_guids = {
+        "/dev/nvme1n1": "11111111-1111-1111-1111-111111111111",
+        "/dev/nvme2n1": "22222222-2222-2222-2222-222222222222",
+    }
+    mocker.patch(
+        "ephemeral_storage_setup.devices.get_lsblk_output",
+        return_value=fake_partitioned_lsblk_output(
+            {"/dev/nvme1n1": partition_guids["/dev/nvme1n1"]}
+        ),
+    )
+    disks = [mocker.Mock(path=path) for path in partition_guids]
+
+    with pytest.raises(devices.PartitionError) as excinfo:
+        devices.resolve_partitions(disks, partition_guids)
+
+    assert list(excinfo.value.errors) == ["/dev/nvme2n1"]
+
+
+def test_topology_snapshot(mocker, fake_lsblk_output):
+    mock_get_lsblk_output = mocker.patch(
+        "ephemeral_storage_setup.devices.get_lsblk_output",
+        return_value=fake_lsblk_output,
+    )
+
+    devs = devices.scan_devices()
+    assert devices.topology.scan_count == 1
+
+    # Property reads are served from the snapshot.
+    root_disk = [dev for dev in devs if dev.path == "/dev/nvme0n1"][0]
+    for _ in range(3):
+        (partition,) = root_disk.children
+        assert partition.partuuid == "24ca9e81-01"
+        assert partition.uuid == "436cf32d-5e3d-46ca-b557-f870c8a25794"
+    assert devices.topology.scan_count == 1
+    mock_get_lsblk_output.assert_called_once_with(None)
+
+    # Invalidation causes exactly one new scan.
+    generation = devices.topology.generation
+    devices.topology.invalidate("test")
+    assert devices.topology.generation == generation + 1
+    assert partition.partuuid == "24ca9e81-01"
+    assert partition.uuid == "436cf32d-5e3d-46ca-b557-f870c8a25794"
+    assert devices.topology.scan_count == 2
+
+
+def test_create_mdraid(mocker):
+    mock_execute_simple = mocker.patch("ephemeral_storage_setup.execute.run_sync")
+    mocker.patch("ephemeral_storage_setup.readiness.wait_for_nodes")
+    mocker.patch("os.stat", return_value=mocker.Mock(st_mode=0o60660))
+    mocker.patch(
+        "ephemeral_storage_setup.devices.get_lsblk_output",
+        return_value=json.dumps(
+            {"blockdevices": [{"path": "/dev/md/ephemeral", "type": "raid0"}]}
+        ),
+    )
+
+    members = [
+        devices.BlockDevice(
+            {"path": f"/dev/nvme{i}n1p1", "type": "part", "phy-sec": 512, "opt-io": 0}
+        )
+        for i in range(2)
+    ]
+
+    mdraid = devices.create_mdraid(members, {"name": "ephemeral"})
+
+    assert isinstance(mdraid, devices.MDRaid)
+    mock_execute_simple.assert_called_once_with(
+        [
+            "mdadm",
+            "--create",
+            "ephemeral",
+            "--homehost=any",
+            "--level=0",
+            "--chunk=512K",
+            "--raid-devices=2",
+            "/dev/nvme0n1p1",
+            "/dev/nvme1n1p1",
+        ],
+        retry=mocker.ANY,
+    )
+
+    devices.create_mdraid(members, {"name": "ephemeral", "chunk": "64K"})
+    assert "--chunk=64K" in mock_execute_simple.call_args.args[0]
+
+
+def test_create_mdraid_redundant(mocker):
+    mock_run_sync = mocker.patch("ephemeral_storage_setup.execute.run_sync")
+    mocker.patch("ephemeral_storage_setup.readiness.wait_for_nodes")
+    mocker.patch("os.stat", return_value=mocker.Mock(st_mode=0o60660))
+    mocker.patch(
+        "ephemeral_storage_setup.devices.get_lsblk_output",
+        return_value=json.dumps(
+            {"blockdevices": [{"path": "/dev/md/ephemeral", "type": "raid5"}]}
+        ),
+    )
+
+    members = [
+        devices.BlockDevice(
+            {"path": f"/dev/nvme{i}n1p1", "type": "part", "phy-sec": 512, "opt-io": 0}
+        )
+        for i in range(3)
+    ]
+    config = {
+        "name": "ephemeral",
+        "level": 5,
+        "resync": "assume-clean",
+        "bitmap": "internal",
+        "bitmap_chunk": "64M",
+    }
+
+    devices.create_mdraid(members, config)
+
+    argv = mock_run_sync.call_args.args[0]
+    assert "--assume-clean" in argv
+    assert "--bitmap=internal" in argv
+    assert "--bitmap-chunk=65536K" in argv
+
+    with pytest.raises(ValueError):
+        devices.create_mdraid(members[:2], config)
+
+    with pytest.raises(ValueError):
+        devices.create_mdraid(members, dict(config, resync="bogus"))
+
+
+def test_matches_config():
+    raw_info = {
+        "model": "Amazon EC2 NVMe Instance Storage",
+        "size": 1024**4,
+        "tran": "nvme",
+        "rota": False,
+    }
+    disk = devices.BlockDevice(dict(raw_info, type="disk"))
+
+    assert disk.matches_config({})
+    assert disk.matches_config({"transports": ["nvme"], "rotational": False})
+    assert not disk.matches_config({"transports": ["sata", "sas"]})
+    assert not disk.matches_config({"rotational": True})
+    assert not disk.matches_config({"min_size": "2T"})
+
+    # Older lsblk versions report the rotational flag as a string.
+    hdd = devices.BlockDevice(dict(raw_info, type="disk", tran="sata", rota="1"))
+    assert hdd.matches_config({"rotational": True})
@@ -0,0 +1,70 @@
+import asyncio
+import sys
+import time
+
+import pytest
+from ephemeral_storage_setup import execute, report
+
+
+def python(code):
+    return [sys.executable, "-c", code]
+
+
+def test_run():
+    stdout, stderr = execute.run_sync(
+        python("import sys; print('a'); print('b'); print('c', file=sys.stderr)")
+    )
+    assert stdout == "a\nb"
+    assert stderr == "c"
+
+
+def test_run_nonzero():
+    with pytest.raises(execute.NonZeroExitException):
+        execute.run_sync(python("raise SystemExit(3)"))
+
+
+def test_run_timeout():
+    with pytest.raises(execute.TimeoutException):
+        execute.run_sync(python("import time; time.sleep(10)"), timeout=0.2)
+
+
+def test_run_retry(tmp_path):
+    # Fails with "busy" on the first attempt, succeeds on the second.
+    marker = tmp_path / "marker"
+    code = (
+        "import os, sys\n"
+        f"if not os.path.exists({str(marker)!r}):\n"
+        f"    open({str(marker)!r}, 'w').close()\n"
+        "    sys.exit('mdadm: cannot open /dev/sda1: Device or resource busy')\n"
+        "print('ok')\n"
+    )
+
+    retry = execute.Retry(attempts=2, delay=0.01)
+    assert execute.run_sync(python(code), retry=retry) == ("ok", "")
+
+    # Other failures are not retried.
+    with pytest.raises(execute.NonZeroExitException):
+        execute.run_sync(python("raise SystemExit('other')"), retry=retry)
+
+
+def test_run_all():
+    results = execute.run_all_sync([python(f"print({i})") for i in range(4)])
+    assert [stdout for stdout, _ in results] == ["0", "1", "2", "3"]
+
+
+def test_run_all_concurrent():
+    start = time.monotonic()
+    asyncio.run(
+        execute.run_all([python("import time; time.sleep(0.3)") for _ in range(3)])
+    )
+    assert time.monotonic() - start < 0.8
+
+
+def test_simple_input():
+    run_report = report.reset()
+    stdout, _ = execute.simple(
+        python("import sys; print(sys.stdin.read().upper())"), input="secret"
+    )
+
+    assert stdout == "SECRET"
+    assert "secret" not in str(run_report.to_dict())
@@ -0,0 +1,97 @@
+import pytest
+from ephemeral_storage_setup import geometry
+
+
+@pytest.mark.parametrize(
+    "level,member_count,expected",
+    [
+        (0, 1, 1),
+        (0, 8, 8),
+        ("raid0", 24, 24),
+        (1, 2, 1),
+        (10, 8, 4),
+        (5, 4, 3),
+        (6, 6, 4),
+    ],
+)
+def test_data_disk_count(level, member_count, expected):
+    assert geometry.data_disk_count(level, member_count) == expected
+
+
+@pytest.mark.parametrize(
+    "members_raw,expected",
+    [
+        # NVMe instance storage: no optimal I/O size reported.
+        ([{"phy-sec": 512, "opt-io": 0}] * 2, 512 * 1024),
+        # EBS: small optimal I/O size.
+        ([{"phy-sec": 4096, "opt-io": 4096}], 512 * 1024),
+        # Large optimal I/O size, rounded up to a power of two.
+        ([{"phy-sec": 4096, "opt-io": 768 * 1024}], 1024 * 1024),
+        # Capped at the maximum.
+        ([{"phy-sec": 4096, "opt-io": 64 * 1024**2}], geometry.MAX_CHUNK_SIZE),
+        # Members with a large minimum I/O size.
+        ([{"phy-sec": 4096, "min-io": 1024**2, "opt-io": 0}], 1024**2),
+    ],
+)
+def test_choose_chunk_size(members_raw, expected):
+    assert geometry.choose_chunk_size(members_raw) == expected
+
+
+NVME = {"phy-sec": 512, "min-io": 512, "opt-io": 0}
+
+
+@pytest.mark.parametrize(
+    "level,member_count,min_io,expected",
+    [
+        # Up to 8 data disks, the default chunk fits the full stripe limit.
+        (0, 8, 512, 512 * 1024),
+        # More data disks: smaller chunks, to bound the full stripe.
+        (0, 16, 512, 256 * 1024),
+        (0, 24, 512, 128 * 1024),
+        # Only data disks count: 16 members in RAID 10 hold 8 data disks.
+        (10, 16, 512, 512 * 1024),
+        (6, 10, 512, 512 * 1024),
+        (5, 17, 512, 256 * 1024),
+        # Never below the members' minimum I/O size, or the lower bound.
+        (0, 24, 512 * 1024, 512 * 1024),
+        (0, 128, 512, geometry.MIN_CHUNK_SIZE),
+    ],
+)
+def test_choose_chunk_size_members(level, member_count, min_io, expected):
+    members_raw = [dict(NVME, **{"min-io": min_io})] * member_count
+    assert geometry.choose_chunk_size(members_raw, level) == expected
+
+
+def test_device_stripe():
+    raw_info = {"min-io": 512 * 1024, "opt-io": 4 * 512 * 1024}
+    stripe = geometry.device_stripe(raw_info)
+    assert stripe == (512 * 1024, 2048 * 1024)
+    assert geometry.ext4_stripe(stripe) == (128, 512)
+
+    assert geometry.device_stripe({"min-io": 512, "opt-io": 0}) is None
+
+
+def test_levels():
+    assert not geometry.is_redundant(0)
+    assert geometry.is_redundant("raid10")
+    assert geometry.has_parity(5)
+    assert not geometry.has_parity(10)
+    assert geometry.min_members("raid5") == 3
+
+    with pytest.raises(ValueError):
+        geometry.min_members(7)
+
+
+@pytest.mark.parametrize(
+    "member_count,memory,expected",
+    [
+        (4, 16 * 1024**3, 16384),
+        (8, 4 * 1024**3, 2048),
+        # Capped at the maximum.
+        (4, 1024**4, geometry.MAX_STRIPE_CACHE_SIZE),
+        # Never below the kernel default.
+        (24, 2 * 1024**3, geometry.MIN_STRIPE_CACHE_SIZE),
+    ],
+)
+def test_stripe_cache_size(member_count, memory, expected):
+    assert geometry.stripe_cache_size(member_count, memory) == expected
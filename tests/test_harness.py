@@ -0,0 +1,54 @@
+import os
+
+import pytest
+from tests import harness
+
+
+@pytest.mark.parametrize("disk_count", [1, 2, 8, 64])
+def test_fake(tmp_path, disk_count):
+    system = harness.FakeSystem(disk_count)
+    result = harness.run(system, str(tmp_path))
+    system.verify(disk_count)
+
+    assert result["status"] == "ok"
+    assert (tmp_path / "mnt" / "some" / "deep" / "path").is_dir()
+    assert "UUID=" in (tmp_path / "fstab").read_text()
+
+    # Per-disk work is one sgdisk each; everything else must not grow with
+    # the number of disks.
+    commands = result["commands"]
+    assert commands.pop("sgdisk") == disk_count
+    assert commands == {
+        "lsblk": 4,
+        "udevadm": 3,
+        "mdadm": 1,
+        "mkfs.ext4": 1,
+        "mount": 1,
+    }
+
+    for phase in ("partition", "partitions", "assemble", "mkfs", "mount", "populate"):
+        assert phase in result["phases"]
+
+
+def test_fake_overlaps_partitioning(tmp_path):
+    # With a simulated latency per command, partitioning 8 disks takes about
+    # as long as one, since the disks are partitioned concurrently.
+    latency = 0.05
+    result = harness.run(harness.FakeSystem(8, latency=latency), str(tmp_path))
+
+    assert result["phases"]["partition"] < latency * 4
+
+
+@pytest.mark.slow
+@pytest.mark.skipif(
+    not harness.LoopSystem.available(), reason="needs root and the setup commands"
+)
+@pytest.mark.parametrize("disk_count", [1, 2, 5])
+def test_loop(tmp_path, disk_count):
+    system = harness.LoopSystem(disk_count, disk_size=256 * 1024**2)
+    result = harness.run(system, str(tmp_path))
+    system.verify(disk_count)
+
+    assert result["status"] == "ok"
+    assert result["commands"]["sgdisk"] == disk_count
+    assert os.path.isdir(tmp_path / "mnt" / "some" / "deep" / "path")
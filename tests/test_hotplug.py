@@ -0,0 +1,92 @@
+import struct
+
+from ephemeral_storage_setup import hotplug
+
+
+class FakeEvents:
+    """
+    Event source returning the given results of wait(), then no events.
+    """
+
+    def __init__(self, results):
+        self.results = list(results)
+        self.closed = False
+
+    def wait(self, timeout):
+        if self.results:
+            return self.results.pop(0)
+        return False
+
+    def close(self):
+        self.closed = True
+
+
+def test_is_block_event():
+    kernel = (
+        b"add@/devices/pci0000:00/nvme/nvme1/nvme1n1\0ACTION=add\0SUBSYSTEM=block\0"
+    )
+    assert hotplug.is_block_event(kernel)
+    assert not hotplug.is_block_event(b"add@/module/loop\0SUBSYSTEM=module\0")
+
+    # Built like libudev's struct udev_monitor_netlink_header: the magic and
+    # filter hashes in network byte order, everything else in host order.
+    properties = b"ACTION=add\0DEVNAME=/dev/nvme1n1\0SUBSYSTEM=block\0"
+    header = (
+        hotplug.UDEV_HEADER_PREFIX
+        + struct.pack(">I", 0xFEEDCAFE)
+        + struct.pack("=III", 40, 40, len(properties))
+        + struct.pack(">II", 0x12345678, 0)
+        + struct.pack("=II", 0, 0)
+    )
+    assert len(header) == 40
+    assert hotplug.is_block_event(header + properties)
+
+
+def test_satisfied(mocker):
+    disks = [mocker.Mock(raw_info={"size": 1024**3}) for _ in range(2)]
+
+    assert hotplug.satisfied([], None)
+    assert hotplug.satisfied(disks, {})
+    assert not hotplug.satisfied([], {})
+    assert hotplug.satisfied(disks, {"disks": 2, "size": "2G"})
+    assert not hotplug.satisfied(disks, {"disks": 3})
+    assert not hotplug.satisfied(disks, {"size": "3G"})
+
+
+def test_wait_for_event(mocker):
+    events = FakeEvents([True])
+    mocker.patch("ephemeral_storage_setup.hotplug.open_events", return_value=events)
+    check = mocker.Mock(side_effect=[(False, 1), (True, 2)])
+
+    assert hotplug.wait_for(check, timeout=5) == (True, 2)
+    assert check.call_count == 2
+    assert events.closed
+
+
+def test_wait_for_timeout(mocker):
+    mocker.patch(
+        "ephemeral_storage_setup.hotplug.open_events", return_value=FakeEvents([])
+    )
+    check = mocker.Mock(return_value=(False, None))
+
+    assert hotplug.wait_for(check, timeout=0.05) == (False, None)
+
+
+def test_wait_for_settle(mocker):
+    # A straggler event during the settle window causes another scan.
+    mocker.patch(
+        "ephemeral_storage_setup.hotplug.open_events",
+        return_value=FakeEvents([True]),
+    )
+    check = mocker.Mock(side_effect=[(True, 1), (True, 2)])
+
+    assert hotplug.wait_for(check, timeout=5, settle=0.05) == (True, 2)
+
+    # Without events during the settle window, the first result stands.
+    mocker.patch(
+        "ephemeral_storage_setup.hotplug.open_events", return_value=FakeEvents([])
+    )
+    check = mocker.Mock(return_value=(True, 1))
+
+    assert hotplug.wait_for(check, timeout=5, settle=0.05) == (True, 1)
+    assert check.call_count == 1
@@ -0,0 +1,44 @@
+import pytest
+from ephemeral_storage_setup import numa
+
+
+@pytest.fixture
+def sysfs(mocker, tmp_path):
+    node_dir = tmp_path / "node"
+    for node, cpus in [(0, "0-15,32-47"), (1, "16-31,48-63")]:
+        (node_dir / f"node{node}").mkdir(parents=True)
+        (node_dir / f"node{node}" / "cpulist").write_text(f"{cpus}\n")
+    (node_dir / "online").write_text("0-1\n")
+
+    block_dir = tmp_path / "block"
+    for kname, node in [("nvme0n1", "0"), ("nvme1n1", "1"), ("xvda", "-1")]:
+        (block_dir / kname / "device").mkdir(parents=True)
+        (block_dir / kname / "device" / "numa_node").write_text(f"{node}\n")
+
+    mocker.patch("ephemeral_storage_setup.numa.NODE_DIR", str(node_dir))
+    mocker.patch("ephemeral_storage_setup.numa.SYSFS_BLOCK_DIR", str(block_dir))
+    return tmp_path
+
+
+def test_parse_list():
+    assert numa.parse_list("0\n") == [0]
+    assert numa.parse_list("0-3,8,10-11") == [0, 1, 2, 3, 8, 10, 11]
+    assert numa.parse_list("\n") == []
+
+
+def test_online_nodes(sysfs):
+    assert numa.online_nodes() == [0, 1]
+
+    (sysfs / "node" / "online").unlink()
+    assert numa.online_nodes() == [0]
+
+
+def test_cpulist(sysfs):
+    assert numa.cpulist(1) == "16-31,48-63"
+
+
+def test_device_node(sysfs):
+    assert numa.device_node("nvme0n1") == 0
+    assert numa.device_node("nvme1n1") == 1
+    assert numa.device_node("xvda") == 0
+    assert numa.device_node("loop0") == 0
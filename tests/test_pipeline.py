@@ -0,0 +1,204 @@
+import threading
+
+import pytest
+from ephemeral_storage_setup import cli, pipeline, report
+
+
+@pytest.fixture
+def run_report():
+    return report.reset()
+
+
+def test_run_order_and_results(run_report):
+    steps = pipeline.Pipeline()
+    steps.add("a", lambda results: 1)
+    steps.add("b", lambda results: results["a"] + 1, requires=["a"])
+    steps.add("c", lambda results: results["a"] + results["b"], requires=["a", "b"])
+
+    assert steps.run() == {"a": 1, "b": 2, "c": 3}
+    assert [entry["phase"] for entry in run_report.phases] == ["a", "b", "c"]
+    assert run_report.phases[2]["requires"] == ["a", "b"]
+
+
+def test_run_overlaps_independent_steps(run_report):
+    # Both steps must be running at the same time to pass the barrier.
+    barrier = threading.Barrier(2, timeout=5)
+
+    steps = pipeline.Pipeline()
+    steps.add("a", lambda results: barrier.wait())
+    steps.add("b", lambda results: barrier.wait())
+    steps.run(max_workers=2)
+
+
+def test_run_max_workers(run_report):
+    lock = threading.Lock()
+    running = [0]
+    peak = [0]
+
+    def step(results):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        threading.Event().wait(0.01)
+        with lock:
+            running[0] -= 1
+
+    steps = pipeline.Pipeline()
+    for i in range(8):
+        steps.add(f"step{i}", step)
+    steps.run(max_workers=3)
+
+    assert 1 < peak[0] <= 3
+
+
+def test_run_failure(run_report):
+    ran = []
+
+    def fail(results):
+        raise RuntimeError("partition failed")
+
+    steps = pipeline.Pipeline()
+    steps.add("fail", fail)
+    steps.add("after", lambda results: ran.append("after"), requires=["fail"])
+
+    with pytest.raises(pipeline.StepError) as exc_info:
+        steps.run()
+
+    assert list(exc_info.value.errors) == ["fail"]
+    assert ran == []
+    assert run_report.phases[0]["status"] == "error"
+
+
+def test_run_failure_siblings(run_report):
+    ran = []
+
+    def fail(results):
+        raise RuntimeError("partition failed")
+
+    # With a single worker, the sibling steps only start after the first one
+    # failed, yet they must still run.
+    steps = pipeline.Pipeline()
+    for i in range(3):
+        steps.add(f"partition{i}", fail, group="partition")
+    steps.add("other", lambda results: ran.append("other"))
+
+    with pytest.raises(pipeline.StepError) as exc_info:
+        steps.run(max_workers=1)
+
+    assert list(exc_info.value.errors) == ["partition0", "partition1", "partition2"]
+    assert ran == []
+
+
+def test_add_unknown_requirement():
+    steps = pipeline.Pipeline()
+    with pytest.raises(ValueError):
+        steps.add("mkfs", lambda results: None, requires=["assemble"])
+
+    steps.add("assemble", lambda results: None)
+    with pytest.raises(ValueError):
+        steps.add("assemble", lambda results: None)
+
+
+def test_plan():
+    steps = pipeline.Pipeline()
+    steps.add("partition:/dev/a", lambda results: None)
+    steps.add("partition:/dev/b", lambda results: None)
+    steps.add(
+        "partitions",
+        lambda results: None,
+        requires=["partition:/dev/a", "partition:/dev/b"],
+    )
+    steps.add("stage-populate", lambda results: None)
+    steps.add(
+        "populate", lambda results: None, requires=["partitions", "stage-populate"]
+    )
+
+    last_report = {
+        "phases": [
+            {"phase": "partition:/dev/a", "elapsed": 1.0},
+            {"phase": "partition:/dev/b", "elapsed": 2.0},
+            {"phase": "partitions", "elapsed": 0.5},
+            {"phase": "stage-populate", "elapsed": 3.0},
+            {"phase": "populate", "elapsed": 1.0},
+        ]
+    }
+
+    assert steps.critical_path({"stage-populate": 3.0, "populate": 1.0}) == (
+        4.0,
+        ["stage-populate", "populate"],
+    )
+
+    output = steps.plan(last_report)
+    assert "critical path (4.000s): stage-populate -> populate" in output
+    assert "* stage-populate" in output
+
+    assert "critical path: unknown" in steps.plan(None)
+
+
+def test_build_pipeline(mocker):
+    disks = [mocker.Mock(path="/dev/nvme1n1"), mocker.Mock(path="/dev/nvme2n1")]
+    config = {
+        "mount": {"mount_point": {"path": "/mnt"}},
+        "tune": {"preset": "nvme"},
+        "populate": {"method": "archive", "archive_path": "/skel.tar"},
+    }
+
+    steps = cli.build_pipeline(config, disks)
+
+    requires = {name: step.requires for name, step in steps.steps.items()}
+    assert requires == {
+        "partition:/dev/nvme1n1": (),
+        "partition:/dev/nvme2n1": (),
+        "partitions": ("partition:/dev/nvme1n1", "partition:/dev/nvme2n1"),
+        "assemble": ("partitions",),
+        "tune": ("assemble",),
+        "mkfs": ("assemble", "tune"),
+        "mount": ("mkfs",),
+        "fstab": ("mkfs",),
+        "stage-populate": (),
+        "populate": ("mount", "stage-populate"),
+        "save-state": ("mount", "fstab", "populate"),
+    }
+
+
+def test_build_pipeline_partition_errors(mocker, run_report):
+    # More disks than workers: every failing disk must still be reported.
+    disks = [mocker.Mock(path=f"/dev/nvme{i}n1") for i in range(1, 7)]
+    for disk in disks:
+        disk.write_single_partition.side_effect = RuntimeError("sgdisk failed")
+    disks[2].write_single_partition.side_effect = None
+    config = {"mount": {"mount_point": {"path": "/mnt"}}}
+
+    steps = cli.build_pipeline(config, disks)
+    with pytest.raises(pipeline.StepError) as exc_info:
+        steps.run(max_workers=2)
+
+    assert sorted(exc_info.value.errors) == sorted(
+        f"partition:{disk.path}" for disk in disks if disk is not disks[2]
+    )
+    for disk in disks:
+        disk.write_single_partition.assert_called_once_with()
+    assert "/dev/nvme5n1" in str(exc_info.value)
+
+
+def test_build_pipeline_mount_unit(mocker):
+    disks = [mocker.Mock(path="/dev/nvme1n1")]
+    config = {
+        "mount": {
+            "mount_point": {"path": "/mnt"},
+            "persist": "systemd",
+            "discard": "periodic",
+        },
+    }
+
+    steps = cli.build_pipeline(config, disks)
+
+    assert "fstab" not in steps.steps
+    assert steps.steps["mount-unit"].requires == ("mkfs",)
+    assert steps.steps["fstrim"].requires == ("mount",)
+    assert steps.steps["save-state"].requires == (
+        "mount",
+        "mount-unit",
+        "fstrim",
+        "populate",
+    )
@@ -0,0 +1,249 @@
+import errno
+import os
+import shutil
+import stat
+
+import pytest
+from ephemeral_storage_setup import populate
+
+
+@pytest.fixture
+def source_tree(tmp_path):
+    source = tmp_path / "source"
+    (source / "etc" / "app").mkdir(parents=True)
+    (source / "var" / "cache").mkdir(parents=True)
+    (source / "etc" / "app" / "config").write_text("key: value\n")
+    (source / "var" / "cache" / "blob").write_bytes(os.urandom(3 * 1024**2 + 17))
+    (source / "var" / "empty").write_bytes(b"")
+    os.link(source / "etc" / "app" / "config", source / "var" / "config-link")
+    (source / "current").symlink_to("etc/app")
+    os.chmod(source / "etc" / "app", 0o750)
+    os.chmod(source / "etc" / "app" / "config", 0o640)
+    os.utime(source / "etc" / "app", ns=(1_000_000_000, 1_000_000_000))
+
+    try:
+        os.setxattr(source / "var" / "empty", "user.test", b"xattr")
+    except OSError as e:
+        if e.errno not in (errno.ENOTSUP, errno.EPERM):
+            raise
+
+    return source
+
+
+def test_copy_tree(source_tree, tmp_path):
+    target = tmp_path / "target"
+    target.mkdir()
+
+    populate.copy_tree(str(source_tree), str(target), max_workers=2)
+
+    assert (target / "etc" / "app" / "config").read_text() == "key: value\n"
+    assert (target / "var" / "cache" / "blob").read_bytes() == (
+        source_tree / "var" / "cache" / "blob"
+    ).read_bytes()
+    assert (target / "var" / "empty").read_bytes() == b""
+
+    # Hardlinks and symlinks are preserved.
+    assert os.path.samefile(
+        target / "etc" / "app" / "config", target / "var" / "config-link"
+    )
+    assert os.readlink(target / "current") == "etc/app"
+
+    # Modes and timestamps are preserved, also for directories.
+    assert stat.S_IMODE(os.stat(target / "etc" / "app").st_mode) == 0o750
+    assert stat.S_IMODE(os.stat(target / "etc" / "app" / "config").st_mode) == 0o640
+    assert os.stat(target / "etc" / "app").st_mtime_ns == 1_000_000_000
+
+    try:
+        expected = os.getxattr(source_tree / "var" / "empty", "user.test")
+    except OSError:
+        pass
+    else:
+        assert os.getxattr(target / "var" / "empty", "user.test") == expected
+
+
+def test_directory_metadata():
+    applied = []
+    directories = populate.DirectoryMetadata(
+        lambda path, metadata: applied.append((path, metadata))
+    )
+
+    directories.open("/t")
+    directories.open("/t/a", "/t", "a")
+    directories.open("/t/a/b", "/t/a", "b")
+    directories.hold("/t/a/b")
+
+    # Directories are applied once everything under them is released.
+    directories.release("/t/a")
+    directories.release("/t/a/b")
+    assert applied == []
+    directories.release("/t/a/b")
+    assert applied == [("/t/a/b", "b"), ("/t/a", "a")]
+
+    # The target itself has no metadata to apply.
+    directories.release("/t")
+    assert applied == [("/t/a/b", "b"), ("/t/a", "a")]
+    assert directories.directories == {}
+
+
+def test_copy_tree_bounded_state(mocker, source_tree, tmp_path):
+    target = tmp_path / "target"
+    target.mkdir()
+    copier = populate.TreeCopier(max_workers=2)
+    apply = mocker.spy(copier.directories, "apply")
+
+    copier.copy(str(source_tree), str(target))
+
+    # Post-order: each directory after its subdirectories.
+    applied = [os.path.relpath(c.args[0], target) for c in apply.call_args_list]
+    assert sorted(applied) == ["etc", "etc/app", "var", "var/cache"]
+    assert applied.index("etc/app") < applied.index("etc")
+    assert applied.index("var/cache") < applied.index("var")
+
+    # Nothing is held once the tree is done: all links of the hardlinked file
+    # were seen, and all directories finished.
+    assert copier.inodes == {}
+    assert copier.directories.directories == {}
+
+
+def test_copy_file_data_fallback(mocker, tmp_path):
+    source = tmp_path / "source"
+    source.write_bytes(b"x" * 100)
+    target = tmp_path / "target"
+
+    mocker.patch(
+        "os.copy_file_range",
+        side_effect=OSError(errno.EXDEV, "cross-device link"),
+        create=True,
+    )
+    mocker.patch("os.sendfile", side_effect=OSError(errno.EINVAL, "invalid"))
+
+    with open(source, "rb") as s, open(target, "wb") as t:
+        populate.copy_file_data(s.fileno(), t.fileno(), 100)
+
+    assert target.read_bytes() == b"x" * 100
+
+
+def test_copy_tree_error(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        populate.copy_tree(str(tmp_path / "missing"), str(tmp_path))
+
+
+@pytest.fixture
+def archive(source_tree, tmp_path):
+    import tarfile
+
+    path = tmp_path / "skel.tar.gz"
+    with tarfile.open(path, "w:gz") as tar:
+        tar.add(source_tree, arcname=".")
+
+    return path
+
+
+def check_extracted(target, source_tree):
+    assert (target / "etc" / "app" / "config").read_text() == "key: value\n"
+    assert (target / "var" / "cache" / "blob").read_bytes() == (
+        source_tree / "var" / "cache" / "blob"
+    ).read_bytes()
+    assert os.path.samefile(
+        target / "etc" / "app" / "config", target / "var" / "config-link"
+    )
+    assert os.readlink(target / "current") == "etc/app"
+    assert stat.S_IMODE(os.stat(target / "etc" / "app").st_mode) == 0o750
+    assert os.stat(target / "etc" / "app").st_mtime == 1
+
+
+def test_extract_archive(archive, source_tree, tmp_path):
+    target = tmp_path / "target"
+    target.mkdir()
+
+    populate.extract_archive(str(archive), str(target), max_workers=2)
+
+    check_extracted(target, source_tree)
+
+
+def test_extract_bounded_state(mocker, archive, source_tree, tmp_path):
+    target = tmp_path / "target"
+    target.mkdir()
+    extractor = populate.ArchiveExtractor(max_workers=2)
+    apply = mocker.spy(extractor.directories, "apply")
+
+    with open(archive, "rb") as fileobj:
+        extractor.extract(fileobj, str(target))
+
+    # Each directory is finished as soon as the archive moves past it.
+    applied = [os.path.relpath(c.args[0], target) for c in apply.call_args_list]
+    assert sorted(applied) == ["etc", "etc/app", "var", "var/cache"]
+    assert applied.index("etc") < applied.index("var/cache")
+    assert extractor.directories.directories == {}
+    check_extracted(target, source_tree)
+
+
+@pytest.mark.skipif(shutil.which("tar") is None, reason="tar not available")
+def test_extract_archive_external(archive, source_tree, tmp_path):
+    target = tmp_path / "target"
+    target.mkdir()
+
+    populate.extract_archive(str(archive), str(target), method="external")
+
+    check_extracted(target, source_tree)
+
+
+def test_archive_compression(tmp_path):
+    path = tmp_path / "archive"
+    for magic, expected in (
+        (populate.ZSTD_MAGIC, "zstd"),
+        (populate.LZ4_MAGIC, "lz4"),
+        (b"\x1f\x8b\x08\x00", None),
+    ):
+        path.write_bytes(magic + b"\x00" * 16)
+        assert populate.archive_compression(str(path)) == expected
+
+
+def test_extract_archive_outside_target(tmp_path):
+    import io
+    import tarfile
+
+    path = tmp_path / "evil.tar"
+    with tarfile.open(path, "w") as tar:
+        info = tarfile.TarInfo("../evil")
+        tar.addfile(info, io.BytesIO(b""))
+
+    target = tmp_path / "target"
+    target.mkdir()
+    with pytest.raises(ValueError):
+        populate.extract_archive(str(path), str(target))
+
+
+@pytest.mark.skipif(
+    shutil.which("tar") is None or shutil.which("zstd") is None,
+    reason="tar or zstd not available",
+)
+def test_extract_archive_external_zstd(source_tree, tmp_path):
+    import subprocess
+    import tarfile
+
+    path = tmp_path / "skel.tar"
+    with tarfile.open(path, "w") as tar:
+        tar.add(source_tree, arcname=".")
+    subprocess.check_call(["zstd", "-q", "--rm", str(path)])
+    zstd_path = tmp_path / "skel.tar.zst"
+    assert populate.archive_compression(str(zstd_path)) == "zstd"
+
+    target = tmp_path / "target"
+    target.mkdir()
+    populate.extract_archive(str(zstd_path), str(target), method="external")
+
+    check_extracted(target, source_tree)
+
+
+def test_prefetch(tmp_path, mocker):
+    source = tmp_path / "source"
+    (source / "dir").mkdir(parents=True)
+    (source / "dir" / "file").write_bytes(b"x" * 100)
+    (source / "link").symlink_to("dir/file")
+    fadvise = mocker.spy(populate.os, "posix_fadvise")
+
+    populate.prefetch(str(source))
+
+    assert fadvise.call_count == 1
+    assert fadvise.call_args[0][3] == populate.os.POSIX_FADV_WILLNEED
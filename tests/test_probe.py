@@ -0,0 +1,64 @@
+import pytest
+from ephemeral_storage_setup import probe
+
+
+def result(p99, iops=100000):
+    return {"lat_p99_us": p99, "iops": iops}
+
+
+def test_probe_disk(mocker, tmp_path):
+    # tmpfs doesn't support O_DIRECT.
+    mocker.patch.object(probe.os, "O_DIRECT", 0)
+    path = tmp_path / "disk"
+    path.write_bytes(bytes(1024**2))
+
+    probe_result = probe.probe_disk(str(path), {"runtime": 0.05, "threads": 2})
+
+    assert probe_result["path"] == str(path)
+    assert probe_result["ops"] > 0
+    assert probe_result["lat_p99_us"] >= probe_result["lat_p50_us"]
+
+
+def test_outliers():
+    results = {
+        "/dev/nvme1n1": result(100),
+        "/dev/nvme2n1": result(120),
+        "/dev/nvme3n1": result(1100),
+        "/dev/nvme4n1": result(110, iops=10000),
+        "/dev/nvme5n1": OSError("I/O error"),
+    }
+
+    reasons = probe.outliers(results, {})
+    assert sorted(reasons) == ["/dev/nvme3n1", "/dev/nvme4n1", "/dev/nvme5n1"]
+    assert "p99 latency" in reasons["/dev/nvme3n1"]
+    assert "IOPS" in reasons["/dev/nvme4n1"]
+
+    reasons = probe.outliers(results, {"max_p99_ratio": 20, "max_p99_us": 115})
+    assert sorted(reasons) == ["/dev/nvme2n1", "/dev/nvme3n1", "/dev/nvme5n1"]
+
+
+def test_outliers_two_disks():
+    # The slow disk must not pull up the median it's compared against.
+    results = {"/dev/nvme1n1": result(100), "/dev/nvme2n1": result(1000)}
+    reasons = probe.outliers(results, {})
+    assert list(reasons) == ["/dev/nvme2n1"]
+    assert "p99 latency" in reasons["/dev/nvme2n1"]
+
+    # A single disk has nothing to be compared against.
+    assert probe.outliers({"/dev/nvme1n1": result(1000)}, {}) == {}
+    assert list(probe.outliers({"/dev/nvme1n1": result(1000)}, {"max_p99_us": 500}))
+
+
+def test_check(mocker):
+    disks = [mocker.Mock(path=f"/dev/nvme{i}n1") for i in range(1, 4)]
+    mocker.patch(
+        "ephemeral_storage_setup.probe.probe_disk",
+        side_effect=lambda path, config: dict(
+            result(1000 if path == "/dev/nvme2n1" else 100), path=path
+        ),
+    )
+
+    assert probe.check(disks, {}) == [disks[0], disks[2]]
+
+    with pytest.raises(probe.ProbeFailed):
+        probe.check(disks, {"on_outlier": "fail"})
@@ -0,0 +1,56 @@
+import threading
+import time
+
+import pytest
+from ephemeral_storage_setup import readiness
+
+
+@pytest.fixture
+def targeted(mocker):
+    mocker.patch("ephemeral_storage_setup.readiness.mode", "targeted")
+    return mocker.patch("ephemeral_storage_setup.execute.simple")
+
+
+def test_wait_for_nodes_existing(targeted, tmp_path):
+    node = tmp_path / "node"
+    node.touch()
+
+    readiness.wait_for_nodes([str(node)], timeout=1.0)
+
+    targeted.assert_not_called()
+
+
+def test_wait_for_nodes_created(targeted, tmp_path):
+    # The node appears in a directory that doesn't exist yet, like
+    # /dev/disk/by-partuuid on a system without partitions.
+    node = tmp_path / "by-partuuid" / "node"
+
+    def create():
+        time.sleep(0.1)
+        node.parent.mkdir()
+        node.symlink_to(tmp_path)
+
+    thread = threading.Thread(target=create)
+    thread.start()
+
+    start = time.monotonic()
+    readiness.wait_for_nodes([str(node)], timeout=5.0)
+    thread.join()
+
+    assert time.monotonic() - start < 2.0
+    targeted.assert_not_called()
+
+
+def test_wait_for_nodes_timeout(targeted, tmp_path):
+    readiness.wait_for_nodes([str(tmp_path / "missing")], timeout=0.1)
+
+    targeted.assert_called_once_with(["udevadm", "settle"])
+
+
+def test_wait_for_nodes_settle_mode(mocker, tmp_path):
+    mocker.patch("ephemeral_storage_setup.readiness.mode", "settle")
+    mock_execute_simple = mocker.patch("ephemeral_storage_setup.execute.simple")
+
+    readiness.wait_for_nodes([str(tmp_path)])
+
+    mock_execute_simple.assert_called_once_with(["udevadm", "settle"])
@@ -0,0 +1,91 @@
+import json
+
+import pytest
+from ephemeral_storage_setup import execute, report
+
+
+@pytest.fixture
+def run_report():
+    return report.reset()
+
+
+def test_phase(run_report):
+    with report.phase("scan"):
+        pass
+
+    with pytest.raises(RuntimeError):
+        with report.phase("mkfs", profile="fast-boot"):
+            raise RuntimeError("mkfs failed")
+
+    scan, mkfs = run_report.phases
+    assert scan["phase"] == "scan"
+    assert scan["status"] == "ok"
+    assert scan["elapsed"] >= 0
+    assert mkfs["status"] == "error"
+    assert mkfs["profile"] == "fast-boot"
+
+
+def test_record_command(run_report):
+    execute.simple(["true"])
+    with pytest.raises(execute.NonZeroExitException):
+        execute.simple(["false"])
+
+    assert [(c["argv"], c["rc"]) for c in run_report.commands] == [
+        (["true"], 0),
+        (["false"], 1),
+    ]
+
+
+def test_write(run_report, tmp_path):
+    with report.phase("scan"):
+        run_report.record_command(["lsblk"], 0, 0.01)
+    run_report.add_section("extra", {"key": "value"})
+    run_report.finish("ok")
+
+    report_path = tmp_path / "run" / "report.json"
+    prometheus_path = tmp_path / "ephemeral_storage_setup.prom"
+    report.write({"path": str(report_path), "prometheus_path": str(prometheus_path)})
+
+    written = json.loads(report_path.read_text())
+    assert written["status"] == "ok"
+    assert written["extra"] == {"key": "value"}
+    assert [p["phase"] for p in written["phases"]] == ["scan"]
+    assert written["commands"][0]["argv"] == ["lsblk"]
+    assert report.read(str(report_path)) == written
+
+    metrics = prometheus_path.read_text()
+    assert "ephemeral_storage_setup_run_success 1\n" in metrics
+    assert "ephemeral_storage_setup_commands_total 1\n" in metrics
+    assert 'ephemeral_storage_setup_phase_duration_seconds{phase="scan"}' in metrics
+
+
+def test_prometheus_metrics_repeated_phases(run_report):
+    for pool in ["ephemeral", "ebs"]:
+        with report.phase("resume", pool=pool):
+            pass
+    with report.phase("probe", pool="ephemeral", disks=2):
+        pass
+    run_report.phases[-1]["elapsed"] = 1.5
+    with report.phase("probe", pool="ephemeral", disks=2):
+        pass
+    run_report.phases[-1]["elapsed"] = 0.5
+    with report.phase("scan"):
+        pass
+    run_report.finish("ok")
+
+    series = [
+        line.rsplit(" ", 1)[0]
+        for line in run_report.prometheus_metrics().splitlines()
+        if not line.startswith("#")
+    ]
+
+    # The textfile collector rejects files with duplicate series.
+    assert len(series) == len(set(series))
+    prefix = "ephemeral_storage_setup_phase_duration_seconds"
+    assert f'{prefix}{{phase="resume",pool="ephemeral"}}' in series
+    assert f'{prefix}{{phase="resume",pool="ebs"}}' in series
+    assert f'{prefix}{{phase="scan"}}' in series
+    assert (
+        f'{prefix}{{phase="probe",pool="ephemeral"}} 2.0'
+        in run_report.prometheus_metrics().splitlines()
+    )
@@ -0,0 +1,205 @@
+import json
+import uuid
+
+import pytest
+from ephemeral_storage_setup import resume
+
+MDSTAT = """\
+Personalities : [raid0] [raid1]
+md127 : active raid0 nvme2n1p1[1] nvme1n1p1[0]
+      7813771264 blocks super 1.2 512k chunks
+
+md126 : inactive nvme3n1p1[0](S)
+      3906885632 blocks super 1.2
+
+unused devices: <none>
+"""
+
+FSUUID = "01234567-89ab-cdef-0123-456789abcdef"
+
+
+def ext4_image(fsuuid):
+    image = bytearray(4096)
+    image[1024 + 0x38 : 1024 + 0x3A] = b"\x53\xef"
+    image[1024 + 0x68 : 1024 + 0x78] = uuid.UUID(fsuuid).bytes
+    return bytes(image)
+
+
+@pytest.fixture
+def md_device(mocker, tmp_path):
+    """
+    A fake /dev/md/ephemeral, symlinked to a fake md127 holding an ext4
+    superblock, and a saved state file for it.
+    """
+
+    (tmp_path / "md127").write_bytes(ext4_image(FSUUID))
+    (tmp_path / "md").mkdir()
+    (tmp_path / "md" / "ephemeral").symlink_to("../md127")
+    mocker.patch("ephemeral_storage_setup.resume.MD_DEVICE_DIR", str(tmp_path / "md"))
+
+    mdstat_path = tmp_path / "mdstat"
+    mdstat_path.write_text(MDSTAT)
+    mocker.patch("ephemeral_storage_setup.resume.MDSTAT_PATH", str(mdstat_path))
+
+    state_path = tmp_path / "state.json"
+    state_path.write_text(
+        json.dumps({"arrays": {"ephemeral": {"fsuuid": FSUUID, "members": ["abc"]}}})
+    )
+    return {
+        "state": {"path": str(state_path)},
+        "mount": {"mount_point": {"path": "/mnt"}},
+    }
+
+
+def test_read_mdstat(tmp_path):
+    path = tmp_path / "mdstat"
+    path.write_text(MDSTAT)
+
+    assert resume.read_mdstat(str(path)) == {
+        "md127": {
+            "state": "active",
+            "level": "raid0",
+            "members": ["nvme2n1p1", "nvme1n1p1"],
+        },
+        "md126": {"state": "inactive", "level": None, "members": ["nvme3n1p1"]},
+    }
+    assert resume.read_mdstat(str(tmp_path / "missing")) == {}
+
+
+def test_read_filesystem_uuid(tmp_path):
+    ext4 = tmp_path / "ext4"
+    ext4.write_bytes(ext4_image(FSUUID))
+    assert resume.read_filesystem_uuid(str(ext4)) == FSUUID
+
+    xfs = tmp_path / "xfs"
+    xfs.write_bytes(b"XFSB" + bytes(28) + uuid.UUID(FSUUID).bytes + bytes(4000))
+    assert resume.read_filesystem_uuid(str(xfs)) == FSUUID
+
+    blank = tmp_path / "blank"
+    blank.write_bytes(bytes(4096))
+    assert resume.read_filesystem_uuid(str(blank)) is None
+
+
+def test_save_state(tmp_path):
+    path = tmp_path / "state" / "state.json"
+    config = {"state": {"path": str(path)}}
+    resume.save_state(config, "ephemeral", FSUUID, ["abc"])
+    resume.save_state(config, "ebs", None, ["def"])
+
+    assert resume.load_state(str(path)) == {
+        "arrays": {
+            "ephemeral": {"fsuuid": FSUUID, "members": ["abc"]},
+            "ebs": {"fsuuid": None, "members": ["def"]},
+        }
+    }
+
+
+def test_resume_without_state(tmp_path, md_device):
+    config = {"state": {"path": str(tmp_path / "missing.json")}}
+    assert resume.resume(config) is False
+
+    # Saved state, but for another array.
+    md_device["mdraid"] = {"name": "ebs"}
+    assert resume.resume(md_device) is False
+
+
+def test_resume_members_missing(mocker, md_device, tmp_path):
+    (tmp_path / "md" / "ephemeral").unlink()
+    mock_assemble = mocker.patch("ephemeral_storage_setup.resume.assemble")
+
+    assert resume.resume(md_device) is False
+    mock_assemble.assert_not_called()
+
+
+def test_resume_mounts(mocker, md_device):
+    mocker.patch("ephemeral_storage_setup.resume.mounted_device", return_value=None)
+    mock_mount = mocker.patch("ephemeral_storage_setup.utils.mount_filesystem")
+    mock_tune = mocker.patch("ephemeral_storage_setup.tune.apply")
+    mocker.patch(
+        "ephemeral_storage_setup.tune.member_disks",
+        return_value=["nvme1n1", "nvme2n1"],
+    )
+    md_device["tune"] = {"preset": "nvme"}
+
+    assert resume.resume(md_device) is True
+    mock_mount.assert_called_once()
+    mock_tune.assert_called_once_with(
+        ["nvme1n1", "nvme2n1"], "md127", {"preset": "nvme"}
+    )
+
+
+def test_resume_already_mounted(mocker, md_device):
+    mocker.patch("ephemeral_storage_setup.resume.mounted_device", return_value="0:0")
+    mock_mount = mocker.patch("ephemeral_storage_setup.utils.mount_filesystem")
+
+    assert resume.resume(md_device) is True
+    mock_mount.assert_not_called()
+
+
+def test_resume_uuid_mismatch(mocker, md_device, tmp_path):
+    (tmp_path / "md127").write_bytes(ext4_image(str(uuid.uuid4())))
+
+    with pytest.raises(resume.StateMismatch):
+        resume.resume(md_device)
+
+
+def test_resume_disabled(md_device):
+    md_device["state"]["resume"] = False
+    assert resume.resume(md_device) is False
+
+
+def test_resume_cache(mocker, md_device, tmp_path):
+    # The filesystem is on the cache device, not on the array.
+    (tmp_path / "md127").write_bytes(bytes(4096))
+    (tmp_path / "cache").write_bytes(ext4_image(FSUUID))
+    mocker.patch(
+        "ephemeral_storage_setup.cache.find_origin", return_value="/dev/nvme1n1"
+    )
+    mock_attach = mocker.patch(
+        "ephemeral_storage_setup.cache.attach", return_value=str(tmp_path / "cache")
+    )
+    mocker.patch("ephemeral_storage_setup.resume.mounted_device", return_value=None)
+    mock_mount = mocker.patch("ephemeral_storage_setup.utils.mount_filesystem")
+    md_device["cache"] = {"mode": "writeback"}
+
+    assert resume.resume(md_device) is True
+    mock_attach.assert_called_once_with(
+        str(tmp_path / "md" / "ephemeral"), "/dev/nvme1n1", md_device["cache"], False
+    )
+    mock_mount.assert_called_once_with(str(tmp_path / "cache"), md_device)
+
+
+def test_resume_crypt_reclaims(mocker, md_device, tmp_path):
+    # The member partition, and its disk in sysfs.
+    (tmp_path / "nvme1n1p1").touch()
+    (tmp_path / "by-partuuid").mkdir()
+    (tmp_path / "by-partuuid" / "abc").symlink_to("../nvme1n1p1")
+    mocker.patch(
+        "ephemeral_storage_setup.devices.partuuid_node",
+        side_effect=lambda guid: str(tmp_path / "by-partuuid" / guid),
+    )
+    (tmp_path / "sys" / "devices" / "nvme1n1" / "nvme1n1p1").mkdir(parents=True)
+    (tmp_path / "sys" / "block").mkdir()
+    (tmp_path / "sys" / "block" / "nvme1n1p1").symlink_to(
+        "../devices/nvme1n1/nvme1n1p1"
+    )
+    mocker.patch(
+        "ephemeral_storage_setup.resume.SYSFS_BLOCK_DIR",
+        str(tmp_path / "sys" / "block"),
+    )
+    run_sync = mocker.patch("ephemeral_storage_setup.execute.run_sync")
+    run_all_sync = mocker.patch("ephemeral_storage_setup.execute.run_all_sync")
+    mocker.patch("ephemeral_storage_setup.readiness.settle")
+
+    md_device["crypt"] = {}
+    assert not resume.resume(md_device)
+
+    md_path = str(tmp_path / "md" / "ephemeral")
+    assert [c.args[0] for c in run_sync.call_args_list] == [
+        ["mdadm", "--stop", md_path],
+    ]
+    # All members are wiped concurrently.
+    assert [c.args[0] for c in run_all_sync.call_args_list] == [
+        [["wipefs", "--all", str(tmp_path / "by-partuuid" / "abc")]],
+        [["sgdisk", "--zap-all", "/dev/nvme1n1"]],
+    ]
@@ -0,0 +1,65 @@
+import subprocess
+import sys
+import time
+
+from ephemeral_storage_setup import lazy
+
+# Import time allowed on top of bare interpreter startup. The tool runs early
+# in boot, so keep this tight; it's generous enough for loaded CI machines.
+IMPORT_BUDGET = 0.25
+
+# Modules that only some runs need, and must not be imported at startup.
+LAZY_MODULES = [
+    "asyncio",
+    "ctypes",
+    "tarfile",
+    "yaml",
+    "ephemeral_storage_setup.bench",
+    "ephemeral_storage_setup.cache",
+    "ephemeral_storage_setup.crypt",
+    "ephemeral_storage_setup.hotplug",
+    "ephemeral_storage_setup.numa",
+    "ephemeral_storage_setup.populate",
+    "ephemeral_storage_setup.probe",
+]
+
+
+def startup_time(code, runs=5):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], check=True)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+def test_lazy_module():
+    json = lazy.module("json")
+    assert repr(json) == "<lazy module 'json'>"
+    assert json.loads("[1]") == [1]
+
+
+def test_cli_imports_lazily():
+    output = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, ephemeral_storage_setup.cli; "
+            f"print(' '.join(m for m in {LAZY_MODULES!r} if m in sys.modules))",
+        ],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+
+    assert output.split() == []
+
+
+def test_startup_budget():
+    baseline = startup_time("pass")
+    elapsed = startup_time("import ephemeral_storage_setup.cli")
+
+    assert elapsed - baseline < IMPORT_BUDGET
@@ -0,0 +1,95 @@
+import pytest
+from ephemeral_storage_setup import devices, sysfs
+
+
+@pytest.fixture
+def sysfs_root(pytestconfig):
+    return str(pytestconfig.rootpath / "tests" / "resources" / "sysfs")
+
+
+def test_scan_devices_raw(sysfs_root):
+    devs = sysfs.scan_devices_raw(devices.BlockDevice._registry, root=sysfs_root)
+
+    # Loop devices are skipped entirely.
+    assert [dev["path"] for dev in devs] == [
+        "/dev/nvme0n1",
+        "/dev/nvme1n1",
+        "/dev/nvme2n1",
+    ]
+
+    root_disk = devs[0]
+    assert root_disk["type"] == "disk"
+    assert root_disk["model"] == "Amazon Elastic Block Store"
+    assert root_disk["tran"] == "nvme"
+    assert root_disk["size"] == 8 * 1024**3
+    assert root_disk["pttype"] == "dos"
+    assert root_disk["sched"] == "mq-deadline"
+    assert root_disk["ra"] == 128
+    assert root_disk["opt-io"] == 4096
+
+    (partition,) = root_disk["children"]
+    assert partition["type"] == "part"
+    assert partition["pkname"] == "nvme0n1"
+    assert partition["fstype"] == "ext4"
+    assert partition["uuid"] == "436cf32d-5e3d-46ca-b557-f870c8a25794"
+    assert partition["partuuid"] == "24ca9e81-01"
+    assert partition["mountpoint"] == "/"
+    assert partition["phy-sec"] == 512
+
+    blank_disk = devs[1]
+    assert blank_disk["model"] == "Amazon EC2 NVMe Instance Storage"
+    assert blank_disk["serial"] == "AWS1234567890ABCDEF1"
+    assert "children" not in blank_disk
+    for field in ("pttype", "fstype", "label", "uuid"):
+        assert blank_disk[field] is None
+
+
+def test_scan_devices_raw_single(sysfs_root):
+    (partition,) = sysfs.scan_devices_raw(
+        devices.BlockDevice._registry, "/dev/nvme0n1p1", root=sysfs_root
+    )
+    assert partition["type"] == "part"
+    assert partition["pkname"] == "nvme0n1"
+
+    with pytest.raises(sysfs.ScanError):
+        sysfs.scan_devices_raw(
+            devices.BlockDevice._registry, "/dev/nvme9n1", root=sysfs_root
+        )
+
+
+def test_scan_devices_matches_lsblk(mocker, sysfs_root):
+    mocker.patch("ephemeral_storage_setup.devices.scanner", "sysfs")
+    mocker.patch(
+        "ephemeral_storage_setup.sysfs.scan_devices_raw",
+        side_effect=lambda known_types, device_path=None: sysfs.Scanner(
+            known_types, root=sysfs_root
+        ).scan(device_path),
+    )
+    mock_get_lsblk_output = mocker.patch(
+        "ephemeral_storage_setup.devices.get_lsblk_output"
+    )
+
+    disks = [
+        dev
+        for dev in devices.scan_devices()
+        if isinstance(dev, devices.Disk) and not dev.is_initialized()
+    ]
+
+    assert [dev.path for dev in disks] == ["/dev/nvme1n1", "/dev/nvme2n1"]
+    assert all(dev.matches_config({}) for dev in disks)
+    mock_get_lsblk_output.assert_not_called()
+
+
+def test_scan_devices_falls_back_to_lsblk(mocker):
+    mocker.patch("ephemeral_storage_setup.devices.scanner", "sysfs")
+    mocker.patch(
+        "ephemeral_storage_setup.sysfs.scan_devices_raw",
+        side_effect=sysfs.ScanError("no sysfs"),
+    )
+    mock_get_lsblk_output = mocker.patch(
+        "ephemeral_storage_setup.devices.get_lsblk_output",
+        return_value='{"blockdevices": []}',
+    )
+
+    assert devices.scan_devices() == []
+    mock_get_lsblk_output.assert_called_once_with(None)
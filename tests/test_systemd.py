@@ -0,0 +1,84 @@
+from ephemeral_storage_setup import systemd, utils
+
+
+def test_escape_path():
+    assert systemd.escape_path("/") == "-"
+    assert systemd.escape_path("/mnt/ephemeral") == "mnt-ephemeral"
+    assert systemd.escape_path("/mnt/my-data/") == "mnt-my\\x2ddata"
+    assert systemd.escape_path("/.hidden") == "\\x2ehidden"
+
+
+def test_mount_unit():
+    unit = systemd.mount_unit(
+        "/dev/disk/by-uuid/01234567", "/mnt", "xfs", ["noatime", "logbsize=256k"]
+    )
+
+    assert "What=/dev/disk/by-uuid/01234567\n" in unit
+    assert "Where=/mnt\n" in unit
+    assert "Options=noatime,logbsize=256k\n" in unit
+    assert "WantedBy=local-fs.target\n" in unit
+
+
+def test_add_mount_unit(mocker, tmp_path):
+    mock_execute_simple = mocker.patch("ephemeral_storage_setup.execute.simple")
+    config = {
+        "mkfs": {"type": "xfs"},
+        "mount": {
+            "mount_point": {"path": "/mnt/ephemeral"},
+            "unit_dir": str(tmp_path),
+            "device_timeout": 5,
+        },
+    }
+
+    utils.add_mount_unit("01234567", config)
+
+    # Boot must not wait for the filesystem if it's gone after a stop and
+    # start: nofail drops the implicit Before=local-fs.target, and the device
+    # unit gives up soon.
+    unit = (tmp_path / "mnt-ephemeral.mount").read_text()
+    assert unit == "\n".join(
+        [
+            "[Unit]",
+            "Description=Ephemeral storage at /mnt/ephemeral",
+            "After=ephemeral-storage-setup.service",
+            "",
+            "[Mount]",
+            "What=/dev/disk/by-uuid/01234567",
+            "Where=/mnt/ephemeral",
+            "Type=xfs",
+            "Options=logbsize=256k,discard,nofail",
+            "",
+            "[Install]",
+            "WantedBy=local-fs.target",
+            "",
+        ]
+    )
+    dropin = tmp_path / "dev-disk-by\\x2duuid-01234567.device.d" / "device-timeout.conf"
+    assert dropin.read_text() == "[Unit]\nJobRunningTimeoutSec=5s\n"
+    mock_execute_simple.assert_any_call(["systemctl", "enable", "mnt-ephemeral.mount"])
+
+
+def test_install_fstrim_timer(mocker, tmp_path):
+    mock_execute_simple = mocker.patch("ephemeral_storage_setup.execute.simple")
+
+    assert systemd.install_fstrim_timer(
+        "/mnt/ephemeral", {"schedule": "hourly"}, unit_dir=str(tmp_path)
+    )
+
+    service = (tmp_path / "fstrim-mnt-ephemeral.service").read_text()
+    assert "ExecStart=/sbin/fstrim --verbose /mnt/ephemeral\n" in service
+    assert "RequiresMountsFor=/mnt/ephemeral\n" in service
+    timer = (tmp_path / "fstrim-mnt-ephemeral.timer").read_text()
+    assert "OnCalendar=hourly\n" in timer
+
+    mock_execute_simple.assert_any_call(["systemctl", "daemon-reload"])
+    mock_execute_simple.assert_any_call(
+        ["systemctl", "enable", "--now", "--no-block", "fstrim-mnt-ephemeral.timer"]
+    )
+
+    # Unchanged units are left alone.
+    mock_execute_simple.reset_mock()
+    assert not systemd.install_fstrim_timer(
+        "/mnt/ephemeral", {"schedule": "hourly"}, unit_dir=str(tmp_path)
+    )
+    mock_execute_simple.assert_not_called()
@@ -0,0 +1,101 @@
+import pytest
+from ephemeral_storage_setup import tune
+
+
+@pytest.fixture
+def sys_block(mocker, tmp_path):
+    for kname in ("nvme1n1", "nvme2n1", "md127"):
+        (tmp_path / kname / "queue").mkdir(parents=True)
+    mocker.patch("ephemeral_storage_setup.tune.SYS_BLOCK_PATH", str(tmp_path))
+    return tmp_path
+
+
+def test_settings():
+    member_settings, array_settings = tune.settings(
+        {"preset": "nvme", "array": {"read_ahead_kb": 8192}}
+    )
+    assert member_settings["scheduler"] == "none"
+    assert array_settings == {"read_ahead_kb": 8192}
+
+    assert tune.settings({}) == ({}, {})
+
+    with pytest.raises(ValueError):
+        tune.settings({"preset": "bogus"})
+
+
+def test_tune(mocker, sys_block, tmp_path):
+    disks = [
+        mocker.Mock(raw_info={"kname": "nvme1n1", "serial": "AWS1"}),
+        mocker.Mock(raw_info={"kname": "nvme2n1", "serial": None}),
+    ]
+    mdraid = mocker.Mock(raw_info={"kname": "md127"})
+    rule_path = tmp_path / "90-test.rules"
+
+    tune.tune(
+        disks,
+        mdraid,
+        "ephemeral",
+        {"preset": "nvme", "udev_rule_path": str(rule_path)},
+    )
+
+    assert (sys_block / "nvme1n1" / "queue" / "scheduler").read_text() == "none"
+    assert (sys_block / "nvme2n1" / "queue" / "rq_affinity").read_text() == "2"
+    assert (sys_block / "md127" / "queue" / "read_ahead_kb").read_text() == "4096"
+
+    rules = rule_path.read_text().splitlines()
+    assert len(rules) == 4
+    assert 'ENV{ID_SERIAL_SHORT}=="AWS1"' in rules[1]
+    assert 'KERNEL=="nvme2n1"' in rules[2]
+    assert 'ATTR{queue/scheduler}="none"' in rules[2]
+    assert 'ENV{MD_DEVNAME}=="ephemeral"' in rules[3]
+    assert 'ATTR{queue/read_ahead_kb}="4096"' in rules[3]
+
+
+def test_apply_queue_settings_error(sys_block):
+    # Missing devices are logged, not raised.
+    tune.apply_queue_settings("nvme9n1", {"scheduler": "none"})
+
+
+def test_member_disks(sys_block):
+    (sys_block / "nvme1n1" / "nvme1n1p1").mkdir()
+    (sys_block / "nvme1n1" / "nvme1n1p1" / "partition").write_text("1\n")
+    (sys_block / "md127" / "slaves").mkdir()
+    (sys_block / "md127" / "slaves" / "nvme1n1p1").symlink_to("../../nvme1n1/nvme1n1p1")
+    (sys_block / "md127" / "slaves" / "nvme2n1").symlink_to("../../nvme2n1")
+
+    assert tune.member_disks("md127") == ["nvme1n1", "nvme2n1"]
+
+
+def test_md_settings(mocker):
+    assert tune.md_settings(0, 4, {"resync": "throttled"}) == {}
+    assert tune.md_settings(10, 4, {"resync": "throttled"}) == {
+        "sync_speed_min": 1000,
+        "sync_speed_max": 100000,
+    }
+
+    mocker.patch(
+        "ephemeral_storage_setup.geometry.stripe_cache_size", return_value=4096
+    )
+    assert tune.md_settings(5, 4, {}) == {"stripe_cache_size": 4096}
+    assert tune.md_settings(5, 4, {"stripe_cache_size": 1024}) == {
+        "stripe_cache_size": 1024
+    }
+
+
+def test_resync_status(sys_block):
+    md_path = sys_block / "md127" / "md"
+    md_path.mkdir()
+    (md_path / "sync_action").write_text("resync\n")
+    (md_path / "sync_completed").write_text("1000 / 4000\n")
+
+    assert tune.resync_status("md127") == {
+        "device": "md127",
+        "action": "resync",
+        "completed_sectors": 1000,
+        "total_sectors": 4000,
+        "progress": 0.25,
+    }
+
+    (md_path / "sync_action").write_text("idle\n")
+    (md_path / "sync_completed").write_text("none\n")
+    assert tune.resync_status("md127") == {"device": "md127", "action": "idle"}
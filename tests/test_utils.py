@@ -1,15 +1,133 @@
 import pytest
-from ephemeral_storage_setup import utils
+from ephemeral_storage_setup import execute, utils
 
 
 def test_mkfs(mocker):
     mock_execute_simple = mocker.patch("ephemeral_storage_setup.execute.simple")
+    mock_wait_for_nodes = mocker.patch(
+        "ephemeral_storage_setup.readiness.wait_for_nodes"
+    )
+    dev_path = "/dev/foo"
+    fsuuid = utils.mkfs(dev_path, {})
+
+    mock_execute_simple.assert_any_call(
+        ["mkfs.ext4", "-L", "ephemeral", "-m", "0", "-U", fsuuid, dev_path],
+        timeout=utils.DEFAULT_MKFS_TIMEOUT,
+    )
+    mock_wait_for_nodes.assert_called_once_with([f"/dev/disk/by-uuid/{fsuuid}"])
+
+
+def test_mkfs_command(mocker):
+    mock_execute_simple = mocker.patch("ephemeral_storage_setup.execute.simple")
+    mock_wait_for_nodes = mocker.patch(
+        "ephemeral_storage_setup.readiness.wait_for_nodes"
+    )
     dev_path = "/dev/foo"
-    utils.mkfs(dev_path, {})
+    config = {"command": ["mkfs.xfs", "-L", "ephemeral"]}
 
+    assert utils.mkfs(dev_path, config) is None
     mock_execute_simple.assert_any_call(
-        ["mkfs.ext4", "-L", "ephemeral", "-m", "0", dev_path],
+        ["mkfs.xfs", "-L", "ephemeral", dev_path], timeout=utils.DEFAULT_MKFS_TIMEOUT
     )
+    assert config["command"] == ["mkfs.xfs", "-L", "ephemeral"]
+    mock_wait_for_nodes.assert_called_once_with([])
+
+
+def test_filesystem_registry():
+    assert isinstance(utils.Filesystem({}), utils.Ext4)
+    assert isinstance(utils.Filesystem({"type": "xfs"}), utils.XFS)
+
+    # Types without a backend can be mounted, but need a custom mkfs command.
+    generic = utils.Filesystem({"type": "zfs"})
+    assert type(generic) is utils.Filesystem
+    assert generic.fstab_type == "zfs"
+    with pytest.raises(utils.Filesystem.Unknown):
+        generic.mkfs_argv("01234567-89ab-cdef-0123-456789abcdef")
+
+
+def test_mkfs_xfs(mocker):
+    mock_execute_simple = mocker.patch("ephemeral_storage_setup.execute.simple")
+    mocker.patch("ephemeral_storage_setup.readiness.wait_for_nodes")
+    mocker.patch("os.cpu_count", return_value=16)
+    mocker.patch("ephemeral_storage_setup.utils.device_size", return_value=1024**4)
+    dev_path = "/dev/foo"
+
+    fsuuid = utils.mkfs(
+        dev_path,
+        {"type": "xfs", "profile": "fast-boot"},
+        stripe=(512 * 1024, 4 * 512 * 1024),
+    )
+
+    mock_execute_simple.assert_any_call(
+        [
+            "mkfs.xfs",
+            "-f",
+            "-L",
+            "ephemeral",
+            "-m",
+            f"uuid={fsuuid}",
+            "-K",
+            "-d",
+            "agcount=16,su=524288,sw=4",
+            dev_path,
+        ],
+        timeout=utils.DEFAULT_MKFS_TIMEOUT,
+    )
+
+
+@pytest.mark.parametrize(
+    "cpu_count,device_size,expected",
+    [
+        (16, 1024**4, 16),
+        (2, 1024**4, 4),
+        # Many CPUs on a small device: groups must be at least 16 MiB.
+        (192, 1024**3, 64),
+        # Too small for the minimum of 4 groups: left to mkfs.xfs.
+        (192, 48 * 1024**2, None),
+        (16, None, None),
+        # Few CPUs on a large device: groups must be at most 1 TiB.
+        (4, 10 * 1024**4, 10),
+    ],
+)
+def test_xfs_allocation_groups(mocker, cpu_count, device_size, expected):
+    mocker.patch("os.cpu_count", return_value=cpu_count)
+    xfs = utils.Filesystem({"type": "xfs"})
+
+    assert xfs.allocation_groups(device_size) == expected
+
+    argv = xfs.mkfs_argv("01234567", device_size=device_size)
+    if expected is None:
+        assert not any(arg.startswith("agcount=") for arg in argv)
+    else:
+        assert argv[argv.index("-d") + 1] == f"agcount={expected}"
+
+    # A configured agcount is passed as it is.
+    xfs = utils.Filesystem({"type": "xfs", "agcount": 8})
+    assert xfs.allocation_groups(device_size) == 8
+
+
+@pytest.mark.parametrize(
+    "config, timeout",
+    [
+        ({}, utils.DEFAULT_MKFS_TIMEOUT),
+        ({"profile": "fast-boot"}, utils.DEFAULT_MKFS_TIMEOUT),
+        # Eager inode table and journal initialization isn't timed out.
+        ({"profile": "full-init"}, None),
+        ({"profile": "full-init", "timeout": 3600}, 3600),
+        ({"type": "xfs", "timeout": 60}, 60),
+        ({"command": ["mkfs.btrfs"], "timeout": None}, None),
+    ],
+)
+def test_mkfs_timeout(mocker, config, timeout):
+    mock_execute_simple = mocker.patch("ephemeral_storage_setup.execute.simple")
+    mocker.patch("ephemeral_storage_setup.readiness.wait_for_nodes")
+    mocker.patch(
+        "ephemeral_storage_setup.utils.ext4_feature_supported", return_value=True
+    )
+
+    utils.mkfs("/dev/foo", config)
+
+    assert mock_execute_simple.call_args.kwargs["timeout"] == timeout
 
 
 def test_mount(mocker):
@@ -19,7 +137,7 @@ def test_mount(mocker):
     config = {"mount_point": {"path": mount_path}}
     utils.mount(dev_path, config)
     mock_execute_simple.assert_any_call(
-        ["mount", dev_path, mount_path],
+        ["mount", "-o", "discard", dev_path, mount_path],
     )
 
 
@@ -46,7 +164,7 @@ def test_mount_and_chown(mocker, chown_config):
 
     utils.mount(dev_path, config)
     mock_execute_simple.assert_any_call(
-        ["mount", dev_path, mount_path],
+        ["mount", "-o", "discard", dev_path, mount_path],
     )
 
     shutil_chown.assert_any_call(
@@ -56,33 +174,21 @@ def test_mount_and_chown(mocker, chown_config):
     )
 
 
-def test_activate_mount(mocker):
-    mock_mount = mocker.patch("ephemeral_storage_setup.utils.mount")
-    mock_add_to_fstab = mocker.patch("ephemeral_storage_setup.utils.add_to_fstab")
-    mock_populate_directory = mocker.patch("ephemeral_storage_setup.utils.populate_directory")
-
-    config = {
-        "mount": {
-            "mount_point": {
-                "path": "/mnt",
-            },
-        },
-        "mkfs": {
-            "type": "zfs",
-        },
-        "populate": {},
-    }
+def test_mount_default_options(mocker):
+    mock_execute_simple = mocker.patch("ephemeral_storage_setup.execute.simple")
+    dev_path = "/dev/foo"
+    mount_path = "/mnt"
 
-    mdraid = mocker.Mock(
-        uuid="01234567-89ab-cdef-0123-456789abcdef",
-        path="/dev/fakemd127"
+    utils.mount(dev_path, {"mount_point": {"path": mount_path}}, ["logbsize=256k"])
+    mock_execute_simple.assert_any_call(
+        ["mount", "-o", "logbsize=256k,discard", dev_path, mount_path],
     )
 
-    utils.activate_mount(mdraid, config)
-
-    mock_mount.assert_called_once_with(mdraid.path, config["mount"])
-    mock_add_to_fstab.assert_called_once_with(mdraid.uuid, "/mnt", "zfs")
-    mock_populate_directory.assert_called_once_with("/mnt", config["populate"])
+    config = {"mount_point": {"path": mount_path}, "mount_options": ["noatime"]}
+    utils.mount(dev_path, config, ["logbsize=256k"])
+    mock_execute_simple.assert_any_call(
+        ["mount", "-o", "noatime,discard", dev_path, mount_path],
+    )
 
 
 def test_add_to_fstab(tmpdir):
@@ -107,6 +213,69 @@ def test_add_to_fstab(tmpdir):
     assert len(output.split()) == 6
 
 
+def test_add_to_fstab_idempotent(tmpdir):
+    file = tmpdir.join("fstab")
+    file.write("# comment\nUUID=root / ext4 defaults 0 1\nUUID=old /mnt xfs defaults 0 0\n")
+    fsuuid = "12345678-1234-1234-1234-123456789012"
+
+    assert utils.add_to_fstab(fsuuid, "/mnt", "ext4", file.strpath, ["noatime"])
+    expected = (
+        "# comment\n"
+        "UUID=root / ext4 defaults 0 1\n"
+        f"UUID={fsuuid} /mnt ext4 noatime 0 0\n"
+    )
+    assert file.read() == expected
+
+    assert not utils.add_to_fstab(fsuuid, "/mnt", "ext4", file.strpath, ["noatime"])
+    assert file.read() == expected
+
+
+def test_add_to_fstab_symlink(tmp_path):
+    # Like /etc/fstab managed elsewhere: the target is updated, and keeps its
+    # mode and owner, rather than the link being replaced.
+    target = tmp_path / "fstab.real"
+    target.write_text("UUID=root / ext4 defaults 0 1\n")
+    target.chmod(0o640)
+    before = target.stat()
+    link = tmp_path / "fstab"
+    link.symlink_to(target)
+
+    assert utils.add_to_fstab("01234567", "/mnt", "ext4", str(link), ["noatime"])
+
+    assert link.is_symlink()
+    assert target.read_text().endswith("UUID=01234567 /mnt ext4 noatime 0 0\n")
+    after = target.stat()
+    assert oct(after.st_mode & 0o7777) == oct(0o640)
+    assert (after.st_uid, after.st_gid) == (before.st_uid, before.st_gid)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["fstab", "fstab.real"]
+
+
+def test_write_atomically_new_file(tmp_path):
+    path = tmp_path / "state" / "state.json"
+
+    utils.write_atomically(str(path), "{}\n")
+
+    assert path.read_text() == "{}\n"
+
+
+def test_mount_options():
+    assert utils.mount_options({}, ["logbsize=256k"]) == ["logbsize=256k", "discard"]
+    assert utils.mount_options(
+        {"mount_options": ["noatime", "lazytime"], "discard": "periodic"}
+    ) == ["noatime", "lazytime"]
+    assert utils.mount_options({"discard": "none"}) == []
+    with pytest.raises(ValueError):
+        utils.mount_options({"discard": "sometimes"})
+
+
+def test_persist_method():
+    assert utils.persist_method({}) == "fstab"
+    assert utils.persist_method({"add_to_fstab": False}) == "none"
+    assert utils.persist_method({"persist": "systemd"}) == "systemd"
+    with pytest.raises(ValueError):
+        utils.persist_method({"persist": "rc.local"})
+
+
 @pytest.mark.parametrize(
     "test_input,expected",
     [
@@ -120,3 +289,61 @@ def test_add_to_fstab(tmpdir):
 )
 def test_to_bytes(test_input, expected):
     assert utils.to_bytes(test_input) == expected
+
+
+def test_mkfs_stripe(mocker):
+    mock_execute_simple = mocker.patch("ephemeral_storage_setup.execute.simple")
+    mocker.patch("ephemeral_storage_setup.readiness.wait_for_nodes")
+    dev_path = "/dev/foo"
+
+    utils.mkfs(dev_path, {}, stripe=(512 * 1024, 4 * 512 * 1024))
+    (argv,), _ = mock_execute_simple.call_args
+    assert argv[-3:] == ["-E", "stride=128,stripe_width=512", dev_path]
+
+    # Config overrides the device geometry.
+    utils.mkfs(dev_path, {"stripe_width": 256}, stripe=(512 * 1024, 4 * 512 * 1024))
+    (argv,), _ = mock_execute_simple.call_args
+    assert argv[-3:] == ["-E", "stride=128,stripe_width=256", dev_path]
+
+
+@pytest.mark.parametrize(
+    "kernel,mke2fs_output,expected",
+    [
+        (True, ("", "mke2fs 1.46.5 (30-Dec-2021)\n"), True),
+        (True, ("", "mke2fs 1.47.0 (5-Feb-2023)\n"), True),
+        # Recent kernel, older e2fsprogs, like Ubuntu 20.04 with an HWE kernel.
+        (True, ("", "mke2fs 1.45.5 (07-Jan-2020)\n"), False),
+        (True, execute.NonZeroExitException("return code: 1"), False),
+        (True, FileNotFoundError("mke2fs"), False),
+        (False, ("", "mke2fs 1.46.5 (30-Dec-2021)\n"), False),
+    ],
+)
+def test_ext4_feature_supported(mocker, tmp_path, kernel, mke2fs_output, expected):
+    if kernel:
+        (tmp_path / "fast_commit").write_text("supported\n")
+    mocker.patch("ephemeral_storage_setup.utils.EXT4_FEATURES_PATH", str(tmp_path))
+    mocker.patch("ephemeral_storage_setup.execute.simple", side_effect=[mke2fs_output])
+
+    assert utils.ext4_feature_supported("fast_commit") == expected
+
+
+@pytest.mark.parametrize("fast_commit", [True, False])
+def test_mkfs_profile(mocker, fast_commit):
+    mock_execute_simple = mocker.patch("ephemeral_storage_setup.execute.simple")
+    mocker.patch("ephemeral_storage_setup.readiness.wait_for_nodes")
+    mocker.patch(
+        "ephemeral_storage_setup.utils.ext4_feature_supported",
+        return_value=fast_commit,
+    )
+    dev_path = "/dev/foo"
+
+    utils.mkfs(dev_path, {"profile": "fast-boot"}, stripe=(65536, 131072))
+    (argv,), _ = mock_execute_simple.call_args
+    assert argv[-2:] == [
+        "nodiscard,lazy_itable_init=1,lazy_journal_init=1,stride=16,stripe_width=32",
+        dev_path,
+    ]
+    assert ("fast_commit" in argv) == fast_commit
+
+    with pytest.raises(ValueError):
+        utils.mkfs(dev_path, {"profile": "bogus"})